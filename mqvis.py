@@ -13,6 +13,15 @@
 * FORMAT=html python3.9 mqvis.py
 напечатает веб-страницу
 
+* FORMAT=json python3.9 mqvis.py
+напечатает снимок в json для других программ #F-JSON-API
+
+* PORT=8080 INTERVAL=60 python3.9 mqvis.py serve
+запустит http-сервер, см. #F-SERVE
+
+* HISTORY_FILE=/var/tmp/mqvis.hist python3.9 mqvis.py history [часов] [узлы]
+покажет загрузку узлов по часам из истории, см. #F-HISTORY
+
 фичи:
 - подсветка некоторых узлов (apollo17-36, tesla-hi)
 - разбивка по 8 часов для удобства восприятия
@@ -24,6 +33,30 @@
 - подсветка границ суток #F-HILITE-DAY
 - показывать колонки не от текущего времени а по времени суток, чтобы понимать 
 вот 6 утра, вот 12, вот 18... и оно хорошо сойдется с границей суток #F-CURHOUR-SHIFT
+- squeue запрашивает только нужные поля, SQUEUE_MODE=all - по-старому через %all #F-SQUEUE-NARROW
+- задачи хранятся колонками (array) с общей таблицей строк, а не списком словарей #F-JOBS-TABLE
+- расписание растеризуется по обрезанным окном диапазонам слотов, без перебора по часам #F-RASTER
+  замер: python3.9 mqvis_bench.py
+- полный разбор hostlist (a[1-2],b[3-4], rack[1-2]-node[01-04]) с кешем, и обратное сжатие #F-HOSTLIST
+- времена squeue разбираются через fromisoformat с кешем, опорное now одно на снимок #F-FAST-TIME
+- DETAILED=1: занятые cpu/память/gpu по узлам и часам, одним вызовом scontrol на все задачи #F-DETAILED-USAGE
+- html выдается кусками по строкам узлов в разрезанный шаблон, без склейки всей страницы #F-STREAM-HTML
+- HISTORY_FILE: снимки дописываются в файл (xor-дельты + zlib), просмотр истории без slurm #F-HISTORY
+- индекс пользователь -> задачи -> узлы и слоты, подсветка затрагивает только нужные ячейки #F-USER-INDEX
+- HTML_MODE=compact: расписание уходит в страницу как RLE JSON, ячейки и подсказки строит браузер #F-COMPACT-HTML
+- sinfo/squeue/scontrol запускаются параллельно, выдача разбирается по мере чтения, таймаут SLURM_TIMEOUT #F-PARALLEL-COLLECT
+- шаблон разбирается один раз на места подстановки, перечитывается только при изменении файла,
+  статика шаблона выводится готовыми байтами одним writelines #F-TEMPLATE-CACHE
+- при запуске грузятся только модули текстового режима, есть main() для вызова из других программ #F-FAST-START
+- SLOT_WIDTH=15m|1h|6h - ширина слота, SLOT_WIDTH=adaptive - мелкие слоты около "сейчас", крупные дальше #F-SLOT-WIDTH
+- CACHE_FILE=файл - общий кеш ответов slurm для запусков через cgi, опрос не чаще раза в CACHE_TTL сек #F-CGI-CACHE
+  (к имени добавляется хеш настроек DETAILED, CLUSTERS, SQUEUE_MODE)
+- CLUSTERS=a,b - несколько кластеров на одной странице, опрос параллельно, узлы вида a:node01 #F-MULTI-CLUSTER
+- PROFILE=1 - время этапов, команд slurm и число объектов в stderr, PROFILE_DUMP=файл - профиль cProfile #F-PROFILE
+- шкала свободных cpu по узлам и слотам, FIT=64cpu:12h - где и когда раньше всего поместится задача #F-FIT
+- задачи узла хранятся интервалами слотов, а не списками в каждом слоте; списки по слотам
+  строятся только при отрисовке подсказок #F-INTERVALS
+- массивы и одинаковые задачи сворачиваются в одну строку 12345_[1-500] с числом задач, AGGREGATE=0 - не сворачивать #F-AGGREGATE
 
 режим text:
 - подстветка задач выбранного (текущего) пользователя #F-HILITE-USER-TASKS
@@ -43,6 +76,20 @@
 - показывать число работающих задач во временнОм слоте #F-JOB-CNT
 - подписать имя ехе-шника в тултипе, как это сделано в таблице узлов; в режиме #F-HIDE-USERS так сделано
 
+режим сервера (python3.9 mqvis.py serve) #F-SERVE:
+- один процесс опрашивает slurm раз в INTERVAL секунд и держит снимок в памяти
+- все клиенты получают готовую страницу из снимка, squeue не вызывается на каждый запрос
+- ETag / If-None-Match, неизменившаяся страница отдается как 304
+- адреса: / - html, /text - текстовая таблица, /api/snapshot - json #F-JSON-API
+- /text?user=u1321&job=123 - подсветка задач любого пользователя по индексу снимка #F-USER-INDEX
+- сжатие gzip (и br, если установлен модуль brotli) по Accept-Encoding
+- расписание обновляется инкрементально, по изменившимся задачам, INCREMENTAL=0 - каждый раз с нуля #F-INCREMENTAL
+- STATIC_ASSETS=1 - css и js шаблона отдаются отдельно по /static/<хеш> с долгим кешированием #F-TEMPLATE-CACHE
+- /metrics - время этапов, команд slurm и размеры снимка в формате Prometheus #F-PROFILE
+- /api/fit?q=2x32cpu:12h - где раньше всего поместится задача, json #F-FIT
+- страница не перезагружается целиком: по /events (server-sent events) приходят только
+  изменившиеся ячейки, подсветка пользователя сохраняется; LIVE=0 - по-старому meta refresh #F-LIVE
+
 идеи:
 - подписать вверху и внизу на каждом блоке время его начала
 - либо - подсветить границу суток
@@ -63,6 +110,7 @@ www.cv.imm.uran.ru vasev@imm.uran.ru
 """
 
 import os
+import sys
 
 ################ параметры
 # для текста и для html
@@ -79,142 +127,754 @@ except ValueError:
     print(f"Warning: Invalid SLOTS value, using default 40", file=sys.stderr)
     TIME_SLOTS = 40
 
+# целый параметр из окружения, как SLOTS выше: при ошибке или выходе из [minimum, maximum]
+# предупреждение и значение по умолчанию, а не падение при импорте (в том числе в режимах,
+# где параметр вообще не используется)
+def env_int( name, default, minimum=1, maximum=None ):
+    try:
+        value = int(os.environ.get(name, str(default)))
+    except ValueError:
+        print(f"Warning: Invalid {name} value, using default {default}", file=sys.stderr)
+        return default
+    if value < minimum or (maximum is not None and value > maximum):
+        print(f"Warning: {name} value {value} is out of range, using default {default}", file=sys.stderr)
+        return default
+    return value
+
+# ширина слота #F-SLOT-WIDTH
+# "1h" (по умолчанию), "15m", "6h", "1d" - все слоты одинаковые;
+# "15m:3h,1h:2d,6h" - по 15 мин первые 3 часа от начала окна, затем по часу до 2 суток, дальше по 6 часов;
+# "adaptive" - то же что SLOT_WIDTH_ADAPTIVE. слоты выравниваются по местному времени
+SLOT_WIDTH_ADAPTIVE = "15m:3h,1h:2d,6h"
+
+SLOT_UNITS = {"m": 60, "h": 3600, "d": 86400}
+
+# "90m" -> 5400, ошибка - ValueError
+def parse_duration( text ):
+    text = text.strip()
+    if text[-1:] not in SLOT_UNITS or not text[:-1].isdigit():
+        raise ValueError( text )
+    return int(text[:-1]) * SLOT_UNITS[ text[-1] ]
+
+# спецификация SLOT_WIDTH -> [(ширина слота сек, до какого смещения от начала окна сек или None)]
+def parse_slot_width( spec ):
+    if spec == "adaptive":
+        spec = SLOT_WIDTH_ADAPTIVE
+    tiers = []
+    for part in spec.split(','):
+        width, _, until = part.partition(':')
+        w = parse_duration( width )
+        if w < 60:
+            raise ValueError( part )
+        tiers.append( (w, parse_duration(until) if until else None) )
+    return tiers
+
+try:
+    SLOT_TIERS = parse_slot_width( os.environ.get("SLOT_WIDTH","1h") )
+except (ValueError, IndexError):
+    print("Warning: Invalid SLOT_WIDTH value, using default 1h", file=sys.stderr)
+    SLOT_TIERS = [(3600, None)]
+
 # для текстовой версии
 # подсветить пользователя #F-HILITE-USER-TASKS
 HILITE_USER = os.environ.get("USER","-") # 'u1321'
 # сколько колонок выдать
 COLUMNS = 2
-# по сколько часов разбивать
+# по сколько часов разбивать (по сколько слотов, если слот не час) #F-SLOT-WIDTH
 SLOT_ITEMS = 6
 ###############
 #F-HIDE-USERS
 HIDE_USERS = False if "FORMAT" == "text" else True
-# детальная информация о нагрузке по часам (мб. долго)
-# todo это глючит - не сходятся числа cpu надо разбираться
-DETAILED_USAGE = False
+# детальная информация о нагрузке по часам #F-DETAILED-USAGE
+# один дополнительный вызов scontrol show job -d --oneliner на весь снимок
+DETAILED_USAGE = os.environ.get("DETAILED","0") == "1"
 # показывать число задач #F-JOB-CNT
 SHOW_JOB_CNT = True
-
-
-import sys
+# вид html: full - ячейки отрисованы на сервере, compact - расписание в виде RLE JSON,
+# сетку и подсказки строит скрипт страницы #F-COMPACT-HTML
+HTML_MODE = os.environ.get("HTML_MODE","full")
+# какие поля запрашивать у squeue #F-SQUEUE-NARROW
+# narrow - только нужные (см. SQUEUE_FIELDS), all - старый вариант -o %all
+SQUEUE_MODE = os.environ.get("SQUEUE_MODE","narrow")
+
+# режим сервера #F-SERVE
+# интервал опроса slurm, сек
+POLL_INTERVAL = max(5, env_int("INTERVAL", 60))
+# пересчитывать в сервере только изменившиеся задачи #F-INCREMENTAL
+INCREMENTAL = os.environ.get("INCREMENTAL","1") == "1"
+# сворачивать задачи массивов и одинаковые задачи в одну строку с числом задач #F-AGGREGATE
+AGGREGATE = os.environ.get("AGGREGATE","1") == "1"
+# таймаут одной команды slurm (sinfo, squeue, scontrol), сек #F-PARALLEL-COLLECT
+SLURM_TIMEOUT = env_int("SLURM_TIMEOUT", 60)
+
+# несколько кластеров на одной странице #F-MULTI-CLUSTER
+# CLUSTERS="uran,umt@20,old=env SLURM_CONF=/etc/slurm-old/slurm.conf"
+# имя - опрашивается через -M имя; имя@сек - свой таймаут; имя=команда - префикс к sinfo/squeue/scontrol
+# вместо -M (запускается как есть, без shell). пусто - только локальный кластер, как раньше
+def parse_clusters( spec ):
+    res = []
+    for entry in spec.split(','):
+        entry = entry.strip()
+        if not entry:
+            continue
+        head, _, prefix = entry.partition('=')
+        name, _, timeout = head.strip().partition('@')
+        res.append( {
+            "name": name,
+            "prefix": prefix.split(),
+            "timeout": max(1, int(timeout)) if timeout.isdigit() else SLURM_TIMEOUT,
+        } )
+    return res
+
+CLUSTERS = parse_clusters( os.environ.get("CLUSTERS","") )
+
+# история снимков #F-HISTORY
+# файл истории, пусто - не вести
+HISTORY_FILE = os.environ.get("HISTORY_FILE","")
+# предел размера файла, МБ, сверх него старые записи прореживаются
+HISTORY_MAX_MB = env_int("HISTORY_MAX_MB", 50)
+# не чаще одной записи за столько секунд
+HISTORY_MIN_INTERVAL = env_int("HISTORY_MIN_INTERVAL", 60, 0)
+# для просмотра истории: за сколько часов и какие узлы (регулярное выражение)
+HISTORY_HOURS = env_int("HISTORY_HOURS", 168)
+HISTORY_NODES = os.environ.get("HISTORY_NODES","")
+
+# общий кеш ответов slurm для запусков через cgi #F-CGI-CACHE
+# файл кеша, пусто - каждый запуск опрашивает slurm сам
+CACHE_FILE = os.environ.get("CACHE_FILE","")
+# сколько секунд кеш считается свежим
+CACHE_TTL = env_int("CACHE_TTL", 30)
+# до какого возраста устаревший кеш отдается сразу (а обновляется в фоне), сек; старше - ждем свежий
+CACHE_MAX_STALE = max(CACHE_TTL, env_int("CACHE_MAX_STALE", 600))
+
+# замеры этапов #F-PROFILE
+# PROFILE=1 - напечатать замеры в stderr после выдачи, PROFILE_DUMP=файл - записать cProfile
+PROFILE = os.environ.get("PROFILE","0") == "1"
+PROFILE_DUMP = os.environ.get("PROFILE_DUMP","")
+
+# поиск места под задачу #F-FIT
+# FIT=64cpu:12h или FIT=2x32cpu:1d - вместо таблицы напечатать, где и когда раньше всего поместится задача
+FIT = os.environ.get("FIT","")
+# сколько узлов с самым ранним слотом показывать
+FIT_LIMIT = env_int("FIT_LIMIT", 10)
+
+# адрес и порт http-сервера
+SERVE_BIND = os.environ.get("BIND","127.0.0.1")
+SERVE_PORT = env_int("PORT", 8080, 1, 65535)
+# в режиме сервера отдавать css и js шаблона отдельными файлами с долгим кешированием #F-TEMPLATE-CACHE
+# тогда при обновлении страницы передаются только данные
+STATIC_ASSETS = os.environ.get("STATIC_ASSETS","0") == "1"
+# в режиме сервера страница не перезагружается целиком, а получает изменившиеся ячейки по /events #F-LIVE
+LIVE = os.environ.get("LIVE","1") == "1"
+
+
+# здесь только то, что нужно текстовому режиму (re все равно грузит subprocess).
+# json, html, csv, pathlib и прочее импортируются внутри функций, которым они нужны:
+# так быстрее запуск на каждый запрос (cgi), проверка: python3 -X importtime mqvis.py #F-FAST-START
 import subprocess
-import json
-from pathlib import Path
-import traceback
-import csv
-import io
 from datetime import datetime, timedelta
-from typing import Dict, List, Optional
 from collections import defaultdict
+from array import array
+from itertools import accumulate
+from bisect import bisect_left, bisect_right
+from functools import lru_cache, wraps
 import re
-import html
-
+import time
+import _thread
+
+
+################ замеры этапов #F-PROFILE
+# время и число вызовов этапов, время и объем выдачи команд slurm, число объектов.
+# копятся в METRICS за один снимок, в режиме сервера отдаются на /metrics в формате Prometheus
+
+# _thread встроен в интерпретатор, threading нужен только серверу и командам slurm
+METRICS_LOCK = _thread.allocate_lock()
+
+def new_metrics():
+    return {
+        "stage_seconds": defaultdict(float),    # этап -> сек
+        "stage_calls": defaultdict(int),
+        "command_seconds": defaultdict(float),  # (команда slurm, кластер) -> сек
+        "command_bytes": defaultdict(int),      # (команда slurm, кластер) -> байт выдачи
+        "objects": {},                          # что -> сколько (задачи, узлы, байты страниц)
+    }
+
+METRICS = new_metrics()
+
+def metrics_reset():
+    global METRICS
+    METRICS = new_metrics()
+
+def metric_add( group, key, value ):
+    with METRICS_LOCK:
+        METRICS[group][key] += value
+
+def metric_set( key, value ):
+    with METRICS_LOCK:
+        METRICS["objects"][key] = value
+
+# копия текущих замеров, чтобы следующий снимок их не менял
+def metrics_snapshot():
+    with METRICS_LOCK:
+        return { k: dict(v) for k, v in METRICS.items() }
+
+# with stage_timer( name ): ... - замерять блок как этап name
+class stage_timer:
+    def __init__( self, name ):
+        self.name = name
+
+    def __enter__( self ):
+        self.t0 = time.perf_counter()
+
+    def __exit__( self, *exc ):
+        with METRICS_LOCK:
+            METRICS["stage_seconds"][self.name] += time.perf_counter() - self.t0
+            METRICS["stage_calls"][self.name] += 1
+
+# декоратор: замерять функцию как этап name
+def timed( name ):
+    def deco( fn ):
+        @wraps( fn )
+        def wrapper( *args, **kwargs ):
+            with stage_timer( name ):
+                return fn( *args, **kwargs )
+        return wrapper
+    return deco
+
+def prom_escape( s ):
+    return str(s).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+# замеры в текстовом формате Prometheus
+def metrics_prometheus( m, extra=None ):
+    out = []
+    # label - имя метки или кортеж имен, тогда и ключи values - кортежи
+    def family( name, kind, help_text, label, values ):
+        out.append( f"# HELP {name} {help_text}" )
+        out.append( f"# TYPE {name} {kind}" )
+        for k, v in sorted( values.items() ):
+            if isinstance( label, tuple ):
+                labels = ",".join( f'{l}="{prom_escape(x)}"' for l, x in zip(label, k) )
+            else:
+                labels = f'{label}="{prom_escape(k)}"'
+            out.append( f'{name}{{{labels}}} {v}' )
+    family( "mqvis_stage_seconds", "gauge", "Wall time of a pipeline stage in the last snapshot", "stage", m["stage_seconds"] )
+    family( "mqvis_stage_calls", "gauge", "Calls of a pipeline stage in the last snapshot", "stage", m["stage_calls"] )
+    family( "mqvis_command_seconds", "gauge", "Run time of a Slurm command in the last snapshot", ("command", "cluster"), m["command_seconds"] )
+    family( "mqvis_command_output_bytes", "gauge", "Output size of a Slurm command in the last snapshot", ("command", "cluster"), m["command_bytes"] )
+    family( "mqvis_objects", "gauge", "Objects processed in the last snapshot", "kind", m["objects"] )
+    for name, (kind, help_text, value) in sorted( (extra or {}).items() ):
+        out.append( f"# HELP {name} {help_text}" )
+        out.append( f"# TYPE {name} {kind}" )
+        out.append( f"{name} {value}" )
+    return "\n".join( out ) + "\n"
+
+
+# запуск команды slurm с построчным чтением выдачи #F-PARALLEL-COLLECT
+# строки отдаются по мере поступления из pipe, разбор идет параллельно с работой команды,
+# а не после того как capture_output накопит всю выдачу.
+# через timeout сек процесс убивается и выбрасывается subprocess.TimeoutExpired,
+# при ненулевом коде возврата - subprocess.CalledProcessError (как у run(check=True))
+# metric - ключ замеров (команда slurm, кластер), по умолчанию (args[0], "") #F-PROFILE
+def run_lines( args, timeout=None, metric=None ):
+    if metric is None:
+        metric = ( args[0], "" )
+    if timeout is None:
+        timeout = SLURM_TIMEOUT
+    t0 = time.perf_counter()
+    nbytes = 0
+    # своя группа процессов: при таймауте убиваются и потомки (обертки из CLUSTERS), #F-MULTI-CLUSTER
+    # иначе они держат pipe открытым и чтение ждет их завершения
+    import threading
+    proc = subprocess.Popen( args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, start_new_session=True )
+    killed = []
+    def kill():
+        import signal
+        killed.append(1)
+        try:
+            os.killpg( proc.pid, signal.SIGKILL )
+        except OSError:
+            proc.kill()
+    timer = threading.Timer( timeout, kill )
+    timer.daemon = True
+    timer.start()
+    # stderr читается своим потоком одновременно с stdout: команда, заполнившая pipe stderr,
+    # иначе ждала бы, пока мы дочитаем stdout, а мы - ее
+    errs = []
+    reader = threading.Thread( target=lambda: errs.append( proc.stderr.read() ), daemon=True )
+    reader.start()
+    try:
+        for line in proc.stdout:
+            nbytes += len(line)
+            yield line.rstrip('\n')
+        proc.wait()
+    finally:
+        timer.cancel()
+        #F-PROFILE
+        metric_add( "command_seconds", metric, time.perf_counter() - t0 )
+        metric_add( "command_bytes", metric, nbytes )
+        if proc.poll() is None:
+            # генератор бросили недочитанным
+            proc.kill()
+            proc.wait()
+        reader.join()
+        proc.stdout.close()
+        proc.stderr.close()
+    stderr = "".join( errs )
+    if killed:
+        raise subprocess.TimeoutExpired( args, timeout )
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError( proc.returncode, args, stderr=stderr )
+
+# команда slurm для кластера cluster (None - локальный) #F-MULTI-CLUSTER
+# с -M slurm печатает перед выдачей строку "CLUSTER: имя", она отбрасывается
+def run_slurm( args, cluster=None ):
+    if cluster is None:
+        return run_lines( args )
+    if cluster["prefix"]:
+        cmd = cluster["prefix"] + args
+    else:
+        cmd = [ args[0], '-M', cluster["name"] ] + args[1:]
+    # замеры по самой команде slurm, а не по обертке из prefix (env ...)
+    lines = run_lines( cmd, cluster["timeout"], ( args[0], cluster["name"] ) )
+    return ( line for line in lines if not line.startswith("CLUSTER: ") )
+
+# разбор выдачи sinfo -N -o '%N %C %t %P' (строки) в словарь узлов
+def parse_sinfo( lines ):
+    nodes = {}
+
+    for line in lines:
+        if line.strip():
+            parts = line.split()
+            if len(parts) >= 4:
+                node_name = parts[0]
+                
+                cpu_numbers = [int(x) for x in parts[1].split('/')] # allocated / idle / other / total
+                
+                if node_name in nodes:
+                  nodes[node_name]['partitions'].append( parts[3] )
+                else:                    
+                  nodes[node_name] = {
+                      'cpus': parts[1],
+                      'cpus_free': cpu_numbers[1],
+                      'cpus_total': cpu_numbers[3],
+                      'state': parts[2], 
+                      'partitions': [parts[3]]
+                  }
+    
+    return nodes
 
-def simple_sinfo_dict():
+@timed("simple_sinfo_dict")
+def simple_sinfo_dict( cluster=None ):
     """
     Простая версия для получения списка узлов SLURM
+    cluster - опросить этот кластер (см. CLUSTERS) #F-MULTI-CLUSTER
     """
     try:
         # Выполняем команду
         # добавлено -a чтобы работало под апачем
-        cmd = subprocess.run(['sinfo', '-N', '-a', '--noheader', '-o', '%N %C %t %P'], 
-                           capture_output=True, text=True, check=True)
-        
-        nodes = {}
-        
-        for line in cmd.stdout.strip().split('\n'):
-            if line.strip():
-                parts = line.split()
-                if len(parts) >= 4:
-                    node_name = parts[0]
-                    
-                    cpu_numbers = [int(x) for x in parts[1].split('/')] # allocated / idle / other / total
-                    
-                    if node_name in nodes:
-                      nodes[node_name]['partitions'].append( parts[3] )
-                    else:                    
-                      nodes[node_name] = {
-                          'cpus': parts[1],
-                          'cpus_free': cpu_numbers[1],
-                          'cpus_total': cpu_numbers[3],
-                          'state': parts[2], 
-                          'partitions': [parts[3]]
-                      }
-        
-        return nodes
+        return parse_sinfo( run_slurm(['sinfo', '-N', '-a', '--noheader', '-o', '%N %C %t %P'], cluster) )
         
     except Exception as e:
         print(f"Ошибка: {e}")
         return {}
 
 
-def get_jobs_dataframe():
+# колоночная таблица задач #F-JOBS-TABLE
+# вместо списка словарей по задачам храним параллельные массивы,
+# а строки (пользователи, имена, id задач, списки узлов) - один раз в общей таблице strings.
+# задача = номер строки в массивах
+
+# нет времени (N/A, Unknown)
+NO_TIME = -1
+
+# now - опорное время снимка для коротких форматов времени (MM-DD HH:MM:SS), один раз на снимок #F-FAST-TIME
+def new_jobs_table( now=None ):
+    return {
+        "now": now if now is not None else datetime.now(),
+        "strings": [],          # интернированные строки
+        "string_ids": {},       # строка -> номер в strings
+        "jobid": array('i'),    # номера строк в strings
+        "user": array('i'),
+        "name": array('i'),
+        "nodes": array('i'),    # SCHEDNODES или NODELIST
+        "state": array('b'),    # биты как в schedule: 4 running, 2 pending, 1 прочее
+        "start": array('q'),    # epoch сек или NO_TIME
+        "end": array('q'),
+        "cpus": array('i'),     # число cpu задачи (%C), 0 - неизвестно #F-FIT
+        "count": array('i'),    # сколько задач в строке (массивы, см. aggregate_jobs) #F-AGGREGATE
+    }
+
+def intern_str( jt, s ):
+    i = jt["string_ids"].get(s)
+    if i is None:
+        i = len(jt["strings"])
+        jt["strings"].append(s)
+        jt["string_ids"][s] = i
+    return i
+
+def jobs_count( jt ):
+    return len(jt["jobid"])
+
+# время slurm -> epoch сек #F-FAST-TIME
+# основной формат squeue YYYY-MM-DDTHH:MM:SS разбирается через fromisoformat с кешем:
+# у многих задач одинаковые времена окончания (лимиты), а strptime медленный
+def slurm_epoch( time_str, now=None ):
+    if len(time_str) == 19 and time_str[10] == 'T':
+        try:
+            return iso_epoch( time_str )
+        except ValueError:
+            pass
+    t = parse_slurm_time( time_str, now )
+    return NO_TIME if t is None else int(t.timestamp())
+
+@lru_cache(maxsize=65536)
+def iso_epoch( time_str ):
+    return int( datetime.fromisoformat(time_str).timestamp() )
+
+# добавить задачу в таблицу, аргументы - строки из выдачи squeue
+# cpus - число cpu задачи на всех узлах, пусто - неизвестно
+def jobs_table_add( jt, jobid, user, name, state, start, end, nodelist, schednodes, cpus="" ):
+    nodes_str = schednodes
+    if nodes_str in ('(null)', ''):
+        nodes_str = nodelist
+
+    if state == 'RUNNING':
+        sval = 4
+    elif state == 'PENDING':
+        sval = 2
+    else:
+        sval = 1
+
+    # сначала разбор, потом добавление: ошибка в строке не должна сдвинуть колонки таблицы
+    start_t = slurm_epoch(start, jt["now"])
+    end_t = slurm_epoch(end, jt["now"])
+    # ожидающие задачи массива squeue сам выдает одной строкой 12345_[8-500]
+    count = len( expand_job_ids(jobid) ) if '[' in jobid else 1
+
+    jt["jobid"].append( intern_str(jt, jobid) )
+    jt["user"].append( intern_str(jt, user) )
+    jt["name"].append( intern_str(jt, name) )
+    jt["nodes"].append( intern_str(jt, nodes_str) )
+    jt["state"].append( sval )
+    jt["start"].append( start_t )
+    jt["end"].append( end_t )
+    jt["cpus"].append( int(cpus) if cpus.isdigit() else 0 )
+    jt["count"].append( count )
+
+# jobs_table_add для строки выдачи squeue: строка, которую не удалось разобрать, пропускается
+# с предупреждением, а не обнуляет всю таблицу в get_jobs_dataframe
+def jobs_table_add_line( jt, *fields ):
+    try:
+        jobs_table_add( jt, *fields )
+    except ValueError as e:
+        print(f"squeue: пропущена задача {fields[0]}: {e}", file=sys.stderr)
+
+# hostlist узлов другого кластера: "node[01-02],gpu1" -> "umt:gpu1,umt:node[01-02]" #F-MULTI-CLUSTER
+def namespace_hostlist( nodes_str, prefix ):
+    if nodes_str in ('', '(null)'):
+        return nodes_str
+    return compress_hostlist( [ prefix + n for n in expand_hostlist(nodes_str) ] )
+
+# переименовать задачи и их узлы в таблице jt в пространство имен кластера prefix ("umt:")
+# номера задач разных кластеров пересекаются, поэтому им тоже нужен префикс
+def jobs_table_namespace( jt, prefix ):
+    strings = jt["strings"]
+    for col, conv in ( ("jobid", lambda x: prefix + x), ("nodes", lambda x: namespace_hostlist(x, prefix)) ):
+        ids = {} # старый номер строки -> новый
+        a = jt[col]
+        for k, i in enumerate(a):
+            j = ids.get(i)
+            if j is None:
+                j = ids[i] = intern_str( jt, conv(strings[i]) )
+            a[k] = j
+    return jt
+
+# подпись задачи в ячейках: пользователь или имя программы #F-HIDE-USERS
+def job_label( jt, i ):
+    if HIDE_USERS:
+        # заменяем пользователя на имя программы
+        #cmd = row.get('COMMAND','')
+        #if cmd == '(null)':
+        #    cmd = row.get('WORK_DIR','')
+        #if cmd == '(null)':
+        #    cmd = row.get('NAME','') #jobname
+        #user = cmd.split("/")[-1]
+        return jt["strings"][ jt["name"][i] ] #jobname она там всегда похоже есть и сразу какая надо
+    return jt["strings"][ jt["user"][i] ]
+
+def job_id_str( jt, i ):
+    return jt["strings"][ jt["jobid"][i] ]
+
+################ сворачивание одинаковых задач #F-AGGREGATE
+# массивы задач и серии одинаковых задач дают в очереди тысячи строк, отличающихся только номером.
+# строки с одним номером массива (12345_7 -> 12345) или без массива, у которых совпадают
+# пользователь, имя, состояние, времена, узлы и число cpu, сливаются в одну строку таблицы
+# с числом задач count и сжатым списком номеров 12345_[1-500]. расписание, подсказки и json
+# дальше работают со строками, число задач учитывается весом (jobcnt, cpualloc).
+# задачи с детальной занятостью (DETAILED=1) не сливаются - у каждой своя занятость узлов
+
+# "12345_[1-3,7:2,9%2]" -> ("12345_1", "12345_2", "12345_3", "12345_7", "12345_9"), простой номер - как есть
+# в диапазоне может быть шаг :N, в конце - %N (ограничение одновременно работающих задач массива).
+# непонятная запись считается одной задачей, чтобы одна строка squeue не ломала разбор всей очереди
+JOB_ARRAY_RE = r'(.*_)\[([^\]]*?)(?:%\d+)?\]'
+JOB_ARRAY_RANGE_RE = r'(\d+)(?:-(\d+)(?::(\d+))?)?'
+def expand_job_ids( jobid ):
+    m = re.fullmatch( JOB_ARRAY_RE, jobid ) if '[' in jobid else None
+    if m is None:
+        return (jobid,)
+    master = m.group(1)
+    ids = []
+    for part in m.group(2).split(','):
+        r = re.fullmatch( JOB_ARRAY_RANGE_RE, part.strip() )
+        if r is None:
+            print(f"непонятный номер массива задач {jobid}", file=sys.stderr)
+            return (jobid,)
+        start = int( r.group(1) )
+        end = int( r.group(2) ) if r.group(2) else start
+        step = int( r.group(3) ) if r.group(3) else 1
+        ids.extend( master + str(i) for i in range( start, end + 1, max(1, step) ) )
+    return tuple(ids)
+
+# номер массива задачи: "12345_7", "12345_[1-3]" -> "12345", не массив -> ""
+# с CLUSTERS номер идет после "кластер:", а в имени кластера тоже может быть "_",
+# поэтому режем по последнему "_" и проверяем, что после него номер или диапазон
+JOB_ARRAY_TASK_RE = re.compile( r'\d+|\[[^\]]*\]' )
+def job_array_master( jobid ):
+    master, sep, task = jobid.rpartition('_')
+    if sep and JOB_ARRAY_TASK_RE.fullmatch( task ):
+        return master
+    return ""
+
+# " ×500" для свернутой строки в подсказках
+def job_count_text( jt, i ):
+    n = jt["count"][i]
+    return f" ×{n}" if n > 1 else ""
+
+@timed("aggregate_jobs")
+def aggregate_jobs( jt, usage=None ):
+    """
+    Новая таблица задач, в которой одинаковые задачи слиты в строки с числом задач #F-AGGREGATE
+    usage - детальная занятость, задачи из нее не сливаются
+    Если сливать нечего, возвращается сама jt
+    """
+    strings = jt["strings"]
+    groups = {}     # ключ -> номер группы
+    members = []    # номер группы -> строки jt
+    for idx in range( jobs_count(jt) ):
+        jobid = strings[ jt["jobid"][idx] ]
+        if usage is not None and jobid in usage:
+            key = idx
+        else:
+            key = ( job_array_master( jobid ), jt["user"][idx], jt["name"][idx], jt["state"][idx],
+                    jt["start"][idx], jt["end"][idx], jt["nodes"][idx], jt["cpus"][idx] )
+        g = groups.get( key )
+        if g is None:
+            groups[key] = len(members)
+            members.append( [idx] )
+        else:
+            members[g].append( idx )
+    if len(members) == jobs_count(jt):
+        return jt
+
+    res = new_jobs_table( jt["now"] )
+    for rows in members:
+        jobs_table_append_row( res, jt, rows[0] )
+        if len(rows) > 1:
+            ids = [ x for i in rows for x in expand_job_ids( strings[ jt["jobid"][i] ] ) ]
+            res["jobid"][-1] = intern_str( res, compress_hostlist( ids ) )
+            res["count"][-1] = sum( jt["count"][i] for i in rows )
+    return res
+
+# поля squeue, которые реально используются в build_hourly_schedule #F-SQUEUE-NARROW
+# (имя колонки как в выдаче %all, код формата squeue -o)
+# NAME идет последним: в имени задачи может встретиться разделитель
+SQUEUE_FIELDS = [
+    ("JOBID", "%i"),
+    ("USER", "%u"),
+    ("STATE", "%T"),
+    ("START_TIME", "%S"),
+    ("END_TIME", "%e"),
+    ("NODELIST", "%N"),
+    ("SCHEDNODES", "%Y"),
+    ("CPUS", "%C"),
+    ("NAME", "%j"),
+]
+
+# разбор выдачи squeue -o <SQUEUE_FIELDS> --noheader (строки) в таблицу задач jt
+# строки режутся по фиксированному разделителю, без csv и без промежуточных словарей
+def parse_squeue_narrow(lines, jt):
+    nsplit = len(SQUEUE_FIELDS) - 1
+    for line in lines:
+        if not line:
+            continue
+        parts = line.split('|', nsplit)
+        if len(parts) != len(SQUEUE_FIELDS):
+            continue
+        jobid, user, state, start, end, nodelist, schednodes, cpus, name = [x.strip() for x in parts]
+        jobs_table_add_line( jt, jobid, user, name, state, start, end, nodelist, schednodes, cpus )
+    return jt
+
+# разбор выдачи squeue -o %all (строки, первая - заголовок) в таблицу задач jt
+def parse_squeue_all(lines, jt):
+    import csv
+    # squeue выводит данные в табличном формате с разделителем |
+    reader = csv.DictReader(lines, delimiter='|', skipinitialspace=True)
+
+    for row in reader:
+        new_row = {}
+        for k, v in row.items():
+            if k is None:
+                continue
+            key = k.strip()
+            if key == '':
+                # пропускаем пустые имена колонок (если такие есть)
+                continue
+            new_row[key] = v.strip() if isinstance(v, str) else v
+        jobs_table_add_line( jt, str(new_row.get('JOBID','')), new_row.get('USER',''), new_row.get('NAME',''),
+            new_row.get('STATE',''), new_row.get('START_TIME',''), new_row.get('END_TIME',''),
+            new_row.get('NODELIST',''), new_row.get('SCHEDNODES','(null)'), new_row.get('CPUS','') )
+    return jt
+
+@timed("get_jobs_dataframe")
+def get_jobs_dataframe( now=None, cluster=None ):
     """
-    Выполняет команду squeue -o "%all" --states=PENDING и возвращает DataFrame
+    Выполняет команду squeue и возвращает колоночную таблицу задач #F-JOBS-TABLE
+    В режиме narrow запрашиваются только поля SQUEUE_FIELDS, при ошибке - откат на -o %all
+    now - опорное время снимка #F-FAST-TIME
+    cluster - опросить этот кластер (см. CLUSTERS) #F-MULTI-CLUSTER
     """
+    mode = SQUEUE_MODE
     try:
-        # Выполняем команду squeue
-        # добавлено -a чтобы работало под апачем
-        result = subprocess.run(
-            ['squeue', '-a', '-o', '%all'],
-            capture_output=True,
-            text=True,
-            check=True
-        )
-        
+        if mode != "all":
+            fmt = "|".join( [f[1] for f in SQUEUE_FIELDS] )
+            try:
+                # добавлено -a чтобы работало под апачем
+                # выдача разбирается по мере чтения из pipe #F-PARALLEL-COLLECT
+                jt = parse_squeue_narrow( run_slurm(['squeue', '-a', '--noheader', '-o', fmt], cluster), new_jobs_table(now) )
+            except subprocess.CalledProcessError as e:
+                # например старый squeue не понимает какое-то поле
+                print(f"squeue -o {fmt} не сработал ({e.stderr.strip()}), используем -o %all", file=sys.stderr)
+                mode = "all"
+
+        if mode == "all":
+            # Выполняем команду squeue
+            # добавлено -a чтобы работало под апачем
+            jt = parse_squeue_all( run_slurm(['squeue', '-a', '-o', '%all'], cluster), new_jobs_table(now) )
+
         # Проверяем, есть ли данные
-        if not result.stdout.strip():
+        if jobs_count(jt) == 0:
             print("Нет задач")
-            return []
-        
-        # squeue выводит данные в табличном формате с разделителем |
-        f = io.StringIO(result.stdout)
-        reader = csv.DictReader(f, delimiter='|', skipinitialspace=True)
-
-        cleaned = []
-        for row in reader:
-            new_row = {}
-            for k, v in row.items():
-                if k is None:
-                    continue
-                key = k.strip()
-                if key == '':
-                    # пропускаем пустые имена колонок (если такие есть)
-                    continue
-                new_row[key] = v.strip() if isinstance(v, str) else v
-            cleaned.append(new_row)
-
-        return cleaned        
+        return jt
 
-        
     except subprocess.CalledProcessError as e:
         print(f"Ошибка выполнения команды squeue: {e}")
         print(f"Stderr: {e.stderr}")
-        return []
+        return new_jobs_table(now)
     except FileNotFoundError:
         print("Команда squeue не найдена. Убедитесь, что SLURM установлен.")
-        return []
+        return new_jobs_table(now)
+    except subprocess.TimeoutExpired as e:
+        print(f"squeue не ответил за {e.timeout} сек", file=sys.stderr)
+        return new_jobs_table(now)
     except Exception as e:
         print(f"Ошибка при обработке данных: {e}")
-        return []
+        return new_jobs_table(now)
         
 
+# детальная занятость узлов задачами #F-DETAILED-USAGE
+# scontrol show job -d --oneliner печатает задачу одной строкой, в которой для каждой
+# группы узлов есть " Nodes=apollo[01-02] CPU_IDs=0-31 Mem=64000 GRES=gpu:2(IDX:0-1)"
+# шаблоны компилируются при первом разборе (re.compile кеширует), а не при импорте #F-FAST-START
+DETAIL_NODES_RE = r'(?:^|\s)Nodes=(\S+) CPU_IDs=(\S+) Mem=(\d+)(?: GRES=(\S*))?'
+DETAIL_FIELD_RE = r'(?:^|\s)(JobId|ArrayJobId|ArrayTaskId)=(\S+)'
+
+# "0-15,32-47" -> 32
+def count_ids( ids_str ):
+    n = 0
+    for part in ids_str.split(','):
+        if '-' in part:
+            a, b = part.split('-', 1)
+            n += int(b) - int(a) + 1
+        elif part.isdigit():
+            n += 1
+    return n
+
+# "gpu:2(IDX:0-1)", "gpu:tesla:2(IDX:0,1)" -> 2
+def count_gpus( gres_str ):
+    n = 0
+    for item in re.split(r',(?![^(]*\))', gres_str or ''):
+        if not item.startswith('gpu'):
+            continue
+        if '(IDX:' in item:
+            n += count_ids( item.split('(IDX:', 1)[1].rstrip(')') )
+        else:
+            cnt = item.split('(', 1)[0].split(':')[-1]
+            n += int(cnt) if cnt.isdigit() else 0
+    return n
+
+# разбор выдачи scontrol show job -d --oneliner
+# output: {jobid: {node: {'usedcpu': n, 'mem': MB, 'gpu': n}}}
+# задача массива доступна и по JobId, и по ArrayJobId_ArrayTaskId (так ее показывает squeue %i)
+def parse_scontrol_details( lines ):
+    field_re = re.compile( DETAIL_FIELD_RE )
+    nodes_re = re.compile( DETAIL_NODES_RE )
+    res = {}
+    for line in lines:
+        if not line.strip():
+            continue
+        fields = dict( field_re.findall(line) )
+        jobid = fields.get('JobId')
+        if jobid is None:
+            continue
+        per_node = {}
+        for nodes_str, cpu_ids, mem, gres in nodes_re.findall(line):
+            usedcpu = count_ids( cpu_ids )
+            gpu = count_gpus( gres )
+            for n in expand_hostlist( nodes_str ):
+                per_node[n] = {'usedcpu': usedcpu, 'mem': int(mem), 'gpu': gpu}
+        res[jobid] = per_node
+        task = fields.get('ArrayTaskId')
+        if 'ArrayJobId' in fields and task is not None and task.isdigit():
+            res[ fields['ArrayJobId'] + '_' + task ] = per_node
+    return res
+
+@timed("gather_for_jobids")
+def gather_for_jobids( jobids=None, cluster=None ):
+    """
+    Детальная занятость узлов задачами одним вызовом scontrol #F-DETAILED-USAGE
+    jobids - ограничить ответ этими задачами (None - все)
+    cluster - опросить этот кластер (см. CLUSTERS) #F-MULTI-CLUSTER
+    """
+    try:
+        res = parse_scontrol_details( run_slurm(['scontrol', 'show', 'job', '-d', '--oneliner'], cluster) )
+    except Exception as e:
+        print(f"Ошибка scontrol show job -d: {e}", file=sys.stderr)
+        return {}
+    if jobids is not None:
+        res = { j: res[j] for j in jobids if j in res }
+    return res
+
 def isna(x):
     if x is None:
         return True
     if isinstance(x, float):
+        import math
         return math.isnan(x)        
     return False
 
 
-def parse_slurm_time(time_str: str) -> Optional[datetime]:
+def parse_slurm_time(time_str: str, now: 'datetime | None' = None) -> 'datetime | None':
     """
     Парсит время в формате SLURM в datetime объект
     Форматы: YYYY-MM-DDTHH:MM:SS, MM-DD HH:MM:SS, HH:MM:SS, N/A, Unknown
+    now - опорное время для коротких форматов (по умолчанию текущее)
     """
     if isna(time_str) or time_str in ['N/A', 'Unknown', 'nan', '']:
         return None
     
+    if now is None:
+        now = datetime.now()
+
     try:
         # Полный формат с датой: 2024-01-15T14:30:00
         if 'T' in time_str:
@@ -222,12 +882,12 @@ def parse_slurm_time(time_str: str) -> Optional[datetime]:
         
         # Формат MM-DD HH:MM:SS (предполагаем текущий год)
         if '-' in time_str and ':' in time_str:
-            current_year = datetime.now().year
+            current_year = now.year
             return datetime.strptime(f"{current_year}-{time_str}", '%Y-%m-%d %H:%M:%S')
         
         # Формат только времени HH:MM:SS (предполагаем сегодняшний день)
         if ':' in time_str and len(time_str.split(':')) == 3:
-            today = datetime.now().date()
+            today = now.date()
             time_part = datetime.strptime(time_str, '%H:%M:%S').time()
             return datetime.combine(today, time_part)
         
@@ -237,62 +897,345 @@ def parse_slurm_time(time_str: str) -> Optional[datetime]:
         print(f"Не удалось распарсить время '{time_str}': {e}")
         return None
 
-def parse_nodes_list(nodes_str: str) -> List[str]:
+# разбор hostlist slurm #F-HOSTLIST
+# полный синтаксис: a[1-2],b[3-4], rack[1-2]-node[01-04], node[01-02]-ib, ведущие нули
+# результат кешируется по исходной строке: у многих задач одинаковые списки узлов (apollo[01-64])
+HOSTLIST_CACHE_SIZE = 4096
+
+# разбить строку по запятым вне квадратных скобок
+def split_hostlist( s ):
+    parts = []
+    depth = 0
+    cur = 0
+    for i, ch in enumerate(s):
+        if ch == '[':
+            depth += 1
+        elif ch == ']':
+            depth -= 1
+        elif ch == ',' and depth == 0:
+            parts.append( s[cur:i] )
+            cur = i + 1
+    parts.append( s[cur:] )
+    return [x.strip() for x in parts if x.strip()]
+
+# содержимое скобок "01-03,05" -> ["01","02","03","05"]
+def expand_ranges( ranges_str ):
+    res = []
+    for part in ranges_str.split(','):
+        part = part.strip()
+        if '-' in part:
+            start, end = part.split('-', 1)
+            width = len(start)  # Для сохранения ведущих нулей
+            for i in range(int(start), int(end) + 1):
+                res.append( f"{i:0{width}d}" )
+        elif part:
+            res.append( part )
+    return res
+
+# одно выражение без запятых верхнего уровня: rack[1-2]-node[01-04] -> декартово произведение
+def expand_host_expr( expr ):
+    names = ['']
+    pos = 0
+    while pos < len(expr):
+        b = expr.find('[', pos)
+        if b < 0:
+            tail = expr[pos:]
+            names = [x + tail for x in names]
+            break
+        e = expr.find(']', b)
+        if e < 0:
+            raise ValueError(f"незакрытая скобка в '{expr}'")
+        head = expr[pos:b]
+        items = expand_ranges( expr[b+1:e] )
+        names = [x + head + y for x in names for y in items]
+        pos = e + 1
+    return names
+
+@lru_cache(maxsize=HOSTLIST_CACHE_SIZE)
+def expand_hostlist( nodes_str ):
+    """
+    Раскрывает hostlist slurm в кортеж имен узлов (строки интернированы, sys.intern)
+    Примеры: "node[01-03,05]" -> ("node01", "node02", "node03", "node05")
+             "a[1-2],b3" -> ("a1", "a2", "b3")
+    """
+    if not nodes_str or nodes_str in ('N/A', 'Unknown', 'nan', '(null)'):
+        return ()
+    res = []
+    for expr in split_hostlist( nodes_str ):
+        if '[' in expr:
+            res.extend( expand_host_expr(expr) )
+        else:
+            res.append( expr )
+    return tuple( sys.intern(x) for x in res )
+
+def parse_nodes_list(nodes_str: str) -> 'list[str]':
     """
     Парсит строку с узлами в список отдельных узлов
     Примеры: "node[01-03,05]" -> ["node01", "node02", "node03", "node05"]
     """
-    if isna(nodes_str) or nodes_str in ['N/A', 'Unknown', 'nan', '']:
+    if isna(nodes_str):
         return []
+    return list( expand_hostlist(nodes_str) )
+
+# имя узла -> (префикс, номер, суффикс), номер - последняя группа цифр
+HOST_NUM_RE = r'^(.*?)(\d+)(\D*)$'
+
+def compress_hostlist( names ) -> str:
+    """
+    Обратное к expand_hostlist: список узлов -> компактная строка для показа
+    Пример: ["node01", "node02", "node03", "node05", "gpu1"] -> "gpu1,node[01-03,05]"
+    Номера с разной шириной (01 и 1) в один диапазон не сливаются
+    """
+    num_re = re.compile( HOST_NUM_RE )
+    groups = defaultdict(list) # (префикс, суффикс, ширина) -> номера
+    plain = []
+    for n in set(names):
+        m = num_re.match(n)
+        if m is None:
+            plain.append(n)
+            continue
+        num = m.group(2)
+        # ширина важна только для номеров с ведущими нулями; сам 0 сливается с 1, 2...
+        width = len(num) if num.startswith('0') and len(num) > 1 else 0
+        groups[(m.group(1), m.group(3), width)].append( int(num) )
+
+    items = [(n, n) for n in plain]
+    for (prefix, suffix, width), nums in groups.items():
+        nums.sort()
+        if len(nums) == 1:
+            s = prefix + f"{nums[0]:0{width}d}" + suffix
+            items.append( (s, s) )
+            continue
+        ranges = []
+        a = b = nums[0]
+        for x in nums[1:]:
+            if x == b + 1:
+                b = x
+                continue
+            ranges.append( (a, b) )
+            a = b = x
+        ranges.append( (a, b) )
+        txt = ",".join( f"{a:0{width}d}" if a == b else f"{a:0{width}d}-{b:0{width}d}" for a, b in ranges )
+        items.append( (prefix + f"{nums[0]:0{width}d}" + suffix, prefix + "[" + txt + "]" + suffix) )
+    items.sort()
+    return ",".join( x[1] for x in items )
     
-    nodes = []
-    
-    # Обрабатываем формат node[01-03,05]
-    pattern = r'(\w+)\[([^\]]+)\]'
-    match = re.search(pattern, nodes_str)
-    
-    if match:
-        prefix = match.group(1)
-        ranges_str = match.group(2)
-        
-        for part in ranges_str.split(','):
-            if '-' in part:
-                # Диапазон узлов
-                start, end = part.split('-')
-                start_num = int(start)
-                end_num = int(end)
-                width = len(start)  # Для сохранения ведущих нулей
-                
-                for i in range(start_num, end_num + 1):
-                    node_name = f"{prefix}{i:0{width}d}"
-                    nodes.append(node_name)
-            else:
-                # Отдельный узел
-                if part.isdigit():
-                    width = len(part)
-                    node_name = f"{prefix}{int(part):0{width}d}"
-                    nodes.append(node_name)
-                else:
-                    nodes.append(f"{prefix}{part}")
+# растеризация: биты состояния слота #F-RASTER
+# для каждого узла ведется разностный массив по каждому биту (строка длины TIME_SLOTS+1),
+# задача добавляет +1 в начале своего диапазона слотов и -1 после конца,
+# а schedule получается одним проходом накопленных сумм по узлу
+RASTER_BITS = (1, 2, 4, 8)
+
+def new_raster_row( nslots ):
+    return array('i', bytes( 4 * len(RASTER_BITS) * (nslots+1) ))
+
+# добавить (w=1) или убрать (w=-1) вклад задачи sval в слоты [s, e) узла
+def raster_add( row, nslots, s, e, sval, w=1 ):
+    off = 0
+    for bit in RASTER_BITS:
+        if sval & bit:
+            row[off + s] += w
+            row[off + e] -= w
+        off += nslots + 1
+
+# сдвинуть разностный массив (список или array из частей по nslots+1) на d <= nslots слотов вперед
+# первый элемент каждой части - сумма ушедших, чтобы продолжающиеся задачи не потерялись
+def diff_shift( row, nslots, d ):
+    out = row[:0]
+    for off in range(0, len(row), nslots + 1):
+        out.append( sum( row[off:off+d+1] ) )
+        out.extend( row[off+d+1:off+nslots+1] )
+        out.extend( [0] * d )
+    return out
+
+# задачи узла хранятся интервалами [(строка таблицы задач, первый слот, слот после последнего)],
+# отсортированными по строке; память и время построения - по числу пар задача-узел, а не
+# задача-узел-слот. списки по слотам получаются из интервалов там, где они нужны #F-INTERVALS
+
+# списки задач узла rec по слотам, задачи в порядке строк таблицы
+def slot_job_lists( rec, nslots ):
+    lists = [[] for x in range(nslots)]
+    for row, s, e in rec['intervals']:
+        for k in range(s, e):
+            lists[k].append( row )
+    return lists
+
+# разностный массив узла -> битовые маски по слотам
+def raster_schedule( row, nslots ):
+    sch = [0] * nslots
+    off = 0
+    for bit in RASTER_BITS:
+        part = row[off:off+nslots]
+        off += nslots + 1
+        if not any(part):
+            continue
+        k = 0
+        for v in accumulate(part):
+            if v > 0:
+                sch[k] |= bit
+            k += 1
+    return sch
+
+# сетка слотов окна #F-SLOT-WIDTH
+# {start: datetime начала слота 0, t0: то же в epoch, edges: границы слотов в epoch (nslots+1),
+#  width: ширина слота сек если все одинаковые, иначе None, labels: метки слотов,
+#  breaks: слоты, перед которыми ставится разделитель колонок, days: слоты, с которых начинаются сутки,
+#  seps: число разделителей перед каждым слотом}
+# слоты выравниваются по местному времени своей ширины (час - по началу часа, 6h - 0, 6, 12, 18 ч),
+# при переходе на более широкие слоты сначала идет короткий слот до ближайшей границы.
+# разделители колонок - каждые SLOT_ITEMS слотов (для часа - 0, 6, 12, 18 ч) и на смене ширины
+# метки времени считаются один раз на слот (а не на задачу-узел-слот);
+# сетка зависит только от начала окна, поэтому кешируется
+def slot_grid( now, nslots=None, tiers=None ):
+    tiers = tuple( tiers or SLOT_TIERS )
+    ls = local_seconds( now )
+    return make_slot_grid( ls - ls % tiers[0][0], nslots or TIME_SLOTS, tiers )
+
+# местное время в секундах от 1970-01-01 без учета пояса, для выравнивания по часам и суткам
+def local_seconds( dt ):
+    return int( (dt.replace(tzinfo=None) - datetime(1970, 1, 1)).total_seconds() )
+
+@lru_cache(maxsize=16)
+def make_slot_grid( ls0, nslots, tiers ):
+    w0 = tiers[0][0]
+    start = datetime(1970, 1, 1) + timedelta(seconds=ls0)
+    offsets = [0]
+    tier_of = []    # номер ступени каждого слота
+    cur = 0
+    ti = 0
+    while len(tier_of) < nslots:
+        while ti + 1 < len(tiers) and tiers[ti][1] is not None and cur >= tiers[ti][1]:
+            ti += 1
+        w = tiers[ti][0]
+        cur += w - (ls0 + cur) % w
+        offsets.append( cur )
+        tier_of.append( ti )
+    t0 = int( start.timestamp() )
+    breaks = set()
+    for k in range(1, nslots):
+        w = tiers[ tier_of[k] ][0]
+        if tier_of[k] != tier_of[k-1] or (ls0 + offsets[k]) % (SLOT_ITEMS * w) == 0:
+            breaks.add( k )
+    seps = list( accumulate( 1 if k in breaks else 0 for k in range(nslots) ) )
+    return {
+        "start": start,
+        "t0": t0,
+        "edges": [ t0 + o for o in offsets ],
+        "width": w0 if len(tiers) == 1 else None,
+        "labels": [ (start + timedelta(seconds=o)).strftime('%d-%m-%Y %H:%M') for o in offsets[:-1] ],
+        "breaks": breaks,
+        "days": { k for k in range(nslots) if (ls0 + offsets[k]) % 86400 == 0 },
+        "seps": seps,
+    }
+
+# сетка, по которой построено расписание узлов gnodes (пустой снимок - сетка от текущего времени)
+def snapshot_grid( gnodes ):
+    for rec in gnodes.values():
+        if 'grid' in rec:
+            return rec['grid']
+    return slot_grid( datetime.now() )
+
+# "1 ч", "15 мин" - подпись ширины слота для легенды
+def slot_width_text( w ):
+    if w % 86400 == 0:
+        return f"{w // 86400} сут"
+    if w % 3600 == 0:
+        return "час" if w == 3600 else f"{w // 3600} ч"
+    return f"{w // 60} мин"
+
+# вставляет в массив arr элемент e перед слотами из breaks (см. slot_grid) #F-SLOT-WIDTH
+def insert_breaks( arr, breaks, e ):
+    result = []
+    for i, x in enumerate(arr):
+        if i in breaks:
+            result.append(e)
+        result.append(x)
+    return result
+
+# индекс для подсветки #F-USER-INDEX
+# {пользователь: {jobid: {"label": подпись в html, "state": биты 4/2/1, "spans": [(узел, s, e), ...]}}}
+# позволяет подсветить любого пользователя или задачу за O(совпадений), без пересчета расписания
+def user_index_job( index, user, jobid, label, sval ):
+    job = { "label": label, "state": sval & 7, "spans": [] }
+    index.setdefault( user, {} )[jobid] = job
+    return job["spans"]
+
+# ячейки пользователя user (или одной его задачи jobid): {узел: set(слоты)}
+def user_index_cells( index, user, jobid=None ):
+    cells = defaultdict(set)
+    for jid, job in index.get( user, {} ).items():
+        if jobid is not None and jid != jobid:
+            continue
+        for n, s, e in job["spans"]:
+            cells[n].update( range(s, e) )
+    return cells
+
+# задачи пользователя из индекса в виде user_tasks #F-SHOW-USER-TASKS
+def user_index_tasks( index, user ):
+    user_tasks = {"running":[],"other":[],"pending":[]}
+    for jobid, job in index.get( user, {} ).items():
+        add_user_task( user_tasks, jobid, job["state"] )
+    return user_tasks
+
+#F-SHOW-USER-TASKS
+def add_user_task( user_tasks, jobid, sval ):
+    if sval & 4:                    
+        user_tasks["running"].append( jobid )
+    elif sval & 2:
+        user_tasks["pending"].append( jobid )
     else:
-        # Простой формат или список через запятую
-        if ',' in nodes_str:
-            nodes = [node.strip() for node in nodes_str.split(',')]
-        else:
-            nodes = [nodes_str.strip()]
-    
-    return [node for node in nodes if node]
-    
-# input: df это список словарей: [ {jobinfo}, {jobinfo}, ... ]
+        # todo тут может быть разбивка - ошибки и пр
+        user_tasks["other"].append( jobid )
+
+# диапазон слотов задачи [s, e) в сетке grid (см. slot_grid), еще не обрезанный окном #F-RASTER
+# до начала окна s = -1, после конца s = nslots; номер слота - двоичный поиск по границам,
+# поэтому стоимость не зависит от ширины и числа слотов #F-SLOT-WIDTH
+# None если задачу нельзя расположить во времени
+def job_slot_range( sval, start_ts, end_ts, grid ):
+    # Если нет времени окончания, пропускаем
+    if end_ts == NO_TIME:
+        return None
+
+    edges = grid["edges"]
+    # Если нет времени начала, используем текущее время для запущенных задач
+    if sval & 4:
+        s = 0
+    elif start_ts != NO_TIME:
+        s = bisect_right( edges, start_ts ) - 1
+    else:
+        return None
+    # слот окончания задачи включительно
+    e = bisect_right( edges, end_ts )
+    return s, e
+
+# детальная занятость: ключ записи узла и поле usage #F-DETAILED-USAGE
+DETAIL_KEYS = ( ("cpuinfo", "usedcpu"), ("meminfo", "mem"), ("gpuinfo", "gpu") )
+
+# сколько cpu задача занимает на одном узле rec #F-FIT
+# qq - детальная занятость задачи на узле (DETAILED=1), иначе число cpu задачи ncpu делится
+# поровну на ее nnodes узлов; если и оно неизвестно - считаем, что задача занимает узел целиком
+# count - число одинаковых задач в строке #F-AGGREGATE
+def job_node_cpus( ncpu, nnodes, rec, qq=None, count=1 ):
+    if qq is not None:
+        return qq['usedcpu']
+    if ncpu > 0:
+        return min( rec['cpus_total'], -(-ncpu // nnodes) * count )
+    return rec['cpus_total']
+
+# input: df это колоночная таблица задач, см. new_jobs_table #F-JOBS-TABLE
 # output: gnodes это словарь хостов {hostname: {...}}
 # output: user_tasks это список id задач выбранного пользователя, словарь вида
 #         {"running":[...],"pending":[...],"other":[...]}
-def build_hourly_schedule(df, gnodes, user_tasks):
+# input: usage - детальная занятость из gather_for_jobids, None - не считать #F-DETAILED-USAGE
+# output: index - если задан словарь, в него строится индекс пользователь -> задачи -> узлы и слоты #F-USER-INDEX
+@timed("build_hourly_schedule")
+def build_hourly_schedule(df, gnodes, user_tasks, usage=None, index=None):
     """
     Строит словарь расписания по часам
+    Диапазон слотов задачи считается арифметически и обрезается окном [0, TIME_SLOTS) #F-RASTER
     """
-    schedule = defaultdict(set)  # Используем set для избежания дубликатов
-    now_time = datetime.now()
+    # опорное время снимка, то же что при разборе времен #F-FAST-TIME
+    now_time = df["now"]
     
     #print(f"Текущее время: {current_time}")
     #print(f"Анализируем {len(df)} задач...")
@@ -300,159 +1243,372 @@ def build_hourly_schedule(df, gnodes, user_tasks):
     processed_jobs = 0
     
     max_time_slots = TIME_SLOTS
-    
-    for n in gnodes.keys():
-      # битовая маска занятости
-      sch = [0 for x in range(max_time_slots)]
-      gnodes[n]['schedule'] = sch
 
-      # колво занятых цпу
-      cc = [0 for x in range(max_time_slots)]
-      gnodes[n]['cpuinfo'] = cc
+    # сетка слотов от текущего времени #F-SLOT-WIDTH
+    grid = slot_grid( now_time, max_time_slots )
+
+    # метки времени общие для всех узлов
+    timeinfo = grid["labels"]
 
-      #jobinfo = 
-      # информация юзер:jobid
-      gnodes[n]['jobinfo'] = [[] for x in range(max_time_slots)]
+    raster = {}
+    alloc = {}
+    jobcnt = {}
+    detail = {}
+    for n in gnodes.keys():
+      # разностный массив занятости, из него потом битовая маска schedule
+      raster[n] = new_raster_row( max_time_slots )
+      # разностный массив выделенных cpu, из него cpualloc #F-FIT
+      alloc[n] = [0] * (max_time_slots + 1)
+      # разностный массив числа задач, из него jobcnt #F-JOB-CNT
+      jobcnt[n] = [0] * (max_time_slots + 1)
+      if usage is not None:
+          # разностные массивы занятых цпу, памяти (МБ) и gpu #F-DETAILED-USAGE
+          detail[n] = [ [0] * (max_time_slots + 1) for key in DETAIL_KEYS ]
+
+      # задачи узла интервалами (номер задачи в таблице df, первый слот, слот после последнего) #F-INTERVALS
+      gnodes[n]['intervals'] = []
       
       # метки времени
-      gnodes[n]['timeinfo'] = ["" for x in range(max_time_slots)]
+      gnodes[n]['timeinfo'] = timeinfo
+      gnodes[n]['grid'] = grid
 
     
-    for idx, row in enumerate(df):
+    strings = df["strings"]
+    for idx in range(jobs_count(df)):
         try:
-            start_time = parse_slurm_time(row.get('START_TIME', ''))
-            end_time = parse_slurm_time(row.get('END_TIME', ''))
-            nodes_str = row.get('SCHEDNODES', '(null)')
-            if nodes_str == '(null)':
-                nodes_str = row.get('NODELIST', '') 
+            nodes_str = strings[ df["nodes"][idx] ]
             
             if not nodes_str or nodes_str in ['N/A', 'Unknown']:
                 continue
             
-            nodes = parse_nodes_list(nodes_str)
+            nodes = expand_hostlist(nodes_str) #F-HOSTLIST
             if not nodes:
-                #print("no nodes",nodes_str,row.get('SCHEDNODES', '(null)'),row.get('NODELIST', '-'))
-                #print(row)
                 # какие-то неназначенные задания
                 continue
                 
             #print(nodes)
 
+            jobid = job_id_str(df, idx)
+            job_record = idx # ссылка на задачу в таблице df: пользователь и айди работы #F-JOBS-TABLE
             
-            if HIDE_USERS: #F-HIDE-USERS
-                # заменяем пользователя на имя программы
-                #cmd = row.get('COMMAND','')
-                #if cmd == '(null)':
-                #    cmd = row.get('WORK_DIR','')
-                #if cmd == '(null)':
-                #    cmd = row.get('NAME','') #jobname
-                #user = cmd.split("/")[-1]
-                user = row.get('NAME','') #jobname она там всегда похоже есть и сразу какая надо
-            else:
-                user = row.get('USER','')
-
-            jobid = str(row.get('JOBID',''))
-            job_record = [user, jobid] # сюда запишем пользователя и айди работы
-            
-            # Если нет времени начала, используем текущее время для запущенных задач
-            #if start_time is None:
-            if row.get('STATE', '') == 'RUNNING':
-                start_time = now_time
-                sval = 4
-            elif row.get('STATE', '') == 'PENDING':
-                sval = 2
-            else:
-                sval = 1
+            sval = df["state"][idx]
+            start_ts = df["start"][idx]
+            end_ts = df["end"][idx]
                 
             # вообще они бывают одновременно и running и pending это видимо если процессоры свободные есть
             #if row.get('STATE', '') == 'PENDING':
             #    sval = sval | 2
                 
-            if row.get('USER','') == HILITE_USER: #F-HILITE-USER-TASKS
+            if strings[ df["user"][idx] ] == HILITE_USER: #F-HILITE-USER-TASKS
                 sval = sval | 8
-                #F-SHOW-USER-TASKS
-                if sval & 4:                    
-                    user_tasks["running"].append( jobid )
-                elif sval & 2:
-                    user_tasks["pending"].append( jobid )
-                else:
-                    # todo тут может быть разбивка - ошибки и пр
-                    user_tasks["other"].append( jobid )
+                add_user_task( user_tasks, jobid, sval )
+
+            if index is not None:
+                spans = user_index_job( index, strings[ df["user"][idx] ], jobid, job_label(df, idx), sval )
+            else:
+                spans = None
             
-            # Если нет времени окончания, пропускаем
-            if end_time is None:
-                #print("no end time")
+            rng = job_slot_range( sval, start_ts, end_ts, grid )
+            if rng is None:
+                continue
+            s, e = rng
+
+            # обрезаем окном
+            s = max(0, s)
+            e = min(max_time_slots, e)
+            if s >= e:
                 continue
-            
-            # Генерируем часы от начала до конца выполнения задачи
-            
-            # час начала задачи
-            current_hour = start_time.replace(minute=0, second=0, microsecond=0)
-            # час конца задачи
-            end_hour = end_time.replace(minute=0, second=0, microsecond=0)
-            
-            # час сейчас
-            start_hour = now_time.replace(minute=0, second=0, microsecond=0)
 
-            if DETAILED_USAGE:
-                #print("get details jobid", jobid, file=sys.stderr,flush=True)
-                h = gather_for_jobids( [jobid] )
-                jinfo = h[ jobid ]
+            if usage is not None:
+                jinfo = usage.get( jobid, {} )
             else:
                 jinfo = {}
-            
-            while current_hour <= end_hour:
-                diff = current_hour - start_hour
-                hours = diff.total_seconds() / 3600
-                time_slot = int(hours)
-                #hour_key = current_hour.strftime('%Y-%m-%d %H:00')
-                hour_key = current_hour.strftime('%d-%m-%Y %H:00')
-                
-                if time_slot < TIME_SLOTS:                
-                    #print( time_slot )
-                    for n in nodes:
-                        sch = gnodes[n]['schedule']
-                        sch[ time_slot ] = sch[ time_slot ] | sval
-                        
-                        sch_jobinfo = gnodes[n]['jobinfo']
-                        sch_jobinfo[ time_slot ].append( job_record )
-                        
-                        gnodes[n]['timeinfo'][ time_slot ] = hour_key
-
-                        if DETAILED_USAGE:
-                            if n in jinfo:
-                                #    print("tt",jinfo[n])
-                                qq = jinfo[n]['usedcpu']
-                                gnodes[n]['cpuinfo'][time_slot] += qq
-                            else:
-                                #print("n is not in jinfo, =",jinfo,file=sys.stderr)
-                                pass
-                    
-                
-                #schedule[hour_key].update(nodes)
-                current_hour += timedelta(hours=1)
-                
-                #if sval & 8:
-                #   print(current_hour, time_slot)
-                    
+
+            for n in nodes:
+                row = raster.get(n)
+                if row is None:
+                    # узла нет в sinfo
+                    continue
+                raster_add( row, max_time_slots, s, e, sval )
+                if spans is not None:
+                    spans.append( (n, s, e) )
+
+                cnt = df["count"][idx] #F-AGGREGATE
+                a = jobcnt[n]
+                a[s] += cnt
+                a[e] -= cnt
+                a = alloc[n]
+                c = job_node_cpus( df["cpus"][idx], len(nodes), gnodes[n], jinfo.get(n), cnt ) #F-FIT
+                a[s] += c
+                a[e] -= c
+
+                # задачи идут по порядку строк df, поэтому интервалы узла уже отсортированы
+                gnodes[n]['intervals'].append( (job_record, s, e) )
+
+                if n in jinfo:
+                    #F-DETAILED-USAGE
+                    qq = jinfo[n]
+                    for d, (key, field) in zip( detail[n], DETAIL_KEYS ):
+                        d[s] += qq[field]
+                        d[e] -= qq[field]
 
             processed_jobs += 1
             
         except Exception as e:
             print(f"Ошибка при обработке задачи {idx}: {e}" )
+            import traceback
             traceback.print_exc()
             continue
     
     #print(f"Обработано задач: {processed_jobs}")
-    
-    # Конвертируем sets в списки и сортируем
-    #result = {}
-    #for hour, nodes_set in schedule.items():
-    #    result[hour] = sorted(list(nodes_set))
-    
-    #return dict(sorted(result.items()))
+
+    for n in gnodes.keys():
+        # битовая маска занятости
+        gnodes[n]['schedule'] = raster_schedule( raster[n], max_time_slots )
+        gnodes[n]['cpualloc'] = list( accumulate( alloc[n][:max_time_slots] ) )
+        gnodes[n]['jobcnt'] = list( accumulate( jobcnt[n][:max_time_slots] ) )
+        if usage is not None:
+            for d, (key, field) in zip( detail[n], DETAIL_KEYS ):
+                gnodes[n][key] = list( accumulate( d[:max_time_slots] ) )
+        else:
+            # колво занятых цпу, без детальной занятости не известно
+            gnodes[n]['cpuinfo'] = [0] * max_time_slots
+
     return None
     
+################ инкрементальное расписание #F-INCREMENTAL
+# для режима сервера: между опросами меняется малая часть очереди, поэтому состояние
+# расписания хранится между обновлениями, а обрабатываются только изменившиеся задачи.
+# задача опознается по отпечатку (jobid, состояние, начало, конец, узлы, пользователь, имя, cpu, число задач):
+# пропавшие и изменившиеся отпечатки вычитаются из слотов, новые добавляются.
+# при смене часа окно сдвигается, дописываются только хвосты задач, уходящих за окно.
+# интервалы узлов ссылаются на строки собственной таблицы задач состояния (state["table"]),
+# строки не переиспользуются; когда мертвых строк становится много - полная пересборка
+
+def new_schedule_state():
+    return {
+        "grid": None,       # сетка слотов, см. slot_grid #F-SLOT-WIDTH
+        "nslots": TIME_SLOTS,
+        "node_names": None, # узлы sinfo и их число cpu, при изменении - пересборка
+        "nodes": {},        # узел -> {raster, intervals, diff, cpus_total, out}
+        "jobs": {},         # отпечаток -> запись задачи, см. sched_state_add
+        "table": new_jobs_table(),
+        "dead": 0,          # строк table, задачи которых уже удалены
+        "usage": False,     # считалась ли детальная занятость
+        "churn": 0,         # число добавленных+удаленных задач при последнем обновлении
+    }
+
+# node - запись узла из sinfo
+# все по слотам хранится разностными массивами: добавление задачи не зависит от ее длины
+def sched_state_node( nslots, usage, node ):
+    rec = {
+        # счетчики задач по битам RASTER_BITS, см. raster_add
+        "raster": new_raster_row( nslots ),
+        # строка задачи в state["table"] -> [первый слот, слот после последнего] #F-INTERVALS
+        "intervals": {},
+        # выделенные cpu (см. job_node_cpus #F-FIT) и детальная занятость #F-DETAILED-USAGE
+        # число задач по слотам (jobcnt #F-JOB-CNT)
+        "diff": { key: [0] * (nslots + 1) for key in ["cpualloc", "jobcnt"] + ([k for k, f in DETAIL_KEYS] if usage else []) },
+        "cpus_total": node['cpus_total'],
+        "out": None,        # последняя выдача узла, см. incremental_schedule
+    }
+    return rec
+
+def job_fingerprint( df, idx ):
+    strings = df["strings"]
+    return ( strings[ df["jobid"][idx] ], df["state"][idx], df["start"][idx], df["end"][idx],
+             strings[ df["nodes"][idx] ], strings[ df["user"][idx] ], strings[ df["name"][idx] ],
+             df["cpus"][idx], df["count"][idx] )
+
+# добавить (w=1) или убрать (w=-1) задачу job в слотах [s, e) ее узлов
+def sched_state_apply( st, job, s, e, w, dirty ):
+    if s >= e:
+        return
+    row = job["row"]
+    sval = job["sval"]
+    jinfo = job["jinfo"]
+    for n in job["nodes"]:
+        rec = st["nodes"].get(n)
+        if rec is None:
+            # узла нет в sinfo
+            continue
+        dirty.add(n)
+        raster_add( rec["raster"], st["nslots"], s, e, sval, w )
+        iv = rec["intervals"]
+        if w < 0:
+            # задача убирается только целиком
+            iv.pop( row, None )
+        elif row in iv and iv[row][1] == s:
+            # продление при сдвиге окна
+            iv[row][1] = e
+        else:
+            iv[row] = [s, e]
+        diff = rec["diff"]
+        diff["jobcnt"][s] += w * job["count"]
+        diff["jobcnt"][e] -= w * job["count"]
+        c = w * job_node_cpus( job["ncpu"], len(job["nodes"]), rec, jinfo.get(n), job["count"] ) #F-FIT
+        diff["cpualloc"][s] += c
+        diff["cpualloc"][e] -= c
+        if n in jinfo:
+            #F-DETAILED-USAGE
+            qq = jinfo[n]
+            for key, field in DETAIL_KEYS:
+                d = diff.get(key)
+                if d is None:
+                    continue
+                d[s] += w * qq[field]
+                d[e] -= w * qq[field]
+
+# добавить задачу idx таблицы df в состояние
+def sched_state_add( st, fp, df, idx, usage, dirty ):
+    nodes = expand_hostlist( fp[4] ) #F-HOSTLIST
+    sval = df["state"][idx]
+    if fp[5] == HILITE_USER: #F-HILITE-USER-TASKS
+        sval |= 8
+    tab = st["table"]
+    row = jobs_count( tab )
+    jobs_table_append_row( tab, df, idx )
+    job = { "row": row, "sval": sval, "nodes": nodes, "start": fp[2], "end": fp[3], "ncpu": fp[7], "count": fp[8],
+            "jinfo": usage.get( fp[0], {} ) if usage is not None else {} }
+    rng = job_slot_range( sval, fp[2], fp[3], st["grid"] )
+    if rng is not None:
+        s, e = max(0, rng[0]), min(st["nslots"], rng[1])
+        job["s"], job["e"] = s, max(s, e)
+        sched_state_apply( st, job, job["s"], job["e"], 1, dirty )
+    else:
+        job["s"] = job["e"] = 0
+    st["jobs"][fp] = job
+
+# скопировать строку idx таблицы src в конец таблицы dst #F-JOBS-TABLE
+def jobs_table_append_row( dst, src, idx ):
+    strings = src["strings"]
+    for col in ("jobid", "user", "name", "nodes"):
+        dst[col].append( intern_str( dst, strings[ src[col][idx] ] ) )
+    for col in ("state", "start", "end", "cpus", "count"):
+        dst[col].append( src[col][idx] )
+
+# сдвинуть окно на d слотов вперед (сменился слот, сетка из одинаковых слотов)
+def sched_state_shift( st, d, dirty ):
+    nslots = st["nslots"]
+    d = min(d, nslots)
+    for n, rec in st["nodes"].items():
+        rec["raster"] = diff_shift( rec["raster"], nslots, d )
+        for key, diff in rec["diff"].items():
+            rec["diff"][key] = diff_shift( diff, nslots, d )
+        iv = {}
+        for row, (s, e) in rec["intervals"].items():
+            if e > d:
+                iv[row] = [max(0, s - d), e - d]
+        rec["intervals"] = iv
+        dirty.add(n)
+    for job in st["jobs"].values():
+        # после сдвига прежний диапазон [s-d, e-d), продлеваем тех, кто упирался в конец окна
+        s = max(0, job["s"] - d)
+        e = max(s, job["e"] - d)
+        rng = job_slot_range( job["sval"], job["start"], job["end"], st["grid"] )
+        if rng is None:
+            continue
+        s2, e2 = max(0, rng[0]), min(nslots, rng[1])
+        if e2 > e:
+            if e <= s:
+                # задача раньше была целиком за окном
+                s = e = s2
+            sched_state_apply( st, job, e, e2, 1, dirty )
+            e = e2
+        job["s"], job["e"] = s, e
+
+@timed("incremental_schedule")
+def incremental_schedule( st, df, gnodes, user_tasks, usage=None, index=None ):
+    """
+    То же что build_hourly_schedule, но с сохранением состояния st между вызовами #F-INCREMENTAL
+    Стоимость пропорциональна числу изменившихся задач, а не размеру очереди
+    st - результат new_schedule_state(), изменяется на месте
+    """
+    nslots = st["nslots"]
+    grid = slot_grid( df["now"], nslots )
+    old = st["grid"]
+    # от числа cpu узла зависит оценка cpualloc #F-FIT
+    node_names = { n: rec['cpus_total'] for n, rec in gnodes.items() }
+
+    # сдвигать можно только сетку из одинаковых слотов, переменная сетка строится заново #F-SLOT-WIDTH
+    rebuild = ( old is None or grid["t0"] < old["t0"]
+                or (grid["t0"] != old["t0"] and (grid["width"] is None or grid["width"] != old["width"]))
+                or node_names != st["node_names"]
+                or (usage is not None) != st["usage"]
+                or st["dead"] > max(1000, len(st["jobs"])) )
+    if rebuild:
+        fresh = new_schedule_state()
+        st.clear()
+        st.update( fresh )
+        st["grid"] = grid
+        st["node_names"] = node_names
+        st["usage"] = usage is not None
+        for n in gnodes.keys():
+            st["nodes"][n] = sched_state_node( nslots, st["usage"], gnodes[n] )
+
+    dirty = set( st["nodes"].keys() ) if rebuild else set()
+
+    if grid["t0"] != st["grid"]["t0"]:
+        # сменился слот: окно сдвигается на целое число слотов
+        d = (grid["t0"] - st["grid"]["t0"]) // grid["width"]
+        st["grid"] = grid
+        sched_state_shift( st, d, dirty )
+
+    # отпечатки текущей очереди, задачи без узлов в расписание не попадают
+    current = {}
+    strings = df["strings"]
+    for idx in range(jobs_count(df)):
+        nodes_str = strings[ df["nodes"][idx] ]
+        if not nodes_str or nodes_str in ['N/A', 'Unknown']:
+            continue
+        fp = job_fingerprint( df, idx )
+        current[fp] = idx
+        if fp[5] == HILITE_USER: #F-HILITE-USER-TASKS
+            add_user_task( user_tasks, fp[0], df["state"][idx] | 8 )
+
+    churn = 0
+    jobs = st["jobs"]
+    for fp in [fp for fp in jobs if fp not in current]:
+        job = jobs.pop(fp)
+        sched_state_apply( st, job, job["s"], job["e"], -1, dirty )
+        st["dead"] += 1
+        churn += 1
+
+    for fp, idx in current.items():
+        if fp not in jobs:
+            sched_state_add( st, fp, df, idx, usage, dirty )
+            churn += 1
+    st["churn"] = churn
+
+    # выдача в том же виде что у build_hourly_schedule, строится заново только для измененных узлов,
+    # так что следующее обновление не меняет уже отрисованный снимок
+    for n in dirty:
+        rec = st["nodes"][n]
+        out = { 'schedule': raster_schedule( rec["raster"], nslots ),
+                'intervals': sorted( (row, s, e) for row, (s, e) in rec["intervals"].items() ) }
+        for key, diff in rec["diff"].items():
+            out[key] = list( accumulate( diff[:nslots] ) )
+        if 'cpuinfo' not in out:
+            out['cpuinfo'] = [0] * nslots
+        rec["out"] = out
+
+    timeinfo = grid["labels"]
+    for n, rec in st["nodes"].items():
+        g = gnodes[n]
+        g.update( rec["out"] )
+        g['timeinfo'] = timeinfo
+        g['grid'] = grid
+
+    if index is not None:
+        #F-USER-INDEX
+        tab = st["table"]
+        for fp in current:
+            job = jobs[fp]
+            spans = user_index_job( index, fp[5], fp[0], job_label(tab, job["row"]), job["sval"] )
+            if job["e"] > job["s"]:
+                spans.extend( (n, job["s"], job["e"]) for n in job["nodes"] if n in st["nodes"] )
+    return st["table"]
+
 # вставляет в массив arr через каждые k элементов элемент e
 # это нужно чтобы делать красивые колонки по k часов (тайм слотов)
 # shift = тема #F-CURHOUR-SHIFT
@@ -466,14 +1622,22 @@ def insert_every_k(arr, k, e, shift):
             
 # gnodes - список узлов { узел : {schedule: ...} }
 # печатает в текстовом режиме
-def paint_text( gnodes, user_tasks ):
+# hilite - {узел: set(слоты)} из user_index_cells, подсветить их вместо бита 8 (HILITE_USER) #F-USER-INDEX
+# user - чьи задачи подсвечены, для легенды
+# out - куда печатать, по умолчанию sys.stdout (в потоках сервера - свой StringIO, не глобальный stdout)
+@timed("paint_text")
+def paint_text( gnodes, user_tasks, hilite=None, user=None, out=None ):
+    if out is None:
+        out = sys.stdout
+    if user is None:
+        user = HILITE_USER
 
     if len(gnodes.keys()) == 0:
         return
 
     now_time = datetime.now() # todo вынести в параметр
-    start_hour_i = now_time.hour
-    #print("start hour=",start_hour_i)
+    grid = snapshot_grid( gnodes ) #F-SLOT-WIDTH
+    days = grid["days"]
     #print(f"Анализируем {len(df)} задач...") xxx
 
     # Text colors
@@ -507,21 +1671,25 @@ def paint_text( gnodes, user_tasks ):
         rec = gnodes[n]
         sch = rec['schedule']
         # колонки по часам
-        sch = insert_every_k( sch, SLOT_ITEMS, 16, start_hour_i )
+        sch = insert_breaks( sch, grid["breaks"], 16 )
         
-        jobinfo = rec['jobinfo']
-        jobinfo = insert_every_k( jobinfo, SLOT_ITEMS, [], start_hour_i )
+        # число задач по слотам #F-JOB-CNT
+        jobcnt = insert_breaks( rec['jobcnt'], grid["breaks"], 0 )
         
         txt = ''
-        slot_index = 0 # номер слота = номер позиции в расписании (с учетом insert_every_k)
+        slot_index = 0 # номер слота = номер позиции в расписании (с учетом insert_breaks)
         hour_index = -1
+        hl = hilite.get(n, ()) if hilite is not None else None
         for x in sch:
-            j = jobinfo[ slot_index ]
+            j = jobcnt[ slot_index ]
             c = '.'
+            if hl is not None and not x & 16:
+                # подсветка по индексу, бит 8 не смотрим
+                x = (x & ~8) | (8 if hour_index + 1 in hl else 0)
             if x & 4: # running
                 if SHOW_JOB_CNT:
-                    if len(j) < 10 :
-                        c = str(len(j)) # покажем число job-ов в слоте #F-JOB-CNT
+                    if j < 10 :
+                        c = str(j) # покажем число job-ов в слоте #F-JOB-CNT
                         #print("c=",c,file=sys.stderr)
                     else:
                         c = '+'
@@ -544,7 +1712,7 @@ def paint_text( gnodes, user_tasks ):
                 hour_index += 1 # это реальная колонка а не пробел - увеличим час
 
             # #F-HILITE-DAY подсветим границу суток
-            if (start_hour_i + hour_index) % 24 == 0:
+            if hour_index in days:
                #c = GREEN + c + RESET 
                c = CYAN + c + RESET 
 
@@ -580,190 +1748,289 @@ def paint_text( gnodes, user_tasks ):
             color = GREEN #CYAN #RED # недозагрузка
         else:
             color = YELLOW #CYAN #RED # RESET # пустые и так видно
-        print(color,n.rjust(max_name_len), cpu_info,  RESET, result,end=eol)
-
-    print("Легенда: Имя узла, свободно-cpu/всего-cpu, 1..9+ = число задач на узле, # = запланировано. ",end="")
-    print("Колонка - час. ", end="")
-    print(CYAN+"Голубая полоса"+RESET+" - граница суток.")
-    print("Серый - узел загружен полностью. ", end="")
-    print(YELLOW+"Жёлтый"+RESET+"/"+GREEN+"Зелёный"+RESET+" - узел загружен частично или свободен. ", end="")
-    print(RED+"Красный"+RESET+" - узел выключен.")
-    print(ON_RED+f"Красный фон"+RESET+" - задачи",HILITE_USER, end="")
+        print(color,n.rjust(max_name_len), cpu_info,  RESET, result,end=eol, file=out)
+
+    print("Легенда: Имя узла, свободно-cpu/всего-cpu, 1..9+ = число задач на узле, # = запланировано. ",end="", file=out)
+    if grid["width"] is not None:
+        print("Колонка - " + slot_width_text( grid["width"] ) + ". ", end="", file=out)
+    else:
+        #F-SLOT-WIDTH
+        print("Колонки: " + ", затем ".join( slot_width_text(w) for w, until in SLOT_TIERS ) + ". ", end="", file=out)
+    print(CYAN+"Голубая полоса"+RESET+" - граница суток.", file=out)
+    print("Серый - узел загружен полностью. ", end="", file=out)
+    print(YELLOW+"Жёлтый"+RESET+"/"+GREEN+"Зелёный"+RESET+" - узел загружен частично или свободен. ", end="", file=out)
+    print(RED+"Красный"+RESET+" - узел выключен.", file=out)
+    print(ON_RED+f"Красный фон"+RESET+" - задачи",user, end="", file=out)
     if len(user_tasks["running"]):
-        print(" работают:"," ".join(user_tasks["running"]), end="" ) 
+        print(" работают:"," ".join(user_tasks["running"]), end="" , file=out) 
     if len(user_tasks["pending"]):
-        print(" ожидают:"," ".join(user_tasks["pending"]), end="" )
+        print(" ожидают:"," ".join(user_tasks["pending"]), end="" , file=out)
     if len(user_tasks["other"]):
-        print(" неясные:"," ".join(user_tasks["other"]), end="" )
+        print(" неясные:"," ".join(user_tasks["other"]), end="" , file=out)
     #print(" см.",ON_RED,"mqinfo | grep ",HILITE_USER,RESET)
-    print(" подробности:",BOLD,"mqinfo | grep",HILITE_USER,RESET)
+    print(" подробности:",BOLD,"mqinfo | grep",user,RESET, file=out)
     #F-SHOW-USER-TASKS
-    print("Текущее время:",now_time.strftime('%d-%m-%Y %H:%M'))
+    print("Текущее время:",now_time.strftime('%d-%m-%Y %H:%M'), file=out)
     #print()
     
-# gnodes - список узлов { узел : {schedule: ...} }
-# где schedule это числовой массив
-def paint_html( gnodes ):
-
-    now_time = datetime.now() # todo вынести в параметр
-    start_hour_i = now_time.hour
-    total_users = dict() # username => 1
-    max_name_len = max([len(x) for x in gnodes.keys()]) if len(gnodes) > 0 else 10
-    counter = 0
+# одна строка узла n в html #F-STREAM-HTML
+# rec - запись узла { schedule: ..., intervals: ..., ... }
+# jobs - таблица задач, на которую ссылаются intervals #F-JOBS-TABLE
+# total_users - сюда добавляются встреченные пользователи, username => 1
+# grid - сетка слотов (см. slot_grid): разделители колонок и границы суток #F-SLOT-WIDTH
+# live - сюда отмечаются изменившиеся ячейки для живого обновления страницы, см. live_begin #F-LIVE
+def paint_html_node( n, rec, jobs, grid, total_users, live=None ):
+    import html
+    #color = RED if (n.startswith('apollo') and int(n[6:]) >= 17) or n.startswith('tesla-') else RESET
+    breaks = grid["breaks"]
+    days = grid["days"]
+    sch = rec['schedule']
+    # колонки по часам
+    sch = insert_breaks( sch, breaks, 16 )
+
+    # списки задач по слотам для подсказок #F-INTERVALS
+    jobinfo = slot_job_lists( rec, len(rec['schedule']) )
+    jobinfo = insert_breaks( jobinfo, breaks, [] )
+    # число задач по слотам, с учетом свернутых #F-AGGREGATE
+    jobcnt = insert_breaks( rec['jobcnt'], breaks, 0 )
     
-    RES = ""
-    #F-AUTO-COLS сделано через стили css grid и вложенный grid для информации по узлу
+    timeinfo = rec['timeinfo']
+    timeinfo = insert_breaks( timeinfo, breaks, "" )
+
+    # занятость процессоров
+    cpuinfo = rec['cpuinfo']
+    cpuinfo = insert_breaks( cpuinfo, breaks, "" )
+    # память и gpu, есть если собиралась детальная занятость #F-DETAILED-USAGE
+    meminfo = insert_breaks( rec['meminfo'], breaks, "" ) if 'meminfo' in rec else None
+    gpuinfo = insert_breaks( rec['gpuinfo'], breaks, "" ) if 'gpuinfo' in rec else None
     
-    for n in gnodes.keys():
-        #color = RED if (n.startswith('apollo') and int(n[6:]) >= 17) or n.startswith('tesla-') else RESET
-        rec = gnodes[n]
-        sch = rec['schedule']
-        # колонки по часам
-        sch = insert_every_k( sch, SLOT_ITEMS, 16,start_hour_i )
-
-        jobinfo = rec['jobinfo']
-        jobinfo = insert_every_k( jobinfo, SLOT_ITEMS, [],start_hour_i )
-        
-        timeinfo = rec['timeinfo']
-        timeinfo = insert_every_k( timeinfo, SLOT_ITEMS, "",start_hour_i )
-
-        # занятость процессоров
-        cpuinfo = rec['cpuinfo']
-        cpuinfo = insert_every_k( cpuinfo, SLOT_ITEMS, "",start_hour_i )
-        
-        txt = ''
-        slot_index = 0
-        hour_index = -1
-        
-        for x in sch:
-            j = jobinfo[ slot_index ]
-            c = '.'
-            cl="cell uelem"
-            if x & 4: # running
-                if SHOW_JOB_CNT:
-                    if len(j) < 10 :
-                        c = str(len(j)) # покажем число job-ов в слоте #F-JOB-CNT
-                        #print("c=",c,file=sys.stderr)
-                    else:
-                        c = '+'
+    # части строки собираются в список и склеиваются один раз
+    txt = []
+    slot_index = 0
+    hour_index = -1
+    
+    for x in sch:
+        j = jobinfo[ slot_index ]
+        c = '.'
+        cl="cell uelem"
+        if x & 4: # running
+            if SHOW_JOB_CNT:
+                if jobcnt[ slot_index ] < 10 :
+                    c = str(jobcnt[ slot_index ]) # покажем число job-ов в слоте #F-JOB-CNT
+                    #print("c=",c,file=sys.stderr)
                 else:
-                    c = 'R'
-                cl += " running"
-            elif x & 2: # pending
-                c = '#'
-                cl += " pending"
-            elif x & 1: #other
-                c = '?'
+                    c = '+'
             else:
-                cl += " free"
-                
-            if x & 8: # hilite user
-               #c = ON_BLUE + c + RESET
-               #print("x=",x)
-               cl += " user"
-               pass
-               
-            if x & 16: # колонка по часам
-               #c = '&nbsp;'
-               c = ''
-               cl += " timeslot"
-            else:
-                hour_index += 1 # это реальная колонка а не пробел - увеличим час
-
-            # #F-HILITE-DAY подсветим границу суток
-            if (start_hour_i + hour_index) % 24 == 0:
-               cl += " hilite_day"
-
-            #if (start_hour_i + slot_index) % 24 == 0:
-            #   c = GREEN + c + RESET    
-
-            # jobinfo - выведем подробную информацию
-
-            #print(j)
-            title = ""
-
-            t = timeinfo[ slot_index ]
-            title += html.escape(t) + "&#10;"
-
-            for item in j:
-                user = item[0]
-                jobid = item[1]
-                # Экранируем данные для использования в CSS классах (только буквы, цифры, дефис, подчеркивание)
-                user_safe = re.sub(r'[^a-zA-Z0-9_-]', '_', user)
-                jobid_safe = re.sub(r'[^a-zA-Z0-9_-]', '_', str(jobid))
-                cl += ' user_' + user_safe
-                #F-TOOLTIP
-                title += html.escape(user) + ":" + html.escape(str(jobid)) + "&#10;"
-                total_users[user] = 1
-                #F-HILITE-USERJOB
-                cl += ' job_' + jobid_safe
-
-            if DETAILED_USAGE:
-                cc = cpuinfo[ slot_index ]
-                title += "cpus: " + html.escape(str(cc))
-
-            txt += "<div class='" + html.escape(cl) + "' title='" + title + "'>" + html.escape(c) + "</div>\n"
-            slot_index += 1
+                c = 'R'
+            cl += " running"
+        elif x & 2: # pending
+            c = '#'
+            cl += " pending"
+        elif x & 1: #other
+            c = '?'
+        else:
+            cl += " free"
             
-        #print(len(txt))
-        
-        #mapping = {4: 'R', 0: '_', 2: '=', 1: '?'}
-        #mapping = {4: '@', 0: '.', 2: '#', 1: '?'}
-        #mapping = {4: 'R', 0: '.', 2: '#', 1: '?'}
-        #result = ''.join([mapping[x] for x in sch])
-        result = txt
-        
-        # разделяем на колонки по часам
-        #result = re.sub(r'(.{6})', r'\1 ', result).strip()
-        
-        # разделяем на колонки по хостам
-        #eol = '\n' if counter % COLUMNS == (COLUMNS-1) else ' '
-
-        #print(n.rjust(max_name_len), result,end=eol)
-        
-        #n = n + " " + str(rec['cpus_free'])        
-        
-        cpu_info = (str(rec['cpus_free']) + "/" + str(rec['cpus_total']) ).rjust(5) # idle / total
-
-        #F-NODE-NONBUSY-HILITE
-        node_usage_class = "nodenonbusy"
-        if rec['state'] == "down*":
-            node_usage_class = "nodedown"
-        elif rec['cpus_free'] == 0:
-            node_usage_class = "nodebusy"
-        elif rec['cpus_free'] == rec["cpus_total"]:
-            node_usage_class = "nodefree"
-        elif rec['cpus_free'] < rec["cpus_total"]/3:
-            #F-NONBUSY-PARTIAL все что меньше трети делаем не такое яркое
-            node_usage_class = "nodebusy60"
+        if x & 8: # hilite user
+           #c = ON_BLUE + c + RESET
+           #print("x=",x)
+           cl += " user"
+           pass
+           
+        if x & 16: # колонка по часам
+           #c = '&nbsp;'
+           c = ''
+           cl += " timeslot"
         else:
-            node_usage_class = "nodebusy30"
-
-        #print(color,n.rjust(max_name_len), cpu_info,  RESET, result,end=eol)
-        #if counter % COLUMNS == 0:
-        #    print(ROW_BEGIN)
-        #print("<div class='node'><div class='nodename'>",n,"</div><div class='cpuinfo'>",cpu_info,"</div>",result,"</div>")
-        RES += "<div class='node'><div class='nodename'>" + html.escape(n) + "</div><div class='cpuinfo " + html.escape(node_usage_class) + "'>" + html.escape(cpu_info) + "</div>" + result + "</div>"
-        #if counter % COLUMNS == COLUMNS-1:
-    #        print("</tr>")
-        counter += 1        
+            hour_index += 1 # это реальная колонка а не пробел - увеличим час
+
+        # #F-HILITE-DAY подсветим границу суток
+        if hour_index in days:
+           cl += " hilite_day"
+
+        # jobinfo - выведем подробную информацию
+
+        #print(j)
+        title = []
+
+        t = timeinfo[ slot_index ]
+        title.append( html.escape(t) + "&#10;" )
+
+        for item in j:
+            user = job_label( jobs, item )
+            jobid = job_id_str( jobs, item )
+            # Экранируем данные для использования в CSS классах (только буквы, цифры, дефис, подчеркивание)
+            user_safe = re.sub(r'[^a-zA-Z0-9_-]', '_', user)
+            jobid_safe = re.sub(r'[^a-zA-Z0-9_-]', '_', str(jobid))
+            cl += ' user_' + user_safe
+            #F-TOOLTIP
+            title.append( html.escape(user) + ":" + html.escape(str(jobid)) + job_count_text(jobs, item) + "&#10;" )
+            total_users[user] = 1
+            #F-HILITE-USERJOB
+            cl += ' job_' + jobid_safe
+
+        if DETAILED_USAGE:
+            cc = cpuinfo[ slot_index ]
+            title.append( "cpus: " + html.escape(str(cc)) )
+            if meminfo is not None and meminfo[ slot_index ]:
+                title.append( "&#10;mem: " + html.escape(str(meminfo[ slot_index ])) + " MB" )
+            if gpuinfo is not None and gpuinfo[ slot_index ]:
+                title.append( "&#10;gpus: " + html.escape(str(gpuinfo[ slot_index ])) )
+
+        txt.append( "<div class='" + html.escape(cl) + "' title='" + "".join(title) + "'>" + html.escape(c) + "</div>\n" )
+        slot_index += 1
         
+    result = "".join(txt)
+    
+    cpu_info = (str(rec['cpus_free']) + "/" + str(rec['cpus_total']) ).rjust(5) # idle / total
+    head = "<div class='cpuinfo " + html.escape(node_usage_class(rec)) + "'>" + html.escape(cpu_info) + "</div>"
+    if live is not None:
+        live_node_cells( live, n, head, txt ) #F-LIVE
+
+    #print("<div class='node'><div class='nodename'>",n,"</div><div class='cpuinfo'>",cpu_info,"</div>",result,"</div>")
+    return "<div class='node'><div class='nodename'>" + html.escape(n) + "</div>" + head + result + "</div>"
+
+#F-NODE-NONBUSY-HILITE
+def node_usage_class( rec ):
+    if rec['state'] == "down*":
+        return "nodedown"
+    elif rec['cpus_free'] == 0:
+        return "nodebusy"
+    elif rec['cpus_free'] == rec["cpus_total"]:
+        return "nodefree"
+    elif rec['cpus_free'] < rec["cpus_total"]/3:
+        #F-NONBUSY-PARTIAL все что меньше трети делаем не такое яркое
+        return "nodebusy60"
+    return "nodebusy30"
 
-    USERS = ""
+# gnodes - список узлов { узел : {schedule: ...} }
+# где schedule это числовой массив
+# генератор строк узлов, по одной за раз #F-STREAM-HTML
+def paint_html_rows( gnodes, jobs, total_users, live=None ):
+    grid = snapshot_grid( gnodes ) #F-SLOT-WIDTH
+    #F-AUTO-COLS сделано через стили css grid и вложенный grid для информации по узлу
+    for n in gnodes.keys():
+        yield paint_html_node( n, gnodes[n], jobs, grid, total_users, live )
+
+# список пользователей #F-USERS
+def paint_html_users( total_users ):
+    import html
+    USERS = []
     total_users[" "] = 1
     for name in sorted( list(total_users.keys()) ):
         # Экранируем имя для CSS класса
         name_safe = re.sub(r'[^a-zA-Z0-9_-]', '_', name)
-        t = "<div class='userinfo uelem user_" + name_safe + "'>" + html.escape(name) + "</div>\n"
-        USERS += t
-    
-    #F-CURTIME
-    now_time_s = datetime.now().strftime('%d-%m-%Y %H:%M')    
-
-    return [RES, USERS, now_time_s]
-
-# загрузить шаблон, завернуть в него строку block[0], напечатать на экран
-def use_template( block ):
+        USERS.append( "<div class='userinfo uelem user_" + name_safe + "'>" + html.escape(name) + "</div>\n" )
+    return "".join(USERS)
+
+# компактная таблица: расписание узлов в JSON с RLE по слотам #F-COMPACT-HTML
+# {slots, seps, days, job_cnt, times: [метки слотов],
+#  labels: [подписи], jobs: [[номер подписи, jobid, число задач если больше 1]],
+#  nodes: [[имя, "свободно/всего", класс загрузки, runs, spans, детали или 0]]}
+# runs - [длина, биты schedule, длина, биты, ...], одинаковые соседние слоты сливаются
+# spans - [номер в jobs, первый слот, слот после последнего, ...] - задачи узла интервалами
+# seps - число разделителей колонок перед слотом, days - слоты начала суток (см. slot_grid) #F-SLOT-WIDTH
+def compact_payload( gnodes, jobs, total_users ):
+    labels = []
+    label_ids = {}
+    cjobs = []
+    job_ids = {}     # строка таблицы jobs -> номер в cjobs
+    nodes = []
+    nslots = 0
+    times = []
+    for n, rec in gnodes.items():
+        sch = rec['schedule']
+        nslots = len(sch)
+        times = rec['timeinfo']
+        runs = []
+        for k in range(nslots):
+            if runs and runs[-1] == sch[k]:
+                runs[-2] += 1
+            else:
+                runs += [1, sch[k]]
+        # интервалы узла и есть spans #F-INTERVALS
+        # задачи нумеруются в порядке появления по слотам, spans идут по слоту окончания
+        ivs = rec['intervals']
+        for row, s, e in sorted( ivs, key=lambda x: (x[1], x[0]) ):
+            if row not in job_ids:
+                user = job_label( jobs, row )
+                total_users[user] = 1
+                u = label_ids.get( user )
+                if u is None:
+                    u = label_ids[user] = len(labels)
+                    labels.append( user )
+                job_ids[row] = len(cjobs)
+                cjobs.append( [u, job_id_str( jobs, row )] )
+                if jobs["count"][row] > 1:
+                    #F-AGGREGATE
+                    cjobs[-1].append( jobs["count"][row] )
+        spans = []
+        for row, s, e in sorted( ivs, key=lambda x: (x[2], x[1], x[0]) ):
+            spans += [job_ids[row], s, e]
+        details = 0
+        if DETAILED_USAGE:
+            details = [ rec['cpuinfo'], rec.get('meminfo', 0), rec.get('gpuinfo', 0) ]
+        nodes.append( [ n, str(rec['cpus_free']) + "/" + str(rec['cpus_total']), node_usage_class( rec ), runs, spans, details ] )
+    grid = snapshot_grid( gnodes )
+    return {
+        "slots": nslots,
+        "seps": grid["seps"],
+        "days": sorted( grid["days"] ),
+        "job_cnt": SHOW_JOB_CNT,
+        "times": times,
+        "labels": labels,
+        "jobs": cjobs,
+        "nodes": nodes,
+    }
+
+# вставка данных компактной таблицы в страницу, сетку строит buildCompact() из шаблона
+# live - см. paint_html_node #F-LIVE
+def paint_compact_table( gnodes, jobs, total_users, live=None ):
+    import json
+    payload = compact_payload( gnodes, jobs, total_users )
+    if live is not None:
+        live_compact_nodes( live, payload ) #F-LIVE
+    data = json.dumps( payload, ensure_ascii=False, separators=(',', ':') )
+    # чтобы строки данных не закрыли тег script
+    data = data.replace( '</', '<\\/' )
+    return "<script>var MQVIS_DATA=" + data + ";</script>\n"
+
+# индекс подсветки для страницы #F-USER-INDEX
+# MQVIS_INDEX = {seps, users: {подпись: [узел, s, e, ...]}, jobs: {jobid: [узел, s, e, ...]}}
+# seps - число разделителей колонок перед слотом (см. slot_grid)
+# узел - номер строки .node в таблице, скрипт шаблона находит ячейки по номеру слота
+def paint_html_index( gnodes, index ):
+    import json
+    users, jobs = html_index_spans( gnodes, index )
+    data = json.dumps( { "seps": snapshot_grid( gnodes )["seps"], "users": users, "jobs": jobs },
+                       ensure_ascii=False, separators=(',', ':') )
+    # чтобы строки данных не закрыли тег script
+    data = data.replace( '</', '<\\/' )
+    return "<script>var MQVIS_INDEX=" + data + ";</script>\n"
+
+# users и jobs для MQVIS_INDEX; only - только интервалы на этих узлах (живое обновление #F-LIVE)
+def html_index_spans( gnodes, index, only=None ):
+    node_ids = { n: i for i, n in enumerate(gnodes.keys()) }
+    users = defaultdict(list)
+    jobs = {}
+    for user, user_jobs in index.items():
+        for jobid, job in user_jobs.items():
+            spans = []
+            for n, s, e in job["spans"]:
+                if only is None or n in only:
+                    spans += [node_ids[n], s, e]
+            if spans:
+                users[ job["label"] ] += spans
+                jobs[ jobid ] = spans
+    return users, jobs
+
+# места подстановки в шаблоне
+TEMPLATE_SLOTS = ('PUT_TABLE', 'PUT_USERS', 'PUT_TIME')
+
+# путь не меняется за время работы, проверяется один раз #F-TEMPLATE-CACHE
+@lru_cache(maxsize=1)
+def template_path():
+    from pathlib import Path
     # вариант чтения из файла
     script_dir = Path(__file__).resolve().parent
 
@@ -781,37 +2048,1318 @@ def use_template( block ):
 
     if not tpl_path.exists():
         sys.exit(f'Error: template not found: {tpl_path}')
+    return tpl_path
+
+# разобранный шаблон #F-TEMPLATE-CACHE
+# (assets) -> {key: (mtime, размер файла), parts: [статика, слот, ..., статика],
+#              static: статика в utf-8, slots: слоты, assets: {адрес: ресурс}}
+# файл перечитывается только если изменился, в режиме сервера шаблон разбирается один раз
+TEMPLATE_CACHE = {}
+
+# <style>...</style> и <script>...</script> без атрибутов
+TEMPLATE_ASSET_RE = r'<(style|script)>(.*?)</\1>'
+
+# вынести css и js шаблона в отдельные ресурсы /static/<хеш>.css|js
+# блоки с местами подстановки остаются в странице
+# output: (текст со ссылками вместо блоков, {адрес: ресурс})
+# ресурс устроен как снимок для encoded_body: {body, etag_body, ctype}
+def extract_assets( text ):
+    import hashlib
+    assets = {}
+    def replace( m ):
+        tag, body = m.group(1), m.group(2)
+        if any( slot in body for slot in TEMPLATE_SLOTS ):
+            return m.group(0)
+        data = body.encode('utf-8')
+        h = hashlib.sha1( data ).hexdigest()[:16]
+        ext, ctype = ("css", "text/css") if tag == "style" else ("js", "application/javascript")
+        url = f"static/{h}.{ext}"
+        assets["/" + url] = { "body": data, "etag_body": '"' + h + '"', "ctype": ctype + "; charset=utf-8" }
+        if tag == "style":
+            return f"<link rel='stylesheet' href='{url}'>"
+        return f"<script src='{url}'></script>"
+    text = re.sub( TEMPLATE_ASSET_RE, replace, text, flags=re.S )
+    return text, assets
+
+# шаблон, разрезанный по местам подстановки, из кеша #F-TEMPLATE-CACHE
+# assets - вынести css/js в отдельные ресурсы (режим сервера, STATIC_ASSETS=1)
+def load_template( assets=False ):
+    path = template_path()
+    st = path.stat()
+    key = ( st.st_mtime_ns, st.st_size )
+    t = TEMPLATE_CACHE.get( assets )
+    if t is None or t["key"] != key:
+        text = path.read_text(encoding='utf-8')
+        found = {}
+        if assets:
+            text, found = extract_assets( text )
+        parts = re.split( '(' + '|'.join(TEMPLATE_SLOTS) + ')', text )
+        t = { "key": key, "static": [ x.encode('utf-8') for x in parts[0::2] ],
+              "slots": parts[1::2], "assets": found }
+        TEMPLATE_CACHE[assets] = t
+    return t
+
+# страница кусками в utf-8: статика шаблона, строки узлов по одной, список пользователей #F-STREAM-HTML
+# в памяти одновременно только одна строка узла, а не вся страница
+# статика берется уже закодированной из кеша шаблона, кодируются только данные #F-TEMPLATE-CACHE
+# index - индекс подсветки, встраивается в страницу после таблицы #F-USER-INDEX
+# assets - css/js шаблона ссылками на /static (режим сервера)
+# live - живое обновление страницы (режим сервера): вместо перезагрузки по meta refresh страница
+# получает изменения ячеек по /events, см. live_begin #F-LIVE
+def stream_html( gnodes, jobs, index=None, assets=False, live=None ):
+    tpl = load_template( assets )
+    static = tpl["static"]
+    slots = tpl["slots"]
+    if live is not None:
+        static = [ re.sub( LIVE_META_REFRESH_RE, b"", x ) for x in static ]
+    total_users = dict() # username => 1
+    if HTML_MODE == "compact":
+        #F-COMPACT-HTML
+        rows = iter( [ paint_compact_table( gnodes, jobs, total_users, live ) ] )
+    else:
+        rows = paint_html_rows( gnodes, jobs, total_users, live )
+    table = None
+    if slots.count('PUT_TABLE') > 1 or ('PUT_USERS' in slots and 'PUT_TABLE' in slots
+                                         and slots.index('PUT_USERS') < slots.index('PUT_TABLE')):
+        # таблицу нужно выдать несколько раз или пользователи идут раньше нее - собираем заранее
+        table = "".join( rows )
 
-    result = tpl_path.read_text(encoding='utf-8')
+    #F-CURTIME
+    now_time_s = datetime.now().strftime('%d-%m-%Y %H:%M')    
+    if live is not None:
+        live["time"] = now_time_s
+
+    users = None
+    size = 0
+    for i, p in enumerate(slots):
+        size += len( static[i] )
+        yield static[i]
+        if p == 'PUT_TIME':
+            chunks = [ now_time_s ]
+        elif p == 'PUT_TABLE':
+            chunks = rows if table is None else [ table ]
+        elif p == 'PUT_USERS':
+            if users is None:
+                if table is None:
+                    # строки узлов больше не нужны, но пользователей надо собрать
+                    for r in rows:
+                        pass
+                users = paint_html_users( total_users )
+                if live is not None:
+                    live["users"] = users
+            chunks = [ users ]
+        for c in chunks:
+            data = c.encode('utf-8')
+            size += len(data)
+            yield data
+        if p == 'PUT_TABLE' and index is not None and HTML_MODE != "compact":
+            # в компактном режиме подсветка идет по интервалам из MQVIS_DATA
+            data = paint_html_index( gnodes, index ).encode('utf-8')
+            size += len(data)
+            yield data
+        if p == 'PUT_TABLE' and live is not None:
+            # номер снимка, с которого страница ждет изменения #F-LIVE
+            data = f"<script>var MQVIS_LIVE={{\"version\":{live['version']}}};</script>\n".encode('utf-8')
+            size += len(data)
+            yield data
+    size += len( static[-1] )
+    yield static[-1]
+    metric_set( "html_bytes", size ) #F-PROFILE
+
+# напечатать страницу на экран по мере отрисовки
+@timed("use_template")
+def use_template_stream( gnodes, jobs, index=None ):
+    out = sys.stdout.buffer
+    out.writelines( stream_html( gnodes, jobs, index ) )
+    out.flush()
 
-    # заменить все вхождения PLACEHOLDER (для замены только первого: .replace('PLACEHOLDER', block, 1))
-    result = result.replace('PUT_TABLE', block[0])
-    result = result.replace('PUT_USERS', block[1])
-    result = result.replace('PUT_TIME', block[2])
+###########################################
 
-    # вывести в stdout в UTF-8
-    sys.stdout.buffer.write(result.encode('utf-8'))
+# объединить ответы кластеров в одно пространство имен "кластер:узел", "кластер:задача" #F-MULTI-CLUSTER
+# futures - [(кластер, sinfo, squeue, scontrol или None)]; у каждого кластера свои таймауты команд,
+# недоступный кластер дает пустые ответы (функции сбора ловят ошибки) и просто пропадает со страницы
+# output: (nodes_dict, таблица задач, usage или None)
+def merge_clusters( futures, now ):
+    nodes_dict = {}
+    df = new_jobs_table( now )
+    usage = {} if DETAILED_USAGE else None
+    for c, f_nodes, f_jobs, f_usage in futures:
+        prefix = c["name"] + ":"
+        for n, rec in f_nodes.result().items():
+            nodes_dict[ prefix + n ] = rec
+        jt = jobs_table_namespace( f_jobs.result(), prefix )
+        for i in range( jobs_count(jt) ):
+            jobs_table_append_row( df, jt, i )
+        if f_usage is not None:
+            for jobid, per_node in f_usage.result().items():
+                usage[ prefix + jobid ] = { prefix + n: u for n, u in per_node.items() }
+    return nodes_dict, df, usage
+
+# опросить slurm: sinfo, squeue и (DETAILED=1) scontrol
+# output: (nodes_dict, таблица задач, usage или None)
+def collect_slurm( now ):
+    from concurrent.futures import ThreadPoolExecutor
+    # sinfo, squeue и scontrol работают одновременно, время сбора ~ самая долгая из команд #F-PARALLEL-COLLECT
+    # с CLUSTERS - все команды всех кластеров сразу #F-MULTI-CLUSTER
+    clusters = CLUSTERS or [None]
+    with ThreadPoolExecutor( max_workers=3*len(clusters) ) as pool:
+        futures = []
+        for c in clusters:
+            f_nodes = pool.submit( simple_sinfo_dict, c )
+            f_jobs = pool.submit( get_jobs_dataframe, now, c )
+            # детальная занятость - один вызов scontrol на все задачи #F-DETAILED-USAGE
+            f_usage = pool.submit( gather_for_jobids, None, c ) if DETAILED_USAGE else None
+            futures.append( (c, f_nodes, f_jobs, f_usage) )
+        if CLUSTERS:
+            nodes_dict, df, usage = merge_clusters( futures, now )
+        else:
+            c, f_nodes, f_jobs, f_usage = futures[0]
+            nodes_dict = f_nodes.result()
+            df = f_jobs.result()
+            usage = f_usage.result() if f_usage is not None else None
+    #fdf = df.loc[df['STATE'] == 'RUNNING']
+    #print(fdf)
+    return nodes_dict, df, usage
+
+################ общий кеш ответов slurm для cgi #F-CGI-CACHE
+# когда страницу одновременно обновляют много браузеров, каждый запуск mqvis.py через cgi
+# вызывал бы свои sinfo и squeue. вместо этого ответы slurm (узлы, таблица задач, usage)
+# хранятся в файле CACHE_FILE:
+# - кеш моложе CACHE_TTL - берется как есть;
+# - старше, но моложе CACHE_MAX_STALE - отдается сразу, а один запуск (взявший блокировку)
+#   обновляет кеш в фоновом процессе, остальные его не ждут;
+# - кеша нет или он слишком старый - запуски ждут блокировку, опрашивает slurm только первый.
+# так slurm опрашивается не чаще раза в CACHE_TTL, сколько бы ни было зрителей.
+# расписание строится уже из кеша, поэтому подсветка USER у каждого запуска своя.
+# настройки, от которых зависят сами ответы slurm (DETAILED, CLUSTERS, SQUEUE_MODE, SLURM_CONF ...),
+# входят в имя файла: CACHE_FILE.<хеш настроек>, запуски с разными настройками не отдают чужой кеш
+# файл: CACHE_MAGIC, zlib( длина json, json {time, now, key, nodes, usage, strings}, массивы таблицы задач )
+# пишется во временный файл и подменяется через os.replace, читатели видят только целый файл
+
+CACHE_MAGIC = b"MQC3"
+CACHE_COLUMNS = ("jobid", "user", "name", "nodes", "state", "start", "end", "cpus", "count")
+
+# ключ кеша: хеш настроек, меняющих ответы slurm
+@lru_cache(maxsize=1)
+def cache_key():
+    import json
+    import hashlib
+    conf = { "detailed": DETAILED_USAGE, "clusters": CLUSTERS, "squeue_mode": SQUEUE_MODE,
+             "squeue_fields": SQUEUE_FIELDS, "slurm_conf": os.environ.get("SLURM_CONF",""),
+             "slurm_clusters": os.environ.get("SLURM_CLUSTERS","") }
+    return hashlib.sha1( json.dumps( conf, sort_keys=True ).encode('utf-8') ).hexdigest()[:12]
+
+# файл кеша для текущих настроек
+def cache_path( path ):
+    return path + "." + cache_key()
+
+def cache_encode( nodes_dict, df, usage ):
+    import json
+    import struct
+    import zlib
+    meta = { "time": time.time(), "now": df["now"].isoformat(), "key": cache_key(), "nodes": nodes_dict,
+             "usage": usage, "strings": df["strings"], "rows": jobs_count(df) }
+    meta_b = json.dumps( meta, ensure_ascii=False, separators=(',', ':') ).encode('utf-8')
+    arrays = b"".join( df[col].tobytes() for col in CACHE_COLUMNS )
+    return CACHE_MAGIC + zlib.compress( struct.pack('<I', len(meta_b)) + meta_b + arrays, 6 )
+
+# output: (время записи epoch, (nodes_dict, таблица задач, usage))
+def cache_decode( data ):
+    import json
+    import struct
+    import zlib
+    if data[:4] != CACHE_MAGIC:
+        raise ValueError( "не файл кеша mqvis" )
+    raw = zlib.decompress( data[4:] )
+    mlen = struct.unpack_from('<I', raw)[0]
+    meta = json.loads( raw[4:4+mlen].decode('utf-8') )
+    if meta.get("key") != cache_key():
+        raise ValueError( "кеш записан с другими настройками" )
+    df = new_jobs_table( datetime.fromisoformat( meta["now"] ) )
+    df["strings"] = meta["strings"]
+    df["string_ids"] = { x: i for i, x in enumerate( meta["strings"] ) }
+    pos = 4 + mlen
+    for col in CACHE_COLUMNS:
+        a = df[col]
+        size = a.itemsize * meta["rows"]
+        a.frombytes( raw[pos:pos+size] )
+        pos += size
+    return meta["time"], ( meta["nodes"], df, meta["usage"] )
+
+# None если кеша нет или он испорчен
+def cache_read( path ):
+    try:
+        with open( path, "rb" ) as f:
+            return cache_decode( f.read() )
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        print(f"Ошибка чтения кеша {path}: {e}", file=sys.stderr)
+        return None
+
+def cache_write( path, raw ):
+    data = cache_encode( *raw )
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open( tmp, "wb" ) as f:
+        f.write( data )
+    os.replace( tmp, path )
+
+# опросить slurm и записать кеш; raw кодируется до построения расписания, которое меняет узлы
+def cache_refresh( path ):
+    raw = collect_slurm( datetime.now() )
+    cache_write( path, raw )
+    return raw
+
+# обновить кеш в отдельном процессе, этот запуск сразу отдает страницу из старого кеша.
+# блокировка lock уже взята, дочерний процесс держит ее (общий открытый файл) до конца обновления
+def cache_refresh_background( path ):
+    if not hasattr( os, "fork" ):
+        cache_refresh( path )
+        return
+    sys.stdout.flush()
+    if os.fork() != 0:
+        return
+    # дочерний процесс: отцепиться от cgi, чтобы веб-сервер не ждал его вывода
+    try:
+        os.setsid()
+        devnull = os.open( os.devnull, os.O_RDWR )
+        for fd in (0, 1, 2):
+            os.dup2( devnull, fd )
+        cache_refresh( path )
+    except Exception:
+        pass
+    os._exit(0)
+
+# ответы slurm из кеша path, см. выше
+# output: (nodes_dict, таблица задач, usage или None)
+def cached_collect( path ):
+    import fcntl
+    cached = cache_read( path )
+    if cached is not None and time.time() - cached[0] < CACHE_TTL:
+        return cached[1]
+    with open( path + ".lock", "a" ) as lock:
+        if cached is not None and time.time() - cached[0] < CACHE_MAX_STALE:
+            try:
+                fcntl.flock( lock, fcntl.LOCK_EX | fcntl.LOCK_NB )
+            except OSError:
+                # кеш уже обновляет другой запуск
+                return cached[1]
+            cache_refresh_background( path )
+            return cached[1]
+        fcntl.flock( lock, fcntl.LOCK_EX )
+        # пока ждали, кеш мог обновить другой запуск
+        cached = cache_read( path )
+        if cached is not None and time.time() - cached[0] < CACHE_TTL:
+            return cached[1]
+        return cache_refresh( path )
 
 ###########################################
 
-# Использование
-nodes_dict = simple_sinfo_dict()
+# собрать снимок: опросить slurm и построить расписание
+# output: словарь {nodes: nodes_dict, jobs: df, user_tasks: ..., time: datetime}
+# state - состояние инкрементального расписания (режим сервера), None - строить с нуля #F-INCREMENTAL
+def collect_snapshot( state=None ):
+    if state is None and CACHE_FILE:
+        # запуск через cgi: ответы slurm из общего кеша #F-CGI-CACHE
+        nodes_dict, df, usage = cached_collect( cache_path( CACHE_FILE ) )
+    else:
+        nodes_dict, df, usage = collect_slurm( datetime.now() )
 
-df= get_jobs_dataframe()
-#fdf = df.loc[df['STATE'] == 'RUNNING']
-#print(fdf)
+    if AGGREGATE:
+        #F-AGGREGATE
+        df = aggregate_jobs( df, usage )
 
-user_tasks={"running":[],"other":[],"pending":[]}
-build_hourly_schedule(df, nodes_dict, user_tasks)
-# nodes_dict после build_hourly_schedule содержит {node: {schedule:..., jobinfo: ..., timeinfo: ... }}
-# где schedule это массив с битовыми масками, jobinfo список пользователей и задач, timeinfo время
+    user_tasks={"running":[],"other":[],"pending":[]}
+    index = {} #F-USER-INDEX
+    if state is not None:
+        # intervals ссылаются на таблицу задач состояния, а не на df
+        df = incremental_schedule(state, df, nodes_dict, user_tasks, usage, index)
+    else:
+        build_hourly_schedule(df, nodes_dict, user_tasks, usage, index)
+    # nodes_dict после build_hourly_schedule содержит {node: {schedule:..., intervals: ..., timeinfo: ... }}
+    # где schedule это массив с битовыми масками, intervals задачи узла интервалами слотов, timeinfo время
+
+    #F-PROFILE
+    metric_set( "jobs", sum( df["count"] ) )
+    metric_set( "job_rows", jobs_count(df) ) #F-AGGREGATE
+    metric_set( "nodes", len(nodes_dict) )
+    metric_set( "node_job_intervals", sum( len( rec.get('intervals', ()) ) for rec in nodes_dict.values() ) )
+    metric_set( "indexed_users", len(index) )
+
+    #print(json.dumps(nodes_dict, indent=2, ensure_ascii=False))
+    return { "nodes": nodes_dict, "jobs": df, "user_tasks": user_tasks, "index": index, "time": datetime.now() }
+
+# текстовая таблица снимка в виде строки
+# user, jobid - подсветить задачи другого пользователя (или одну задачу) по индексу снимка #F-USER-INDEX
+def render_text( snap, user=None, jobid=None ):
+    import io
+    buf = io.StringIO()
+    if user is None:
+        paint_text( snap["nodes"], snap["user_tasks"], out=buf )
+    else:
+        paint_text( snap["nodes"], user_index_tasks( snap["index"], user ),
+                    user_index_cells( snap["index"], user, jobid ), user, buf )
+    return buf.getvalue()
+
+@timed("render_html")
+def render_html( snap, assets=False, live=None ):
+    return b"".join( stream_html( snap["nodes"], snap["jobs"], snap.get("index"), assets, live ) )
+
+# снимок для других программ (FORMAT=json, /api/snapshot) #F-JSON-API
+# {time, slots: [метки слотов], edges: [границы слотов epoch, на 1 больше слотов], bits: {...}, user, user_tasks,
+#  jobs: [{jobid, user, name, state, start, end, count}],
+#  nodes: {узел: {cpus, cpus_free, cpus_total, state, partitions, schedule: [биты по слотам],
+#                 jobs: [[номера в jobs] по слотам], cpuinfo/meminfo/gpuinfo если DETAILED}}}
+# в jobs только задачи, которые есть в расписании; start/end - epoch сек или null
+# count - число задач в строке, у свернутых массивов jobid вида 12345_[1-500] #F-AGGREGATE
+JSON_STATES = {4: "running", 2: "pending", 1: "other"}
+
+def snapshot_json( snap ):
+    jt = snap["jobs"]
+    strings = jt["strings"]
+    jobs = []
+    job_ids = {}  # строка таблицы -> номер в jobs
+    nodes = {}
+    slots = []
+    for n, rec in snap["nodes"].items():
+        slots = rec['timeinfo']
+        per_slot = []
+        for slot_jobs in slot_job_lists( rec, len(rec['schedule']) ): #F-INTERVALS
+            ids = []
+            for row in slot_jobs:
+                j = job_ids.get( row )
+                if j is None:
+                    j = job_ids[row] = len(jobs)
+                    jobs.append( {
+                        "jobid": strings[ jt["jobid"][row] ],
+                        "user": strings[ jt["user"][row] ],
+                        "name": strings[ jt["name"][row] ],
+                        "state": JSON_STATES.get( jt["state"][row], "other" ),
+                        "start": None if jt["start"][row] == NO_TIME else jt["start"][row],
+                        "end": None if jt["end"][row] == NO_TIME else jt["end"][row],
+                        "count": jt["count"][row], #F-AGGREGATE
+                    } )
+                ids.append( j )
+            per_slot.append( ids )
+        node = {
+            "cpus": rec['cpus'],
+            "cpus_free": rec['cpus_free'],
+            "cpus_total": rec['cpus_total'],
+            "state": rec['state'],
+            "partitions": rec['partitions'],
+            "schedule": list( rec['schedule'] ),
+            "jobs": per_slot,
+        }
+        for key in ("cpuinfo", "meminfo", "gpuinfo"):
+            if DETAILED_USAGE and key in rec:
+                node[key] = list( rec[key] )
+        nodes[n] = node
+    return {
+        "time": snap["time"].isoformat( timespec='seconds' ),
+        "slots": slots,
+        "edges": snapshot_grid( snap["nodes"] )["edges"], #F-SLOT-WIDTH
+        "bits": {"other": 1, "pending": 2, "running": 4, "user": 8},
+        "user": HILITE_USER,
+        "user_tasks": snap["user_tasks"],
+        "jobs": jobs,
+        "nodes": nodes,
+    }
+
+# JSON в байтах, orjson если установлен (быстрее в разы), иначе стандартный json
+@timed("render_json")
+def render_json( snap ):
+    import json
+    doc = snapshot_json( snap )
+    try:
+        import orjson
+        return orjson.dumps( doc )
+    except ImportError:
+        return json.dumps( doc, ensure_ascii=False, separators=(',', ':') ).encode('utf-8')
+
+################ свободные cpu и поиск места под задачу #F-FIT
+# по каждому узлу из выделенных задачам cpu (cpualloc, см. job_node_cpus) и числа cpu узла
+# получается шкала свободных cpu по слотам. она хранится отрезками постоянного значения:
+# их на узле единицы, поэтому запрос FIT=64cpu:12h обходит не узлы*слоты, а только отрезки.
+# для каждого узла находятся интервалы, где свободно не меньше нужного, и из них - слоты,
+# с которых задача помещается на всю длительность (конец задачи ищется по границам сетки);
+# интервалы всех узлов складываются разностным массивом, его префиксные суммы дают
+# число подходящих узлов по слотам, первый слот с нужным числом узлов и есть ответ.
+# за окном расписания узлы считаются свободными.
+
+# состояния sinfo %t, в которых на узел ничего не запустится (суффиксы *~#... отбрасываются)
+FIT_UNAVAILABLE = { "down", "drain", "drng", "fail", "failg", "maint", "unk", "futr", "inval", "resv" }
+
+FIT_RE = r'^(?:(\d+)x)?(\d+)(?:cpu)?:(\d+[mhd])$'
+
+# "2x32cpu:12h" -> (cpu на узел, длительность сек, число узлов); ValueError при ошибке
+def parse_fit( spec ):
+    m = re.match( FIT_RE, spec.strip().lower() )
+    if m is None:
+        raise ValueError( f"bad FIT spec {spec!r}, expected [Nx]Ccpu:duration, e.g. 2x32cpu:12h" )
+    count = int( m.group(1) ) if m.group(1) else 1
+    cpus = int( m.group(2) )
+    if count < 1 or cpus < 1:
+        raise ValueError( f"bad FIT spec {spec!r}: zero cpus or nodes" )
+    return cpus, parse_duration( m.group(3) ), count
+
+def node_available( rec ):
+    return rec['state'].rstrip("*~#!%$@^-+") not in FIT_UNAVAILABLE
+
+# свободные cpu узла rec по слотам; в текущем слоте - не больше, чем сейчас сообщает sinfo
+def free_timeline( rec ):
+    alloc = rec.get('cpualloc') or [0] * len( rec['schedule'] )
+    if not node_available( rec ):
+        return [0] * len( alloc )
+    total = rec['cpus_total']
+    free = [ max(0, total - a) for a in alloc ]
+    if free:
+        free[0] = min( free[0], rec['cpus_free'] )
+    return free
+
+# шкала -> отрезки [(начало, конец, свободно)] с постоянным значением
+def free_runs( free ):
+    runs = []
+    for k, v in enumerate( free ):
+        if runs and runs[-1][2] == v:
+            runs[-1][1] = k + 1
+        else:
+            runs.append( [k, k + 1, v] )
+    return runs
+
+# отрезки всех узлов снимка, считаются один раз на снимок
+def snapshot_free_runs( snap ):
+    runs = snap.get("free_runs")
+    if runs is None:
+        runs = snap["free_runs"] = { n: free_runs( free_timeline(rec) ) for n, rec in snap["nodes"].items() }
+    return runs
+
+@timed("fit_query")
+def fit_query( snap, cpus, duration, count=1, limit=10 ):
+    """
+    Где раньше всего поместится задача: count узлов по cpus свободных cpu на duration секунд #F-FIT
+    output: {cpus, duration, count, slot, start, label, nodes, earliest}
+      slot/start/label - первый слот, в котором одновременно подходят count узлов (None - нигде в окне),
+      nodes - подходящие в этом слоте узлы,
+      earliest - до limit узлов с самым ранним собственным слотом: [{node, slot, start, label}]
+    """
+    grid = snapshot_grid( snap["nodes"] )
+    edges = grid["edges"]
+    nslots = len( edges ) - 1
+    now = int( snap["jobs"]["now"].timestamp() )
+    # начало слота; нулевой уже идет, задача в нем стартует сейчас
+    starts = [ now ] + edges[1:nslots]
+    # end_of[s] - конец (не включая) слотов, занятых задачей, начатой в слоте s; не убывает
+    end_of = [ min( nslots, bisect_left( edges, t + duration ) ) for t in starts ]
+
+    diff = [0] * (nslots + 1)
+    first = {}  # узел -> первый подходящий слот
+    spans = {}  # узел -> [(a, b)] слоты старта
+    for n, runs in snapshot_free_runs( snap ).items():
+        a = None
+        for r0, r1, v in runs + [[nslots, nslots, -1]]:
+            if v >= cpus:
+                if a is None:
+                    a = r0
+                b = r1
+                continue
+            if a is not None:
+                # [a, b) - свободно не меньше cpus; старт в s годится, если end_of[s] <= b
+                hi = min( b, bisect_right( end_of, b ) )
+                if hi > a:
+                    diff[a] += 1
+                    diff[hi] -= 1
+                    spans.setdefault( n, [] ).append( (a, hi) )
+                    first.setdefault( n, a )
+                a = None
+
+    slot = None
+    for k, c in enumerate( accumulate( diff[:nslots] ) ):
+        if c >= count:
+            slot = k
+            break
+
+    def when( k ):
+        return { "slot": k, "start": starts[k], "label": grid["labels"][k] }
+
+    res = { "cpus": cpus, "duration": duration, "count": count, "slot": None, "start": None, "label": None, "nodes": [] }
+    if slot is not None:
+        res.update( when(slot) )
+        res["nodes"] = sorted( n for n, sp in spans.items() if any( a <= slot < b for a, b in sp ) )
+    res["earliest"] = [ dict( node=n, **when(k) ) for n, k in sorted( first.items(), key=lambda x: (x[1], x[0]) )[:limit] ]
+    return res
+
+# ответ fit_query текстом
+def fit_text( res ):
+    lines = []
+    what = f"{res['count']} x {res['cpus']} cpu" if res['count'] > 1 else f"{res['cpus']} cpu"
+    what += " на " + slot_width_text( res['duration'] )
+    if res['slot'] is None:
+        lines.append( f"{what}: в окне расписания места нет" )
+    else:
+        lines.append( f"{what}: раньше всего с {res['label']} (слот {res['slot']}), узлы: " + compress_hostlist( res['nodes'] ) )
+    for x in res['earliest']:
+        lines.append( f"  {x['node']}  с {x['label']}" )
+    return "\n".join( lines ) + "\n"
+
+################ история снимков #F-HISTORY
+# каждый снимок дописывается в файл HISTORY_FILE: по узлам состояние текущего часа (биты schedule
+# слота 0), занятые и всего cpu, плюс таблица работающих задач. так можно смотреть загрузку
+# за прошлые дни без опроса slurm: python3.9 mqvis.py history
+#
+# файл - последовательность записей [заголовок формата HIST_HEADER][zlib(тело)], читается через mmap.
+# ключевая запись (kind 0) хранит все целиком, дельта (kind 1) - xor массивов с предыдущей записью
+# (между соседними опросами почти все нули, сжимаются хорошо) и изменения в таблице задач.
+# при превышении HISTORY_MAX_MB старые записи прореживаются (см. history_compact)
+
+HIST_MAGIC = b'MQH1'
+# magic, длина тела, kind, epoch сек, число узлов
+HIST_HEADER = '<4sIBqI'
+# ключевая запись не реже чем раз в столько записей
+HIST_KEYFRAME_EVERY = 100
+
+# снимок -> запись истории {time, nodes: [имена], state, used, total: array, jobs: {jobid: [user, state, узлы]}}
+def history_record( snap ):
+    names = list( snap["nodes"].keys() )
+    state = array('B')
+    used = array('H')
+    total = array('H')
+    for n in names:
+        rec = snap["nodes"][n]
+        sch = rec.get('schedule') or [0]
+        state.append( sch[0] & 0xff )
+        total.append( min(0xffff, rec['cpus_total']) )
+        used.append( min(0xffff, max(0, rec['cpus_total'] - rec['cpus_free'])) )
+    jobs = {}
+    for user, user_jobs in snap.get("index", {}).items():
+        for jobid, job in user_jobs.items():
+            # только то, что было в текущем часе
+            nodes = [n for n, s, e in job["spans"] if s == 0 and e > 0]
+            if nodes:
+                jobs[jobid] = [user, job["state"], compress_hostlist(nodes)] #F-HOSTLIST
+    return { "time": int(snap["time"].timestamp()), "nodes": names,
+             "state": state, "used": used, "total": total, "jobs": jobs }
+
+def xor_bytes( a, b ):
+    return ( int.from_bytes(a, 'little') ^ int.from_bytes(b, 'little') ).to_bytes( len(a), 'little' )
+
+# тело записи в байтах: ключевая если prev is None или узлы сменились, иначе дельта к prev
+def history_encode( rec, prev ):
+    import json
+    arrays = [ rec["state"].tobytes(), rec["used"].tobytes(), rec["total"].tobytes() ]
+    if prev is None or prev["nodes"] != rec["nodes"]:
+        kind = 0
+        meta = { "nodes": rec["nodes"], "jobs": rec["jobs"] }
+    else:
+        kind = 1
+        old = [ prev["state"].tobytes(), prev["used"].tobytes(), prev["total"].tobytes() ]
+        arrays = [ xor_bytes(a, b) for a, b in zip(arrays, old) ]
+        meta = { "add": { j: v for j, v in rec["jobs"].items() if prev["jobs"].get(j) != v },
+                 "del": [ j for j in prev["jobs"] if j not in rec["jobs"] ] }
+    import struct
+    import zlib
+    meta_b = json.dumps( meta, ensure_ascii=False, separators=(',', ':') ).encode('utf-8')
+    body = zlib.compress( struct.pack('<I', len(meta_b)) + meta_b + b"".join(arrays), 6 )
+    return struct.pack( HIST_HEADER, HIST_MAGIC, len(body), kind, rec["time"], len(rec["nodes"]) ) + body
+
+# восстановить запись из тела, prev - предыдущая восстановленная запись (для дельт)
+def history_decode( kind, epoch, nnodes, body, prev ):
+    import json
+    import struct
+    import zlib
+    raw = zlib.decompress( body )
+    mlen = struct.unpack_from('<I', raw)[0]
+    meta = json.loads( raw[4:4+mlen].decode('utf-8') )
+    pos = 4 + mlen
+    parts = []
+    for code, size in (('B', 1), ('H', 2), ('H', 2)):
+        parts.append( raw[pos:pos + size*nnodes] )
+        pos += size*nnodes
+    if kind == 0:
+        nodes = meta["nodes"]
+        jobs = meta["jobs"]
+    else:
+        if prev is None:
+            raise ValueError("дельта без ключевой записи")
+        nodes = prev["nodes"]
+        parts = [ xor_bytes(a, b) for a, b in zip(parts, [prev["state"].tobytes(), prev["used"].tobytes(), prev["total"].tobytes()]) ]
+        jobs = dict( prev["jobs"] )
+        for j in meta["del"]:
+            jobs.pop( j, None )
+        jobs.update( meta["add"] )
+    rec = { "time": epoch, "nodes": nodes, "jobs": jobs }
+    for key, code, data in zip(("state", "used", "total"), ('B', 'H', 'H'), parts):
+        a = array(code)
+        a.frombytes( data )
+        rec[key] = a
+    return rec
+
+# заголовки записей файла: (позиция тела, kind, epoch, число узлов, длина тела)
+# битый хвост (например, недописанная запись) пропускается
+def history_scan( mm ):
+    import struct
+    hsize = struct.calcsize( HIST_HEADER )
+    pos = 0
+    while pos + hsize <= len(mm):
+        magic, blen, kind, epoch, nnodes = struct.unpack_from( HIST_HEADER, mm, pos )
+        pos += hsize
+        if magic != HIST_MAGIC or pos + blen > len(mm):
+            print("история: битая запись, дальше не читаем", file=sys.stderr)
+            return
+        yield pos, kind, epoch, nnodes, blen
+        pos += blen
+
+# записи файла по порядку (генератор), файл читается через mmap
+# from_last_key - начать с последней ключевой записи (для дописывания дельт)
+def history_records( path, from_last_key=False ):
+    import mmap
+    try:
+        f = open( path, 'rb' )
+    except FileNotFoundError:
+        return
+    with f:
+        if os.fstat( f.fileno() ).st_size == 0:
+            return
+        with mmap.mmap( f.fileno(), 0, access=mmap.ACCESS_READ ) as mm:
+            heads = list( history_scan( mm ) )
+            if from_last_key:
+                keys = [i for i, h in enumerate(heads) if h[1] == 0]
+                heads = heads[ keys[-1]: ] if keys else []
+            prev = None
+            for pos, kind, epoch, nnodes, blen in heads:
+                try:
+                    prev = history_decode( kind, epoch, nnodes, mm[pos:pos+blen], prev )
+                except Exception as e:
+                    print(f"история {path}: {e}", file=sys.stderr)
+                    return
+                yield prev
+
+# последняя запись и число записей начиная с последней ключевой
+def history_tail( path ):
+    last = None
+    since_key = 0
+    for rec in history_records( path, from_last_key=True ):
+        last = rec
+        since_key += 1
+    return last, since_key
+
+# последняя записанная запись {path, rec, since_key, size},
+# чтобы не перечитывать файл на каждый снимок в режиме сервера
+HISTORY_LAST = None
+
+def history_append( snap, path=None ):
+    """
+    Дописать снимок в историю #F-HISTORY
+    Запись пропускается, если предыдущая моложе HISTORY_MIN_INTERVAL (частые CGI-вызовы)
+    Блокировка - на отдельном файле path.lock, как у кеша CGI: history_compact подменяет
+    сам файл истории, и дескриптор, открытый до подмены, писал бы в удаленный файл
+    """
+    global HISTORY_LAST
+    import fcntl
+    path = path or HISTORY_FILE
+    rec = history_record( snap )
+    last = HISTORY_LAST
+    if last is None or last["path"] != path:
+        # файл дописывался не позже своего mtime, а записи не новее времени записи -
+        # если с mtime интервал не прошел, заголовки записей можно не перечитывать
+        try:
+            if rec["time"] - os.stat( path ).st_mtime < HISTORY_MIN_INTERVAL:
+                return False
+        except FileNotFoundError:
+            pass
+    with open( path + ".lock", "a" ) as lock:
+        # от параллельных CGI-вызовов
+        fcntl.flock( lock, fcntl.LOCK_EX )
+        with open( path, 'ab' ) as f:
+            if last is not None and last["path"] == path and last["size"] == f.tell():
+                prev, since_key = last["rec"], last["since_key"]
+            else:
+                # файл дописывал кто-то другой
+                prev, since_key = history_tail( path )
+            if prev is not None and rec["time"] - prev["time"] < HISTORY_MIN_INTERVAL:
+                return False
+            if since_key >= HIST_KEYFRAME_EVERY:
+                prev = None
+                since_key = 0
+            f.write( history_encode( rec, prev ) )
+            f.flush()
+            HISTORY_LAST = { "path": path, "rec": rec, "since_key": since_key + 1, "size": f.tell() }
+            size = f.tell()
+        if size > HISTORY_MAX_MB * 1024 * 1024:
+            history_compact( path )
+            HISTORY_LAST = None
+    return True
+
+# уровни прореживания: записи старше age сек оставляются не чаще чем раз в step сек
+HIST_DOWNSAMPLE = [ (24*3600, 3600), (7*24*3600, 6*3600), (30*24*3600, 24*3600) ]
+
+def history_compact( path ):
+    """
+    Ограничение размера истории HISTORY_MAX_MB #F-HISTORY
+    Старые записи прореживаются по HIST_DOWNSAMPLE, если не помогло - отбрасываются самые старые.
+    Файл переписывается во временный и атомарно подменяется, цель - половина лимита
+    """
+    recs = list( history_records( path ) )
+    if not recs:
+        return
+    limit = HISTORY_MAX_MB * 1024 * 1024 // 2
+    now = recs[-1]["time"]
+
+    def encode_all( recs ):
+        out = []
+        prev = None
+        for i, r in enumerate(recs):
+            out.append( history_encode( r, prev if i % HIST_KEYFRAME_EVERY else None ) )
+            prev = r
+        return b"".join( out )
+
+    data = encode_all( recs )
+    for age, step in HIST_DOWNSAMPLE:
+        if len(data) <= limit:
+            break
+        kept = []
+        last_bucket = None
+        for r in recs:
+            if now - r["time"] > age:
+                bucket = r["time"] // step
+                if bucket == last_bucket:
+                    continue
+                last_bucket = bucket
+            kept.append( r )
+        recs = kept
+        data = encode_all( recs )
+    while len(data) > limit and len(recs) > 1:
+        recs = recs[ len(recs)//4 or 1: ]
+        data = encode_all( recs )
+
+    tmp = path + ".tmp"
+    with open( tmp, 'wb' ) as f:
+        f.write( data )
+    os.replace( tmp, path )
+
+# загрузка узлов по часам за прошлые hours часов: {узел: {час epoch: [сумма used/total, число записей]}}
+# nodes_re - фильтр имен узлов (регулярное выражение)
+# записи берутся с начала первого показываемого часа, а не за hours*3600 сек до now:
+# иначе часть часа перед ним попадает в util, но не в колонки paint_history
+def history_utilization( path, hours, nodes_re=None, now=None ):
+    now = int( (now or datetime.now()).timestamp() )
+    since = now - now % 3600 - (hours-1)*3600
+    pat = re.compile( nodes_re ) if nodes_re else None
+    util = defaultdict( lambda: defaultdict(lambda: [0.0, 0]) )
+    users = defaultdict(int)   # пользователь -> число узло-записей
+    for rec in history_records( path ):
+        if rec["time"] < since:
+            continue
+        hour = rec["time"] - rec["time"] % 3600
+        for n, used, total in zip(rec["nodes"], rec["used"], rec["total"]):
+            if total == 0 or (pat is not None and not pat.search(n)):
+                continue
+            cell = util[n][hour]
+            cell[0] += used / total
+            cell[1] += 1
+        for jobid, (user, state, nodes) in rec["jobs"].items():
+            if state & 4:
+                users[user] += len( [n for n in expand_hostlist(nodes) if pat is None or pat.search(n)] )
+    return util, users
+
+def paint_history( hours=None, nodes_re=None, now=None ):
+    """
+    Текстовый вид истории загрузки: узлы по строкам, часы по колонкам #F-HISTORY
+    0..9 - средняя загрузка cpu за час десятками процентов, @ - 100%, . - нет данных
+    """
+    hours = hours or HISTORY_HOURS
+    nodes_re = nodes_re if nodes_re is not None else HISTORY_NODES
+    now = now or datetime.now()
+    util, users = history_utilization( HISTORY_FILE, hours, nodes_re, now )
+    if not util:
+        print("История пуста:", HISTORY_FILE)
+        return
+    now = int( now.timestamp() )
+    first = now - now % 3600 - (hours-1)*3600
+    hour_list = [ first + 3600*k for k in range(hours) ]
+
+    def mark( cell ):
+        if cell is None or cell[1] == 0:
+            return '.'
+        v = cell[0] / cell[1]
+        return '@' if v >= 0.995 else str( int(v*10) )
+
+    max_name_len = max( len(n) for n in util )
+    total = defaultdict(lambda: [0.0, 0])
+    for n in sorted(util):
+        row = util[n]
+        cells = []
+        for h in hour_list:
+            cell = row.get(h)
+            cells.append( mark(cell) )
+            if cell is not None:
+                total[h][0] += cell[0]
+                total[h][1] += cell[1]
+        print( n.rjust(max_name_len), "".join( insert_every_k(cells, 24, ' ', datetime.fromtimestamp(first).hour) ) )
+    avg = "".join( mark(total.get(h)) for h in hour_list )
+    print( "всего".rjust(max_name_len), "".join( insert_every_k(list(avg), 24, ' ', datetime.fromtimestamp(first).hour) ) )
+    s = sum( t[0] for t in total.values() )
+    c = sum( t[1] for t in total.values() )
+    load = f"{100*s/c:.1f}%" if c else "нет данных"
+    print(f"Средняя загрузка cpu за {hours} ч: {load}, начало {datetime.fromtimestamp(first).strftime('%d-%m-%Y %H:00')}, колонка - час, группы по суткам")
+    top = sorted( users.items(), key=lambda x: -x[1] )[:10]
+    if top:
+        print("Больше всего узло-записей:", " ".join( f"{u}:{k}" for u, k in top ))
+
+################ режим сервера #F-SERVE
+
+# текущий снимок сервера: {html: bytes, text: bytes, etag_html: ..., etag_text: ..., nodes..., jobs...}
+# заменяется целиком (присваиванием), поэтому читателям блокировка не нужна
+SNAPSHOT = None
+
+def make_etag( data ):
+    import hashlib
+    return '"' + hashlib.sha1( data ).hexdigest()[:20] + '"'
+
+# состояние инкрементального расписания, меняется только потоком опроса #F-INCREMENTAL
+# создается в serve(), None - строить с нуля
+SCHEDULE_STATE = None
+
+################ живое обновление страницы #F-LIVE
+# страница из режима сервера не перезагружается по meta refresh, а держит соединение
+# /events (server-sent events). при каждом опросе ячейки узлов сравниваются с прошлым
+# снимком по хешам и клиентам уходят только изменившиеся: html ячеек (HTML_MODE=full)
+# или записи узлов (HTML_MODE=compact), а также список пользователей и время.
+# смена сетки слотов или набора узлов - событие reload, страница перезагружается целиком.
+# у событий номер снимка (id), переподключившийся клиент получает пропущенные из LIVE_BACKLOG,
+# слишком отставший - reload
+
+# сколько последних событий помнить для переподключившихся клиентов
+LIVE_BACKLOG = 30
+# пустая строка в /events раз в столько секунд, чтобы прокси не рвали соединение
+LIVE_KEEPALIVE = 25
+LIVE_META_REFRESH_RE = rb"<meta http-equiv=.refresh.[^>]*>\s*"
+
+LIVE_STATE = {
+    "version": 0,       # номер последнего опубликованного снимка
+    "shape": None,      # (узлы, границы слотов, вид html) - при смене reload
+    "hashes": {},       # узел -> хеши ячеек последнего снимка
+    "users": None,      # хеш списка пользователей
+    "log": [],          # [(номер, данные события)], не больше LIVE_BACKLOG
+    "cond": None,       # threading.Condition, см. live_cond
+}
+
+# условие для ожидания новых событий; создается при первом обращении, до serve() потоков нет
+def live_cond():
+    if LIVE_STATE["cond"] is None:
+        import threading
+        LIVE_STATE["cond"] = threading.Condition()
+    return LIVE_STATE["cond"]
+
+# начало отрисовки снимка с живым обновлением: сюда paint_html_node / paint_compact_table
+# складывают изменения узлов относительно прошлого снимка
+def live_begin():
+    return { "version": LIVE_STATE["version"] + 1, "prev": LIVE_STATE["hashes"], "hashes": {},
+             "nodes": {}, "jobs": [], "job_ids": {}, "users": None, "time": None }
+
+# ячейки узла n в html: head - cpu узла, cells - ячейки слотов с разделителями
+def live_node_cells( live, n, head, cells ):
+    hashes = [ hash(head) ] + [ hash(c) for c in cells ]
+    live["hashes"][n] = hashes
+    prev = live["prev"].get(n)
+    if prev is None or len(prev) != len(hashes):
+        # новый узел или другая сетка - все равно reload
+        return
+    diff = {}
+    if prev[0] != hashes[0]:
+        diff["head"] = head
+    changed = [ [k, c] for k, c in enumerate(cells) if prev[k+1] != hashes[k+1] ]
+    if changed:
+        diff["cells"] = changed
+    if diff:
+        live["nodes"][n] = diff
+
+# узлы компактной таблицы (см. compact_payload): номера задач в payload свои у каждого снимка,
+# поэтому сравниваются записи с подставленными задачами, а в событие задачи идут своим списком
+def live_compact_nodes( live, payload ):
+    cjobs = payload["jobs"]
+    labels = payload["labels"]
+    for nd in payload["nodes"]:
+        spans = nd[4]
+        resolved = tuple( (labels[cjobs[j][0]], tuple(cjobs[j][1:]), s, e)
+                          for j, s, e in zip( spans[0::3], spans[1::3], spans[2::3] ) )
+        h = hash( (nd[1], nd[2], tuple(nd[3]), resolved, repr(nd[5])) )
+        n = nd[0]
+        live["hashes"][n] = h
+        prev = live["prev"].get(n)
+        if prev is None or prev == h:
+            continue
+        # задачи события: [подпись, jobid, число задач если больше 1]
+        local = []
+        for j in spans[0::3]:
+            k = live["job_ids"].get(j)
+            if k is None:
+                k = live["job_ids"][j] = len(live["jobs"])
+                live["jobs"].append( [labels[cjobs[j][0]]] + cjobs[j][1:] )
+            local.append( k )
+        spans2 = []
+        for i, k in enumerate(local):
+            spans2 += [k, spans[3*i+1], spans[3*i+2]]
+        live["nodes"][n] = { "compact": nd[:4] + [spans2] + nd[5:] }
+
+# после отрисовки снимка: событие с изменениями для подключенных страниц
+def live_publish( snap, live ):
+    import json
+    names = list( snap["nodes"].keys() )
+    shape = ( tuple(names), tuple( snapshot_grid( snap["nodes"] )["edges"] ), HTML_MODE )
+    users = hash( live["users"] )
+    if shape != LIVE_STATE["shape"]:
+        msg = { "reload": True }
+    else:
+        pos = { n: i for i, n in enumerate(names) }
+        msg = { "time": live["time"], "nodes": [ [pos[n], d] for n, d in live["nodes"].items() ] }
+        if live["jobs"]:
+            msg["jobs"] = live["jobs"]
+        if HTML_MODE != "compact" and live["nodes"] and snap.get("index") is not None:
+            # интервалы индекса подсветки на изменившихся узлах, страница заменяет ими старые
+            users_idx, jobs_idx = html_index_spans( snap["nodes"], snap["index"], live["nodes"] )
+            msg["index"] = { "users": users_idx, "jobs": jobs_idx }
+        if users != LIVE_STATE["users"]:
+            msg["users"] = live["users"]
+    data = json.dumps( msg, ensure_ascii=False, separators=(',', ':') ).encode('utf-8')
+    metric_set( "live_event_bytes", len(data) ) #F-PROFILE
+    metric_set( "live_changed_nodes", len(live["nodes"]) )
+    cond = live_cond()
+    with cond:
+        LIVE_STATE.update( shape=shape, hashes=live["hashes"], users=users, version=live["version"] )
+        LIVE_STATE["log"] = LIVE_STATE["log"][-(LIVE_BACKLOG-1):] + [ (live["version"], data) ]
+        cond.notify_all()
+
+# события для клиента, у которого уже есть снимок since: [(номер, данные)], пусто - ждать дальше
+def live_events_since( since ):
+    log = LIVE_STATE["log"]
+    if since > LIVE_STATE["version"] or (log and since < log[0][0] - 1):
+        # страница от прошлого запуска сервера или пропущено слишком много
+        return [ (LIVE_STATE["version"], b'{"reload":true}') ]
+    return [ x for x in log if x[0] > since ]
+
+# сжатие ответа по Accept-Encoding: br (если установлен модуль brotli) или gzip #F-JSON-API
+# сжатые данные кешируются в снимке, на каждый запрос не пересчитываются
+def pick_encoding( accept ):
+    accept = accept.lower()
+    if "br" in [x.split(';')[0].strip() for x in accept.split(',')]:
+        # только проверка наличия, сам модуль импортируется при сжатии
+        import importlib.util
+        if importlib.util.find_spec( "brotli" ) is not None:
+            return "br"
+    if "gzip" in accept:
+        return "gzip"
+    return None
 
-#print(json.dumps(nodes_dict, indent=2, ensure_ascii=False))
+def encoded_body( snap, key, encoding ):
+    if encoding is None:
+        return snap[key]
+    ckey = key + "." + encoding
+    data = snap.get( ckey )
+    if data is None:
+        if encoding == "br":
+            import brotli
+            data = brotli.compress( snap[key] )
+        else:
+            import gzip
+            data = gzip.compress( snap[key], compresslevel=6 )
+        snap[ckey] = data
+    return data
+
+# опросить slurm, отрисовать и подменить SNAPSHOT
+def refresh_snapshot():
+    global SNAPSHOT
+    metrics_reset() #F-PROFILE
+    t0 = time.perf_counter()
+    snap = collect_snapshot( SCHEDULE_STATE )
+    live = live_begin() if LIVE else None #F-LIVE
+    snap["html"] = render_html( snap, STATIC_ASSETS, live )
+    snap["text"] = render_text( snap ).encode('utf-8')
+    snap["json"] = render_json( snap )
+    snap["etag_html"] = make_etag( snap["html"] )
+    snap["etag_text"] = make_etag( snap["text"] )
+    snap["etag_json"] = make_etag( snap["json"] )
+    for key in ("html", "text", "json"):
+        metric_set( key + "_bytes", len(snap[key]) )
+    REFRESH_STATS["seconds"] = time.perf_counter() - t0
+    REFRESH_STATS["count"] += 1
+    REFRESH_STATS["last"] = time.time()
+    SNAPSHOT = snap
+    if live is not None:
+        # после SNAPSHOT: перезагрузившаяся по reload страница должна получить уже новый снимок
+        live_publish( snap, live )
+    snap["metrics"] = metrics_snapshot()
+    if HISTORY_FILE:
+        #F-HISTORY
+        try:
+            history_append( snap )
+        except Exception as e:
+            print(f"Ошибка записи истории: {e}", file=sys.stderr)
+    return snap
+
+# счетчики опросов для /metrics #F-PROFILE
+REFRESH_STATS = {"count": 0, "errors": 0, "seconds": 0.0, "last": 0.0}
+
+# /metrics: замеры последнего снимка и счетчики опросов в формате Prometheus
+def render_metrics( snap ):
+    extra = {
+        "mqvis_refresh_total": ("counter", "Completed snapshot refreshes", REFRESH_STATS["count"]),
+        "mqvis_refresh_errors_total": ("counter", "Failed snapshot refreshes", REFRESH_STATS["errors"]),
+        "mqvis_refresh_seconds": ("gauge", "Wall time of the last snapshot refresh", REFRESH_STATS["seconds"]),
+        "mqvis_refresh_timestamp_seconds": ("gauge", "Unix time of the last snapshot refresh", REFRESH_STATS["last"]),
+    }
+    m = snap["metrics"] if snap is not None else new_metrics()
+    return metrics_prometheus( m, extra ).encode('utf-8')
+
+# цикл опроса slurm, работает в отдельном потоке
+def poll_loop():
+    while True:
+        t0 = time.monotonic()
+        try:
+            refresh_snapshot()
+        except Exception as e:
+            # оставляем последний удачный снимок
+            REFRESH_STATS["errors"] += 1
+            print(f"Ошибка при обновлении снимка: {e}", file=sys.stderr)
+            import traceback
+            traceback.print_exc()
+        time.sleep( max(1, POLL_INTERVAL - (time.monotonic() - t0)) )
+
+def serve():
+    global SCHEDULE_STATE
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            path, _, query = self.path.partition('?')
+            if path == "/text" and query:
+                self.send_user_text( query )
+                return
+            if path == "/metrics":
+                #F-PROFILE
+                data = render_metrics( SNAPSHOT )
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(data)))
+                self.send_header("Cache-Control", "no-cache")
+                self.end_headers()
+                self.wfile.write(data)
+                return
+            if path.startswith("/static/"):
+                #F-TEMPLATE-CACHE
+                self.send_asset( path )
+                return
+            if path == "/api/fit":
+                #F-FIT
+                self.send_fit( query )
+                return
+            if path == "/events":
+                #F-LIVE
+                self.send_events( query )
+                return
+            if path in ("/", "/index.html"):
+                key, ctype = "html", "text/html; charset=utf-8"
+            elif path == "/text":
+                key, ctype = "text", "text/plain; charset=utf-8"
+            elif path == "/api/snapshot":
+                #F-JSON-API
+                key, ctype = "json", "application/json"
+            else:
+                self.send_error(404)
+                return
+
+            snap = SNAPSHOT
+            if snap is None:
+                # первый опрос еще не закончился
+                self.send_response(503)
+                self.send_header("Retry-After", "5")
+                self.end_headers()
+                return
+            self.send_body( snap, key, ctype, "no-cache" )
+
+        # отдать snap[key] с учетом ETag и Accept-Encoding
+        def send_body( self, snap, key, ctype, cache_control ):
+            encoding = pick_encoding( self.headers.get("Accept-Encoding", "") )
+            etag = snap["etag_" + key]
+            if encoding is not None:
+                # у сжатого варианта свой ETag
+                etag = etag[:-1] + "-" + encoding + '"'
+            if etag in self.headers.get("If-None-Match", ""):
+                self.send_response(304)
+                self.send_header("ETag", etag)
+                self.end_headers()
+                return
+
+            data = encoded_body( snap, key, encoding )
+            self.send_response(200)
+            self.send_header("Content-Type", ctype)
+            self.send_header("Content-Length", str(len(data)))
+            if encoding is not None:
+                self.send_header("Content-Encoding", encoding)
+            self.send_header("Vary", "Accept-Encoding")
+            self.send_header("ETag", etag)
+            self.send_header("Cache-Control", cache_control)
+            self.end_headers()
+            self.wfile.write(data)
+
+        # css/js шаблона, STATIC_ASSETS=1 #F-TEMPLATE-CACHE
+        # адрес содержит хеш содержимого, поэтому кешируется браузером надолго
+        def send_asset( self, path ):
+            asset = load_template( True )["assets"].get( path ) if STATIC_ASSETS else None
+            if asset is None:
+                self.send_error(404)
+                return
+            self.send_body( asset, "body", asset["ctype"], "public, max-age=31536000, immutable" )
+
+        # /text?user=u1321[&job=123] - подсветка по индексу снимка, без опроса slurm #F-USER-INDEX
+        def send_user_text( self, query ):
+            from urllib.parse import parse_qs
+            snap = SNAPSHOT
+            if snap is None:
+                self.send_response(503)
+                self.send_header("Retry-After", "5")
+                self.end_headers()
+                return
+            q = parse_qs( query )
+            user = q.get("user", [HILITE_USER])[0]
+            jobid = q.get("job", [None])[0]
+            data = render_text( snap, user, jobid ).encode('utf-8')
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; charset=utf-8")
+            self.send_header("Content-Length", str(len(data)))
+            self.send_header("Cache-Control", "no-cache")
+            self.end_headers()
+            self.wfile.write(data)
+
+        # /api/fit?q=2x32cpu:12h[&limit=20] - где раньше всего поместится задача, json #F-FIT
+        def send_fit( self, query ):
+            from urllib.parse import parse_qs
+            q = parse_qs( query )
+            try:
+                fit = parse_fit( q.get("q", [""])[0] )
+                limit = max(1, int( q.get("limit", [FIT_LIMIT])[0] ))
+            except ValueError as e:
+                self.send_json( 400, {"error": str(e)} )
+                return
+            snap = SNAPSHOT
+            if snap is None:
+                self.send_response(503)
+                self.send_header("Retry-After", "5")
+                self.end_headers()
+                return
+            self.send_json( 200, fit_query( snap, *fit, limit=limit ) )
+
+        # /events?v=номер снимка страницы - поток server-sent events с изменениями ячеек #F-LIVE
+        # при переподключении браузер сам присылает номер последнего события в Last-Event-ID
+        def send_events( self, query ):
+            from urllib.parse import parse_qs
+            if not LIVE:
+                self.send_error(404)
+                return
+            since = self.headers.get("Last-Event-ID") or parse_qs( query ).get("v", ["0"])[0]
+            since = int(since) if since.isdigit() else 0
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream; charset=utf-8")
+            self.send_header("Cache-Control", "no-cache")
+            self.send_header("X-Accel-Buffering", "no")
+            self.end_headers()
+            cond = live_cond()
+            try:
+                while True:
+                    with cond:
+                        events = live_events_since( since ) if LIVE_STATE["version"] > 0 else []
+                        if not events:
+                            cond.wait( LIVE_KEEPALIVE )
+                            events = live_events_since( since ) if LIVE_STATE["version"] > 0 else []
+                    if not events:
+                        self.wfile.write( b": ping\n\n" )
+                    for version, data in events:
+                        self.wfile.write( b"id: " + str(version).encode() + b"\ndata: " + data + b"\n\n" )
+                        since = version
+                    self.wfile.flush()
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+
+        def send_json( self, code, doc ):
+            import json
+            data = json.dumps( doc, ensure_ascii=False ).encode('utf-8')
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.send_header("Cache-Control", "no-cache")
+            self.end_headers()
+            self.wfile.write(data)
+
+    if INCREMENTAL:
+        SCHEDULE_STATE = new_schedule_state()
+    import threading
+    live_cond()
+    threading.Thread( target=poll_loop, daemon=True ).start()
+    httpd = ThreadingHTTPServer( (SERVE_BIND, SERVE_PORT), Handler )
+    print(f"mqvis: http://{SERVE_BIND}:{SERVE_PORT}/ интервал опроса {POLL_INTERVAL} сек", file=sys.stderr)
+    httpd.serve_forever()
+
+# один опрос slurm и вывод в stdout в формате FORMAT
+def print_snapshot():
+    if FIT:
+        # проверяем запрос до опроса slurm #F-FIT
+        try:
+            fit = parse_fit( FIT )
+        except ValueError as e:
+            print(f"Ошибка: {e}", file=sys.stderr)
+            sys.exit(2)
+    snap = collect_snapshot()
+    if HISTORY_FILE:
+        #F-HISTORY
+        try:
+            history_append( snap )
+        except Exception as e:
+            print(f"Ошибка записи истории: {e}", file=sys.stderr)
+    if FIT:
+        #F-FIT
+        res = fit_query( snap, *fit, limit=FIT_LIMIT )
+        if FORMAT == "json":
+            import json
+            sys.stdout.write( json.dumps( res, ensure_ascii=False ) + "\n" )
+        else:
+            sys.stdout.write( fit_text( res ) )
+    elif FORMAT == "html":
+        use_template_stream( snap["nodes"], snap["jobs"], snap["index"] )
+    elif FORMAT == "json":
+        #F-JSON-API
+        data = render_json( snap )
+        metric_set( "json_bytes", len(data) ) #F-PROFILE
+        sys.stdout.buffer.write( data )
+    else:
+        #print(HILITE_USER)
+        paint_text( snap["nodes"], snap["user_tasks"] )
+
+###########################################
+
+# точка входа; при import mqvis ничего не запускается, только читаются параметры окружения #F-FAST-START
+# argv - аргументы без имени скрипта: [], ["serve"], ["history", часы, regex]
+def main( argv=None ):
+    if argv is None:
+        argv = sys.argv[1:]
+    if len(argv) > 0 and argv[0] == "serve":
+        serve()
+    elif len(argv) > 0 and argv[0] == "history":
+        #F-HISTORY
+        paint_history( int(argv[1]) if len(argv) > 1 else None,
+                       argv[2] if len(argv) > 2 else None )
+    else:
+        if PROFILE_DUMP:
+            #F-PROFILE
+            import cProfile
+            profiler = cProfile.Profile()
+            profiler.runcall( print_snapshot )
+            profiler.dump_stats( PROFILE_DUMP )
+        else:
+            print_snapshot()
+        if PROFILE:
+            sys.stdout.flush()
+            sys.stderr.write( metrics_prometheus( metrics_snapshot() ) )
 
-if FORMAT == "html":
-    use_template( paint_html( nodes_dict ) )
-else:
-    #print(HILITE_USER)
-    paint_text( nodes_dict, user_tasks )
+if __name__ == "__main__":
+    main()
 
 # done
@@ -0,0 +1,383 @@
+#!/bin/env python3.9
+
+"""
+Замеры скорости mqvis на синтетической очереди, без slurm
+
+Запуск:
+* python3.9 mqvis_bench.py
+  2000 узлов, 50000 задач
+* python3.9 mqvis_bench.py 500 10000
+  узлы, задачи
+* python3.9 mqvis_bench.py 500 10000 --shape multi --states RUNNING=1,PENDING=3 --json bench.json
+  форма списков узлов, доли состояний задач, результаты в json для отслеживания регрессий
+* python3.9 mqvis_bench.py 500 10000 --fixtures dir
+  записать синтетические выдачи sinfo и squeue в каталог
+* python3.9 mqvis_bench.py 2000 50000 --compare
+  сравнить построение расписания с эталонным обходом задач по часам (как было до #F-RASTER)
+
+Этапы (разбор sinfo/squeue, построение расписания, text, html, json) меряются по отдельности
+на синтетических выдачах sinfo -N -o '%N %C %t %P' и squeue -o %all / -o SQUEUE_FIELDS
+"""
+
+import os
+import json
+import time
+import random
+import platform
+import argparse
+from array import array
+from datetime import datetime, timedelta
+
+import mqvis
+
+# синтетические выдачи slurm #F-BENCH
+# узлы двух групп: node0000.. (3/4) и gpu000.. (1/4), чтобы были списки вида node[..],gpu[..]
+def fixture_node_names( nnodes ):
+    ncpu = max(1, nnodes * 3 // 4)
+    return [f"node{i:04d}" for i in range(ncpu)] + [f"gpu{i:03d}" for i in range(nnodes - ncpu)]
+
+# выдача sinfo -N -a --noheader -o '%N %C %t %P', часть узлов в двух разделах
+def synthetic_sinfo_text( nnodes, seed=1 ):
+    rnd = random.Random( seed )
+    lines = []
+    for n in fixture_node_names( nnodes ):
+        total = rnd.choice([32, 48, 64, 128])
+        alloc = rnd.randint(0, total)
+        state = rnd.choice(['alloc', 'mix', 'idle', 'down*']) if rnd.random() < 0.9 else 'drain'
+        cpus = f"{alloc}/{total-alloc}/0/{total}"
+        lines.append( f"{n} {cpus} {state} all" )
+        if rnd.random() < 0.3:
+            lines.append( f"{n} {cpus} {state} {'gpu' if n.startswith('gpu') else 'long'}" )
+    return "\n".join( lines ) + "\n"
+
+# hostlist задачи заданной формы по списку имен узлов
+# single - один узел, range - prefix[a-b], list - prefix[a,b,c], multi - node[..],gpu[..]
+HOSTLIST_SHAPES = ("single", "range", "list", "multi")
+
+def synthetic_hostlist( rnd, names, shape ):
+    if shape == "mixed":
+        shape = rnd.choice( HOSTLIST_SHAPES )
+    a = rnd.randrange( len(names) )
+    if shape == "single":
+        return names[a]
+    if shape == "range":
+        b = min( len(names)-1, a + rnd.randint(1, 15) )
+        picked = names[a:b+1]
+    elif shape == "list":
+        picked = rnd.sample( names, min(len(names), rnd.randint(2, 8)) )
+    else:
+        picked = rnd.sample( names, min(len(names), rnd.randint(2, 6)) ) + rnd.sample( names, min(len(names), rnd.randint(1, 4)) )
+    return mqvis.compress_hostlist( picked )
+
+# доли состояний "RUNNING=2,PENDING=2,COMPLETING=1" -> список для rnd.choice
+def parse_states( spec ):
+    res = []
+    for item in spec.split(','):
+        name, _, w = item.partition('=')
+        res += [name.strip()] * int(w or 1)
+    return res
+
+# колонки squeue -o %all, кроме нужных mqvis - несколько обычных "лишних", как в настоящей выдаче
+SQUEUE_ALL_COLUMNS = ["ACCOUNT", "TRES_PER_NODE", "MIN_CPUS", "MIN_TMP_DISK", "END_TIME", "FEATURES",
+    "GROUP", "OVER_SUBSCRIBE", "JOBID", "NAME", "COMMENT", "TIME_LIMIT", "MIN_MEMORY", "REQ_NODES",
+    "COMMAND", "PRIORITY", "QOS", "REASON", "ST", "USER", "RESERVATION", "WCKEY", "EXC_NODES",
+    "NICE", "S:C:T", "EXEC_HOST", "CPUS", "NODES", "DEPENDENCY", "ARRAY_JOB_ID", "SOCKETS_PER_NODE",
+    "CORES_PER_SOCKET", "THREADS_PER_CORE", "ARRAY_TASK_ID", "TIME_LEFT", "TIME", "NODELIST",
+    "CONTIGUOUS", "PARTITION", "PRIORITY", "NODELIST(REASON)", "START_TIME", "STATE", "UID",
+    "SUBMIT_TIME", "LICENSES", "CORE_SPEC", "SCHEDNODES", "WORK_DIR"]
+
+# задачи очереди как словари колонок squeue
+def synthetic_job_rows( nnodes, njobs, shape="mixed", states="RUNNING=2,PENDING=2,COMPLETING=1", seed=1 ):
+    rnd = random.Random( seed )
+    names = fixture_node_names( nnodes )
+    choices = parse_states( states )
+    now = datetime.now().replace(microsecond=0)
+    fmt = '%Y-%m-%dT%H:%M:%S'
+    rows = []
+    for j in range(njobs):
+        state = rnd.choice( choices )
+        if state == 'RUNNING':
+            start = now - timedelta(minutes=rnd.randint(0, 3000))
+        else:
+            start = now + timedelta(minutes=rnd.randint(0, 5000))
+        end = start + timedelta(hours=rnd.choice([1, 2, 4, 8, 24, 72, 168]))
+        nl = synthetic_hostlist( rnd, names, shape )
+        user = f"u{rnd.randint(0,200)}"
+        rows.append( {
+            "JOBID": str(100000+j), "USER": user, "NAME": f"job{rnd.randint(0,50)}", "STATE": state,
+            "START_TIME": start.strftime(fmt), "END_TIME": end.strftime(fmt),
+            "NODELIST": nl if state != 'PENDING' else '', "SCHEDNODES": nl if state == 'PENDING' else '(null)',
+            "COMMAND": f"/home/{user}/run.sh", "WORK_DIR": f"/home/{user}", "PARTITION": "all",
+            "TIME_LIMIT": "7-00:00:00", "CPUS": str(rnd.choice([1, 16, 64])),
+        } )
+    return rows
+
+# выдача squeue -a -o %all: заголовок и строки через |
+def synthetic_squeue_all_text( rows ):
+    lines = [ "|".join( SQUEUE_ALL_COLUMNS ) ]
+    for r in rows:
+        lines.append( "|".join( r.get(c, "N/A") for c in SQUEUE_ALL_COLUMNS ) )
+    return "\n".join( lines ) + "\n"
+
+# выдача squeue -a --noheader -o <SQUEUE_FIELDS>
+def synthetic_squeue_narrow_text( rows ):
+    return "".join( "|".join( r[name] for name, code in mqvis.SQUEUE_FIELDS ) + "\n" for r in rows )
+
+# узлы в формате simple_sinfo_dict - разбор той же синтетической выдачи sinfo
+def synthetic_nodes( nnodes, seed=1 ):
+    return mqvis.parse_sinfo( synthetic_sinfo_text( nnodes, seed ).split("\n") )
+
+# таблица задач - разбор той же синтетической выдачи squeue, по умолчанию узлы подряд (node[0010-0025])
+def synthetic_jobs( nnodes, njobs, seed=1, shape="range", states="RUNNING=2,PENDING=2,COMPLETING=1" ):
+    rows = synthetic_job_rows( nnodes, njobs, shape, states, seed )
+    return mqvis.parse_squeue_narrow( synthetic_squeue_narrow_text( rows ).split("\n"), mqvis.new_jobs_table() )
+
+def write_fixtures( path, sinfo, squeue_all, squeue_narrow ):
+    os.makedirs( path, exist_ok=True )
+    for name, text in (("sinfo.txt", sinfo), ("squeue_all.txt", squeue_all), ("squeue_narrow.txt", squeue_narrow)):
+        with open( os.path.join(path, name), "w", encoding="utf-8" ) as f:
+            f.write( text )
+
+def clear_caches():
+    mqvis.expand_hostlist.cache_clear()
+    mqvis.iso_epoch.cache_clear()
+
+# замер этапов конвейера по отдельности на синтетических выдачах
+# output: {этап: сек}, {размер выдачи: байт}
+def bench_stages( nnodes, njobs, shape="mixed", states="RUNNING=2,PENDING=2,COMPLETING=1", seed=1, repeat=3, fixtures=None ):
+    rows = synthetic_job_rows( nnodes, njobs, shape, states, seed )
+    sinfo = synthetic_sinfo_text( nnodes, seed )
+    squeue_all = synthetic_squeue_all_text( rows )
+    squeue_narrow = synthetic_squeue_narrow_text( rows )
+    if fixtures:
+        write_fixtures( fixtures, sinfo, squeue_all, squeue_narrow )
+    times = {}
+    sizes = {"sinfo": len(sinfo), "squeue_all": len(squeue_all), "squeue_narrow": len(squeue_narrow)}
+
+    def stage( name, fn, clear=True ):
+        def run():
+            if clear:
+                clear_caches()
+            return fn()
+        times[name] = best_time( run, repeat )
+        return fn()
+
+    stage( "parse_sinfo", lambda: mqvis.parse_sinfo( sinfo.split("\n") ) )
+    stage( "parse_squeue_all", lambda: mqvis.parse_squeue_all( squeue_all.split("\n"), mqvis.new_jobs_table() ) )
+    jt = stage( "parse_squeue_narrow", lambda: mqvis.parse_squeue_narrow( squeue_narrow.split("\n"), mqvis.new_jobs_table() ) )
+    stage( "aggregate_jobs", lambda: mqvis.aggregate_jobs( jt ), clear=False ) #F-AGGREGATE
+
+    def build():
+        nodes = mqvis.parse_sinfo( sinfo.split("\n") )
+        user_tasks = {"running":[],"other":[],"pending":[]}
+        index = {}
+        mqvis.build_hourly_schedule( jt, nodes, user_tasks, None, index )
+        return { "nodes": nodes, "jobs": jt, "user_tasks": user_tasks, "index": index, "time": jt["now"] }
+    snap = stage( "build_hourly_schedule", build )
+
+    stage( "render_text", lambda: mqvis.render_text( snap ), clear=False )
+    html = stage( "render_html", lambda: mqvis.render_html( snap ), clear=False )
+    mode = mqvis.HTML_MODE
+    mqvis.HTML_MODE = "compact"
+    try:
+        compact = stage( "render_html_compact", lambda: mqvis.render_html( snap ), clear=False )
+    finally:
+        mqvis.HTML_MODE = mode
+    js = stage( "render_json", lambda: mqvis.render_json( snap ), clear=False )
+
+    # поиск места 2x64cpu:12h вместе с построением шкал свободных cpu #F-FIT
+    def fit():
+        snap.pop( "free_runs", None )
+        return mqvis.fit_query( snap, 64, 12*3600, 2 )
+    stage( "fit_query", fit, clear=False )
+    sizes.update( { "html": len(html), "html_compact": len(compact), "json": len(js) } )
+    return times, sizes
+
+# лучшее время из repeat запусков fn(), сек
+def best_time( fn, repeat=3 ):
+    best = None
+    for i in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        dt = time.perf_counter() - t0
+        best = dt if best is None else min(best, dt)
+    return best
+
+# расписание как до #F-RASTER: обход каждой задачи по часам со strftime на каждый час и узел.
+# эталон для сравнения скорости и результата (биты состояния и число задач по слотам), только часовые слоты
+def reference_schedule( jt, nodes ):
+    now = jt["now"]
+    start_hour = now.replace(minute=0, second=0, microsecond=0)
+    nslots = mqvis.TIME_SLOTS
+    for rec in nodes.values():
+        rec['schedule'] = [0] * nslots
+        rec['jobcnt'] = [0] * nslots
+        rec['timeinfo'] = [""] * nslots
+    strings = jt["strings"]
+    for idx in range( mqvis.jobs_count(jt) ):
+        names = mqvis.expand_hostlist( strings[ jt["nodes"][idx] ] )
+        sval = jt["state"][idx]
+        if not names or jt["end"][idx] == mqvis.NO_TIME:
+            continue
+        if sval & 4:
+            start = now
+        elif jt["start"][idx] != mqvis.NO_TIME:
+            start = datetime.fromtimestamp( jt["start"][idx] )
+        else:
+            continue
+        current_hour = start.replace(minute=0, second=0, microsecond=0)
+        end_hour = datetime.fromtimestamp( jt["end"][idx] ).replace(minute=0, second=0, microsecond=0)
+        while current_hour <= end_hour:
+            time_slot = int( (current_hour - start_hour).total_seconds() / 3600 )
+            hour_key = current_hour.strftime('%d-%m-%Y %H:00')
+            for n in names:
+                rec = nodes.get(n)
+                if rec is None or not 0 <= time_slot < nslots:
+                    continue
+                rec['schedule'][time_slot] |= sval
+                rec['jobcnt'][time_slot] += jt["count"][idx]
+                rec['timeinfo'][time_slot] = hour_key
+            current_hour += timedelta(hours=1)
+    return nodes
+
+# build_hourly_schedule на synthetic_jobs; compare - еще и эталон reference_schedule
+# output: (сек, сек эталона или None)
+def bench_schedule( nnodes, njobs, compare=False ):
+    jt = synthetic_jobs( nnodes, njobs )
+    sinfo = synthetic_sinfo_text( nnodes ).split("\n")
+    res = {}
+
+    def run():
+        res["nodes"] = mqvis.parse_sinfo( sinfo )
+        mqvis.build_hourly_schedule( jt, res["nodes"], {"running":[],"other":[],"pending":[]} )
+
+    def ref():
+        res["ref"] = reference_schedule( jt, mqvis.parse_sinfo( sinfo ) )
+
+    t = best_time( run )
+    if not compare or mqvis.SLOT_TIERS != [(3600, None)]:
+        return t, None
+    t_ref = best_time( ref, 1 )
+    for n, rec in res["nodes"].items():
+        r = res["ref"][n]
+        assert [x & 7 for x in rec['schedule']] == r['schedule'], n
+        assert list( rec['jobcnt'] ) == r['jobcnt'], n
+    return t, t_ref
+
+# обновление расписания при малом числе изменившихся задач: с нуля и инкрементально #F-INCREMENTAL
+def bench_incremental( nnodes, njobs, churn=100 ):
+    jt = synthetic_jobs( nnodes, njobs )
+    st = mqvis.new_schedule_state()
+    mqvis.incremental_schedule( st, jt, synthetic_nodes( nnodes ), {"running":[],"other":[],"pending":[]} )
+
+    # следующий опрос: churn задач закончились, столько же новых
+    fresh = synthetic_jobs( nnodes, churn, seed=2 )
+    jt3 = mqvis.new_jobs_table( jt["now"] )
+    for i in range(churn, njobs):
+        mqvis.jobs_table_append_row( jt3, jt, i )
+    for i in range(churn):
+        mqvis.jobs_table_append_row( jt3, fresh, i )
+        jt3["jobid"][-1] = mqvis.intern_str( jt3, "new" + mqvis.job_id_str(fresh, i) )
+
+    def full():
+        mqvis.build_hourly_schedule( jt3, synthetic_nodes( nnodes ), {"running":[],"other":[],"pending":[]} )
+
+    def inc():
+        st2 = { **st, "jobs": dict(st["jobs"]) }
+        st2["nodes"] = { n: { **r, "raster": array('i', r["raster"]),
+                              "intervals": { row: list(x) for row, x in r["intervals"].items() },
+                              "diff": { k: list(d) for k, d in r["diff"].items() } } for n, r in st["nodes"].items() }
+        t = time.perf_counter()
+        mqvis.incremental_schedule( st2, jt3, synthetic_nodes( nnodes ), {"running":[],"other":[],"pending":[]} )
+        return time.perf_counter() - t
+
+    return best_time( full ), min( inc() for i in range(3) )
+
+# разбор времен squeue: strptime (как было) и slurm_epoch #F-FAST-TIME
+# времена окончания повторяются (лимиты), как в реальной очереди
+def bench_time_parse( n=100000, seed=1 ):
+    rnd = random.Random( seed )
+    now = datetime.now()
+    fmt = '%Y-%m-%dT%H:%M:%S'
+    base = now.replace(minute=0, second=0, microsecond=0)
+    strs = [ (base + timedelta(minutes=rnd.randint(0, 2000)*10)).strftime(fmt) for i in range(n) ]
+
+    def old():
+        for s in strs:
+            int( datetime.strptime(s, fmt).timestamp() )
+
+    def new():
+        mqvis.iso_epoch.cache_clear()
+        for s in strs:
+            mqvis.slurm_epoch( s, now )
+
+    return best_time( old ), best_time( new )
+
+# раскрытие hostlist: с пустым кешем и с заполненным (как у задач с общими узлами)
+def bench_hostlist( n=20000 ):
+    strs = [f"node[{i%500:04d}-{i%500+15:04d}],gpu[{i%7}-{i%7+2}]" for i in range(n)]
+
+    def cold():
+        mqvis.expand_hostlist.cache_clear()
+        for s in strs:
+            mqvis.expand_hostlist( s )
+
+    def warm():
+        for s in strs:
+            mqvis.expand_hostlist( s )
+
+    return best_time( cold ), best_time( warm )
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser( description="замеры mqvis на синтетической очереди" )
+    ap.add_argument( "nodes", type=int, nargs="?", default=2000 )
+    ap.add_argument( "jobs", type=int, nargs="?", default=50000 )
+    ap.add_argument( "--shape", default="mixed", choices=HOSTLIST_SHAPES + ("mixed",), help="форма списков узлов задач" )
+    ap.add_argument( "--states", default="RUNNING=2,PENDING=2,COMPLETING=1", help="доли состояний задач" )
+    ap.add_argument( "--seed", type=int, default=1 )
+    ap.add_argument( "--repeat", type=int, default=3 )
+    ap.add_argument( "--json", help="записать результаты в файл json" )
+    ap.add_argument( "--fixtures", help="записать синтетические выдачи sinfo/squeue в каталог" )
+    ap.add_argument( "--stages-only", action="store_true", help="без микро-замеров" )
+    ap.add_argument( "--compare", action="store_true", help="сравнить build_hourly_schedule с эталонным обходом по часам" )
+    args = ap.parse_args()
+    nnodes, njobs = args.nodes, args.jobs
+
+    print(f"узлов {nnodes}, задач {njobs}, слотов {mqvis.TIME_SLOTS} по {os.environ.get('SLOT_WIDTH','1h')}, списки узлов {args.shape}, состояния {args.states}")
+    times, sizes = bench_stages( nnodes, njobs, args.shape, args.states, args.seed, args.repeat, args.fixtures )
+    for name, t in times.items():
+        print(f"{name}: {t:.3f} сек")
+    print("размеры, байт:", ", ".join( f"{k} {v}" for k, v in sizes.items() ))
+
+    micro = {}
+    if not args.stages_only:
+        t, t_ref = bench_schedule( nnodes, njobs, args.compare )
+        micro["schedule_synthetic_table"] = t
+        print(f"build_hourly_schedule: {t:.3f} сек")
+        if t_ref is not None:
+            micro["schedule_reference"] = t_ref
+            print(f"обход по часам (как было): {t_ref:.3f} сек, ускорение в {t_ref/t:.1f} раз, расписания совпадают")
+        full, inc = bench_incremental( nnodes, njobs )
+        micro["update_full"], micro["update_incremental"] = full, inc
+        print(f"обновление при 100 сменившихся задачах: с нуля {full:.3f} сек, инкрементально {inc:.3f} сек")
+        old, new = bench_time_parse()
+        micro["time_parse_strptime"], micro["time_parse_slurm_epoch"] = old, new
+        print(f"разбор 100000 времен: strptime {old:.3f} сек, slurm_epoch {new:.3f} сек")
+        cold, warm = bench_hostlist()
+        micro["hostlist_cold"], micro["hostlist_warm"] = cold, warm
+        print(f"expand_hostlist 20000 строк: {cold:.3f} сек с пустым кешем, из кеша {warm:.3f} сек")
+
+    if args.json:
+        result = {
+            "time": datetime.now().isoformat( timespec='seconds' ),
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "params": { "nodes": nnodes, "jobs": njobs, "slots": mqvis.TIME_SLOTS,
+                        "slot_width": os.environ.get("SLOT_WIDTH","1h"), "shape": args.shape,
+                        "states": args.states, "seed": args.seed, "repeat": args.repeat },
+            "stages": times,
+            "sizes": sizes,
+            "micro": micro,
+        }
+        with open( args.json, "w", encoding="utf-8" ) as f:
+            json.dump( result, f, ensure_ascii=False, indent=1 )
@@ -0,0 +1,77 @@
+#!/bin/env python3.9
+
+"""
+Проверки общего кеша ответов slurm для cgi #F-CGI-CACHE
+
+Запуск (slurm не нужен):
+* python3.9 -m unittest test_mqvis_cache
+* python3.9 -m pytest test_mqvis_cache.py
+"""
+
+import os
+import tempfile
+import unittest
+from datetime import datetime
+
+import mqvis
+
+NOW = datetime( 2026, 10, 17, 12, 0 )
+
+# ответы slurm в том виде, как их отдает collect_slurm
+def raw_answers():
+    nodes = mqvis.parse_sinfo( [ "node01 4/4/0/8 mix all", "node02 0/8/0/8 idle all" ] )
+    jt = mqvis.parse_squeue_narrow( [ "5|bob|RUNNING|2026-10-17T10:00:00|2026-10-17T20:00:00|node01|(null)|4|job",
+                                      "6_[1-4]|alice|PENDING|2026-10-17T13:00:00|2026-10-17T14:00:00||node02|2|a" ],
+                                    mqvis.new_jobs_table(NOW) )
+    return nodes, jt, None
+
+class CacheTest( unittest.TestCase ):
+
+    def setUp( self ):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join( self.dir.name, "mqvis.cache" )
+        self.saved = ( mqvis.collect_slurm, mqvis.DETAILED_USAGE, mqvis.CACHE_TTL )
+        self.calls = 0
+        def collect( now ):
+            self.calls += 1
+            return raw_answers()
+        mqvis.collect_slurm = collect
+        mqvis.cache_key.cache_clear()
+
+    def tearDown( self ):
+        mqvis.collect_slurm, mqvis.DETAILED_USAGE, mqvis.CACHE_TTL = self.saved
+        mqvis.cache_key.cache_clear()
+        self.dir.cleanup()
+
+    def test_roundtrip( self ):
+        nodes, jt, usage = raw_answers()
+        t, (nodes2, jt2, usage2) = mqvis.cache_decode( mqvis.cache_encode( nodes, jt, usage ) )
+        self.assertEqual( nodes2, nodes )
+        self.assertIsNone( usage2 )
+        self.assertEqual( jt2["now"], NOW )
+        for col in mqvis.CACHE_COLUMNS:
+            self.assertEqual( list( jt2[col] ), list( jt[col] ), col )
+        self.assertEqual( [ mqvis.job_id_str(jt2, i) for i in range(2) ], [ "5", "6_[1-4]" ] )
+
+    def test_fresh_cache_skips_slurm( self ):
+        mqvis.CACHE_TTL = 60
+        mqvis.cached_collect( self.path )
+        nodes, jt, usage = mqvis.cached_collect( self.path )
+        self.assertEqual( self.calls, 1 )
+        self.assertEqual( mqvis.jobs_count(jt), 2 )
+
+    # другие настройки - другой файл, а старый файл с чужим ключом не читается
+    def test_settings_in_key( self ):
+        mqvis.DETAILED_USAGE = False
+        plain = mqvis.cache_path( self.path )
+        mqvis.cache_write( plain, raw_answers() )
+        mqvis.DETAILED_USAGE = True
+        mqvis.cache_key.cache_clear()
+        detailed = mqvis.cache_path( self.path )
+        self.assertNotEqual( plain, detailed )
+        with open( plain, "rb" ) as f:
+            with self.assertRaises( ValueError ):
+                mqvis.cache_decode( f.read() )
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,92 @@
+#!/bin/env python3.9
+
+"""
+Проверки истории снимков #F-HISTORY
+
+Запуск (slurm не нужен):
+* python3.9 -m unittest test_mqvis_history
+* python3.9 -m pytest test_mqvis_history.py
+"""
+
+import io
+import os
+import tempfile
+import unittest
+import contextlib
+from datetime import datetime, timedelta
+
+import mqvis
+
+# снимок из nnodes узлов, у каждого used занятых cpu из 8
+def snapshot( t, nnodes=3, used=4 ):
+    nodes = { f"node{i:02d}": { "schedule": [4], "cpus_total": 8, "cpus_free": 8 - used } for i in range(nnodes) }
+    return { "nodes": nodes, "index": {}, "time": t }
+
+class HistoryTest( unittest.TestCase ):
+
+    def setUp( self ):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join( self.dir.name, "mqvis.hist" )
+        self.saved = ( mqvis.HISTORY_FILE, mqvis.HISTORY_MIN_INTERVAL, mqvis.HISTORY_LAST )
+        mqvis.HISTORY_FILE = self.path
+        mqvis.HISTORY_MIN_INTERVAL = 60
+        mqvis.HISTORY_LAST = None
+
+    def tearDown( self ):
+        mqvis.HISTORY_FILE, mqvis.HISTORY_MIN_INTERVAL, mqvis.HISTORY_LAST = self.saved
+        self.dir.cleanup()
+
+    def paint( self, hours, now ):
+        out = io.StringIO()
+        with contextlib.redirect_stdout( out ):
+            mqvis.paint_history( hours, "", now )
+        return out.getvalue()
+
+    def test_append_and_read( self ):
+        t0 = datetime( 2026, 1, 1, 10, 0 )
+        for k in range(5):
+            self.assertTrue( mqvis.history_append( snapshot( t0 + timedelta(minutes=5*k) ), self.path ) )
+        recs = list( mqvis.history_records( self.path ) )
+        self.assertEqual( len(recs), 5 )
+        self.assertEqual( [ r["time"] for r in recs ], [ int( (t0 + timedelta(minutes=5*k)).timestamp() ) for k in range(5) ] )
+        self.assertEqual( list( recs[-1]["used"] ), [4, 4, 4] )
+
+    def test_min_interval( self ):
+        t0 = datetime( 2026, 1, 1, 10, 0 )
+        self.assertTrue( mqvis.history_append( snapshot(t0), self.path ) )
+        self.assertFalse( mqvis.history_append( snapshot( t0 + timedelta(seconds=10) ), self.path ) )
+        # без HISTORY_LAST (новый CGI-запуск) предыдущая запись читается из файла
+        mqvis.HISTORY_LAST = None
+        self.assertFalse( mqvis.history_append( snapshot( t0 + timedelta(seconds=20) ), self.path ) )
+        self.assertEqual( len( list( mqvis.history_records( self.path ) ) ), 1 )
+
+    # запись за 10 минут до начала первого показываемого часа не должна попадать в расчет
+    def test_partial_hour( self ):
+        now = datetime( 2026, 1, 1, 12, 30 )
+        self.assertTrue( mqvis.history_append( snapshot( datetime( 2026, 1, 1, 11, 50 ) ), self.path ) )
+        util, users = mqvis.history_utilization( self.path, 1, None, now )
+        self.assertEqual( dict(util), {} )
+        self.assertIn( "История пуста", self.paint( 1, now ) )
+        # в пределах окна из 2 часов та же запись видна
+        text = self.paint( 2, now )
+        self.assertIn( "50.0%", text )
+
+    def test_compact( self ):
+        t0 = datetime( 2026, 1, 1, 0, 0 )
+        for k in range(200):
+            mqvis.history_append( snapshot( t0 + timedelta(minutes=10*k), 50 ), self.path )
+        size = os.path.getsize( self.path )
+        saved = mqvis.HISTORY_MAX_MB
+        try:
+            mqvis.HISTORY_MAX_MB = size / 1024 / 1024 / 2
+            mqvis.history_compact( self.path )
+        finally:
+            mqvis.HISTORY_MAX_MB = saved
+        recs = list( mqvis.history_records( self.path ) )
+        self.assertLess( os.path.getsize( self.path ), size / 2 + 1 )
+        self.assertTrue( 0 < len(recs) < 200 )
+        # самая свежая запись остается
+        self.assertEqual( recs[-1]["time"], int( (t0 + timedelta(minutes=10*199)).timestamp() ) )
+
+if __name__ == "__main__":
+    unittest.main()
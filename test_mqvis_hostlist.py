@@ -0,0 +1,67 @@
+#!/bin/env python3.9
+
+"""
+Проверки раскрытия и сжатия hostlist #F-HOSTLIST
+
+Запуск (slurm не нужен):
+* python3.9 -m unittest test_mqvis_hostlist
+* python3.9 -m pytest test_mqvis_hostlist.py
+"""
+
+import random
+import unittest
+
+import mqvis
+
+# известные раскрытия hostlist
+HOSTLIST_CASES = [
+    ("node01", ["node01"]),
+    ("node[01-03,05]", ["node01", "node02", "node03", "node05"]),
+    ("a[1-2],b[3-4]", ["a1", "a2", "b3", "b4"]),
+    ("rack[1-2]-node[01-02]", ["rack1-node01", "rack1-node02", "rack2-node01", "rack2-node02"]),
+    ("node[8-10]-ib", ["node8-ib", "node9-ib", "node10-ib"]),
+    ("tesla-hi,apollo[17-18]", ["tesla-hi", "apollo17", "apollo18"]),
+    ("(null)", []),
+]
+
+# случайный набор имен узлов: разные префиксы, ширина номеров с нулями и без, суффиксы
+def random_names( rnd ):
+    names = set()
+    for i in range(rnd.randint(1, 40)):
+        prefix = rnd.choice(["node", "apollo", "gpu", "rack1-node", "n"])
+        num = rnd.randint(0, 120)
+        width = rnd.choice([0, 2, 3])
+        suffix = rnd.choice(["", "", "-ib"])
+        names.add( f"{prefix}{num:0{width}d}{suffix}" )
+    names.add( rnd.choice(["login", "tesla-hi", "x"]) )
+    return names
+
+class HostlistTest( unittest.TestCase ):
+
+    def test_expand_known( self ):
+        for s, expected in HOSTLIST_CASES:
+            with self.subTest( hostlist=s ):
+                self.assertEqual( list( mqvis.expand_hostlist(s) ), expected )
+
+    def test_compress_known( self ):
+        for s, expected in HOSTLIST_CASES:
+            if expected:
+                with self.subTest( hostlist=s ):
+                    self.assertEqual( sorted( mqvis.expand_hostlist( mqvis.compress_hostlist(expected) ) ), sorted(expected) )
+
+    # номера без ведущих нулей, в том числе "0", не должны становиться дополненными
+    def test_compress_unpadded( self ):
+        names = ["n0", "n1", "n2", "n10"]
+        self.assertEqual( sorted( mqvis.expand_hostlist( mqvis.compress_hostlist(names) ) ), sorted(names) )
+
+    # свойство expand(compress(x)) == x на случайных наборах
+    def test_roundtrip( self ):
+        rnd = random.Random( 1 )
+        for k in range(500):
+            names = random_names( rnd )
+            hl = mqvis.compress_hostlist( names )
+            with self.subTest( hostlist=hl ):
+                self.assertEqual( sorted( mqvis.expand_hostlist(hl) ), sorted(names) )
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,85 @@
+#!/bin/env python3.9
+
+"""
+Проверки разбора squeue в таблицу задач и сворачивания задач #F-JOBS-TABLE #F-AGGREGATE
+
+Запуск (slurm не нужен):
+* python3.9 -m unittest test_mqvis_jobs
+* python3.9 -m pytest test_mqvis_jobs.py
+"""
+
+import unittest
+from datetime import datetime
+
+import mqvis
+
+NOW = datetime( 2026, 10, 17, 12, 0 )
+
+# строка выдачи squeue -o SQUEUE_FIELDS
+def line( jobid, user="bob", state="RUNNING", nodes="node01", cpus="4", name="job",
+          start="2026-10-17T10:00:00", end="2026-10-17T20:00:00" ):
+    if state == "PENDING":
+        return f"{jobid}|{user}|{state}|{start}|{end}||{nodes}|{cpus}|{name}"
+    return f"{jobid}|{user}|{state}|{start}|{end}|{nodes}|(null)|{cpus}|{name}"
+
+def parse( lines ):
+    return mqvis.parse_squeue_narrow( lines, mqvis.new_jobs_table(NOW) )
+
+def rows( jt ):
+    return { mqvis.job_id_str(jt, i): jt["count"][i] for i in range( mqvis.jobs_count(jt) ) }
+
+class JobIdsTest( unittest.TestCase ):
+
+    def test_expand_job_ids( self ):
+        self.assertEqual( mqvis.expand_job_ids("12345"), ("12345",) )
+        self.assertEqual( mqvis.expand_job_ids("12345_[1-3,7%2]"), ("12345_1", "12345_2", "12345_3", "12345_7") )
+        self.assertEqual( mqvis.expand_job_ids("200_[1-9:2]"), ("200_1", "200_3", "200_5", "200_7", "200_9") )
+        self.assertEqual( mqvis.expand_job_ids("my_c:9_[1-2]"), ("my_c:9_1", "my_c:9_2") )
+        # непонятная запись - одна задача, без исключения
+        self.assertEqual( mqvis.expand_job_ids("1_[a-b]"), ("1_[a-b]",) )
+
+    def test_job_array_master( self ):
+        self.assertEqual( mqvis.job_array_master("12345_7"), "12345" )
+        self.assertEqual( mqvis.job_array_master("12345_[1-3]"), "12345" )
+        self.assertEqual( mqvis.job_array_master("my_c:777_5"), "my_c:777" )
+        self.assertEqual( mqvis.job_array_master("my_c:777"), "" )
+
+    # задача со ступенчатым массивом не должна обнулять таблицу
+    def test_stepped_array_row( self ):
+        jt = parse( [ line("100"), line("200_[1-9:2]", state="PENDING"), line("300", user="alice") ] )
+        self.assertEqual( rows(jt), { "100": 1, "200_[1-9:2]": 5, "300": 1 } )
+
+    def test_pending_array_count( self ):
+        jt = parse( [ line("12345_[8-500%10]", state="PENDING") ] )
+        self.assertEqual( rows(jt), { "12345_[8-500%10]": 493 } )
+
+class AggregateTest( unittest.TestCase ):
+
+    def test_array_tasks_merge( self ):
+        jt = parse( [ line(f"500_{k}") for k in range(1, 11) ] + [ line("600") ] )
+        agg = mqvis.aggregate_jobs( jt )
+        self.assertEqual( rows(agg), { "500_[1-10]": 10, "600": 1 } )
+
+    def test_different_attrs_not_merged( self ):
+        jt = parse( [ line("500_1"), line("500_2", nodes="node02"), line("500_3", cpus="8"),
+                      line("500_4", user="alice"), line("500_5", state="PENDING") ] )
+        self.assertIs( mqvis.aggregate_jobs( jt ), jt )
+
+    def test_identical_plain_jobs_merge( self ):
+        jt = parse( [ line("700"), line("701"), line("702") ] )
+        self.assertEqual( rows( mqvis.aggregate_jobs(jt) ), { "[700-702]": 3 } )
+
+    # имя кластера с "_" не должно сливать разные массивы #F-MULTI-CLUSTER
+    def test_cluster_prefix_with_underscore( self ):
+        jt = parse( [ line("my_c:777_5"), line("my_c:777_6"), line("my_c:778_5"), line("my_c:779") ] )
+        agg = rows( mqvis.aggregate_jobs(jt) )
+        self.assertEqual( agg["my_c:777_[5-6]"], 2 )
+        self.assertEqual( sum( agg.values() ), 4 )
+        self.assertEqual( len(agg), 3 )
+
+    def test_usage_jobs_not_merged( self ):
+        jt = parse( [ line("500_1"), line("500_2") ] )
+        self.assertIs( mqvis.aggregate_jobs( jt, { "500_1": {} } ), jt )
+
+if __name__ == "__main__":
+    unittest.main()
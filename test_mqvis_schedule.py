@@ -0,0 +1,144 @@
+#!/bin/env python3.9
+
+"""
+Проверки построения расписания на синтетической очереди из mqvis_bench
+#F-RASTER #F-INCREMENTAL #F-FIT
+
+Запуск (slurm не нужен):
+* python3.9 -m unittest test_mqvis_schedule
+* python3.9 -m pytest test_mqvis_schedule.py
+"""
+
+import random
+import unittest
+from datetime import datetime, timedelta
+
+import mqvis
+import mqvis_bench as bench
+
+NNODES = 40
+NJOBS = 300
+
+def new_user_tasks():
+    return {"running":[],"other":[],"pending":[]}
+
+# параметры модуля, которые меняют тесты
+class SettingsMixin:
+
+    def setUp( self ):
+        self.saved = ( mqvis.SLOT_TIERS, mqvis.TIME_SLOTS )
+        self.rows = bench.synthetic_job_rows( NNODES, NJOBS, "mixed", "RUNNING=2,PENDING=2,COMPLETING=1", 1 )
+        self.sinfo = bench.synthetic_sinfo_text( NNODES, 1 ).split("\n")
+        self.squeue = bench.synthetic_squeue_narrow_text( self.rows ).split("\n")
+
+    def tearDown( self ):
+        mqvis.SLOT_TIERS, mqvis.TIME_SLOTS = self.saved
+
+    def jobs( self, lines=None, now=None ):
+        return mqvis.parse_squeue_narrow( lines or self.squeue, mqvis.new_jobs_table(now) )
+
+    def nodes( self ):
+        return mqvis.parse_sinfo( self.sinfo )
+
+class RasterTest( SettingsMixin, unittest.TestCase ):
+
+    # арифметический растр совпадает с обходом задач по часам (как было)
+    def test_matches_reference( self ):
+        mqvis.SLOT_TIERS = [(3600, None)]
+        jt = self.jobs()
+        nodes = self.nodes()
+        mqvis.build_hourly_schedule( jt, nodes, new_user_tasks() )
+        ref = bench.reference_schedule( jt, self.nodes() )
+        for n, rec in nodes.items():
+            self.assertEqual( [x & 7 for x in rec['schedule']], ref[n]['schedule'], n )
+            self.assertEqual( list( rec['jobcnt'] ), ref[n]['jobcnt'], n )
+
+    # интервалы узла покрывают ровно занятые слоты
+    def test_intervals_cover_schedule( self ):
+        jt = self.jobs()
+        nodes = self.nodes()
+        mqvis.build_hourly_schedule( jt, nodes, new_user_tasks() )
+        for n, rec in nodes.items():
+            busy = set()
+            for row, s, e in rec['intervals']:
+                self.assertTrue( 0 <= s < e <= mqvis.TIME_SLOTS )
+                busy.update( range(s, e) )
+            self.assertEqual( busy, { k for k, x in enumerate(rec['schedule']) if x & 7 }, n )
+
+class IncrementalTest( SettingsMixin, unittest.TestCase ):
+
+    # несколько опросов подряд: время идет, часть задач исчезает - инкрементально как с нуля
+    def check( self, width ):
+        mqvis.SLOT_TIERS = mqvis.parse_slot_width( width )
+        rnd = random.Random( 5 )
+        st = mqvis.new_schedule_state()
+        now = datetime.now()
+        for it in range(12):
+            now += timedelta( minutes=rnd.choice([1, 7, 16, 40, 61]) )
+            lines = [ l for l in self.squeue if rnd.random() > 0.05 ]
+            full = self.nodes()
+            jt1 = self.jobs( lines, now )
+            mqvis.build_hourly_schedule( jt1, full, new_user_tasks(), None, {} )
+            inc = self.nodes()
+            jt2 = mqvis.incremental_schedule( st, self.jobs( lines, now ), inc, new_user_tasks(), None, {} )
+            for n in full:
+                for key in ("schedule", "jobcnt", "cpualloc"):
+                    self.assertEqual( list( full[n][key] ), list( inc[n][key] ), (width, it, n, key) )
+                a = sorted( (mqvis.job_id_str(jt1, r), s, e) for r, s, e in full[n]["intervals"] )
+                b = sorted( (mqvis.job_id_str(jt2, r), s, e) for r, s, e in inc[n]["intervals"] )
+                self.assertEqual( a, b, (width, it, n) )
+
+    def test_hourly( self ):
+        self.check( "1h" )
+
+    def test_adaptive( self ):
+        self.check( "adaptive" )
+
+class FitTest( SettingsMixin, unittest.TestCase ):
+
+    # перебор: первый слот, с которого count узлов имеют cpus свободных на duration
+    def brute( self, snap, cpus, duration, count ):
+        nodes = snap["nodes"]
+        edges = mqvis.snapshot_grid( nodes )["edges"]
+        nslots = len(edges) - 1
+        starts = [ int( snap["jobs"]["now"].timestamp() ) ] + edges[1:nslots]
+        for k in range(nslots):
+            end = min( nslots, mqvis.bisect_left( edges, starts[k] + duration ) )
+            ok = [ n for n, rec in nodes.items() if all( v >= cpus for v in mqvis.free_timeline(rec)[k:end] ) ]
+            if len(ok) >= count:
+                return k, sorted(ok)
+        return None, []
+
+    def test_against_brute_force( self ):
+        jt = self.jobs()
+        nodes = self.nodes()
+        mqvis.build_hourly_schedule( jt, nodes, new_user_tasks() )
+        snap = { "nodes": nodes, "jobs": jt }
+        for spec in ( "1cpu:1h", "32cpu:12h", "2x32cpu:12h", "4x64cpu:1d", "128cpu:3d", "200cpu:1h" ):
+            cpus, duration, count = mqvis.parse_fit( spec )
+            res = mqvis.fit_query( snap, cpus, duration, count )
+            slot, names = self.brute( snap, cpus, duration, count )
+            self.assertEqual( res["slot"], slot, spec )
+            if slot is not None:
+                self.assertEqual( res["nodes"], names, spec )
+
+    # узел освобождается через 3 часа, другой через 5 - первое место для 1 и для 2 узлов
+    def test_known_slots( self ):
+        mqvis.SLOT_TIERS = [(3600, None)]
+        now = datetime( 2026, 10, 17, 12, 30 )
+        fmt = '%Y-%m-%dT%H:%M:%S'
+        def job( jobid, node, hours ):
+            return f"{jobid}|bob|RUNNING|{(now - timedelta(hours=1)).strftime(fmt)}|{(now + timedelta(hours=hours)).strftime(fmt)}|{node}|(null)|8|j"
+        jt = mqvis.parse_squeue_narrow( [ job("1", "node01", 3), job("2", "node02", 5) ], mqvis.new_jobs_table(now) )
+        nodes = mqvis.parse_sinfo( [ "node01 8/0/0/8 alloc all", "node02 8/0/0/8 alloc all" ] )
+        mqvis.build_hourly_schedule( jt, nodes, new_user_tasks() )
+        snap = { "nodes": nodes, "jobs": jt }
+        res = mqvis.fit_query( snap, 8, 3600, 1 )
+        self.assertEqual( (res["slot"], res["nodes"]), self.brute( snap, 8, 3600, 1 ) )
+        self.assertEqual( res["nodes"], ["node01"] )
+        res2 = mqvis.fit_query( snap, 8, 3600, 2 )
+        self.assertEqual( (res2["slot"], res2["nodes"]), self.brute( snap, 8, 3600, 2 ) )
+        self.assertGreater( res2["slot"], res["slot"] )
+
+if __name__ == "__main__":
+    unittest.main()